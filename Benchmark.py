@@ -0,0 +1,406 @@
+'''
+Benchmark module
+
+This module's responsibility is to measure how the stages of the project
+scale with the amount of instances: it generates synthetic datasets with the
+shape of iris and covtype (raw .data files, as the original ones) and times
+separately their preprocessing (Parser), loading, splitting, training
+(ID3.ID3 or Classifier.generate_forest_classifier), the save and load of the
+binary model (FlatTree) and the prediction of the validation instances, both
+vectorized (Classifier.predict_matrix) and instance by instance, walking the
+compiled trees once per instance (Classifier.classify_flat and
+Classifier.classify_dataset_multi_label).
+For each stage it records the seconds, the throughput (instances per second)
+and the peak resident memory, and it compares them with a baseline file of a
+previous run to flag regressions. Everything runs offline.
+'''
+
+import Classifier
+import Data
+import FlatTree
+import ID3
+import json
+import numpy
+import os
+import Parser
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from Utils import resident_memory
+
+# Instances generated and written to the raw files at once
+generation_block_rows = 500000
+
+# Means and standard deviations of the attributes of each class of iris
+iris_means = [[5.0, 3.4, 1.5, 0.2], [5.9, 2.8, 4.3, 1.3], [6.6, 3.0, 5.6, 2.0]]
+iris_deviations = [[0.35, 0.38, 0.17, 0.1], [0.52, 0.31, 0.47, 0.2],
+                   [0.64, 0.32, 0.55, 0.27]]
+
+# Lowest and highest values of the continuous attributes of covtype
+covtype_ranges = [(1859, 3858), (0, 360), (0, 66), (0, 1397), (-173, 601),
+                  (0, 7117), (0, 254), (0, 254), (0, 254), (0, 7173)]
+
+# Seconds between two samples of the resident memory
+memory_interval = 0.005
+
+
+'''
+Writes to file_path a raw iris file (as iris/iris.data) with amount_rows
+instances: each attribute is drawn from a normal distribution with the mean
+and deviation of its class in the real dataset, so the classes are about as
+separable as in it.
+'''
+
+
+def generate_iris(file_path, amount_rows, seed):
+    generator = numpy.random.default_rng(seed)
+    classes = numpy.array(Data.Data('iris', instances=False).classes,
+                          dtype=object)
+    with open(file_path, 'w') as output:
+        for start in range(0, amount_rows, generation_block_rows):
+            rows = min(generation_block_rows, amount_rows - start)
+            labels = generator.integers(0, len(classes), rows)
+            values = generator.normal(numpy.take(iris_means, labels, axis=0),
+                                      numpy.take(iris_deviations, labels,
+                                                 axis=0))
+            values = numpy.round(numpy.clip(values, 0.1, None), 1)
+            block = numpy.empty((rows, 5), dtype=object)
+            block[:, :4] = values
+            block[:, 4] = classes[labels]
+            numpy.savetxt(output, block, fmt='%.1f,%.1f,%.1f,%.1f,%s')
+
+
+'''
+Writes to file_path a raw covtype file (as covtype/covtype.data) with
+amount_rows instances: the classes follow the distribution of the real
+dataset, the elevation, the wilderness area and the soil type depend on the
+class (with noise) and the other attributes are uniform in their ranges.
+'''
+
+
+def generate_covtype(file_path, amount_rows, seed):
+    generator = numpy.random.default_rng(seed)
+    distribution = Data.Data('covtype', instances=False).class_distribution
+    proportions = numpy.array(list(distribution.values()))
+    proportions /= proportions.sum()
+    with open(file_path, 'w') as output:
+        for start in range(0, amount_rows, generation_block_rows):
+            rows = min(generation_block_rows, amount_rows - start)
+            labels = generator.choice(len(proportions), rows, p=proportions)
+            block = numpy.zeros((rows, 55), dtype=numpy.int64)
+            for column, (low, high) in enumerate(covtype_ranges):
+                block[:, column] = generator.integers(low, high + 1, rows)
+            low, high = covtype_ranges[0]
+            block[:, 0] = numpy.clip(
+                low + 250 + 250 * labels + generator.normal(0, 180, rows),
+                low, high)
+            wilderness = (labels + generator.integers(0, 2, rows)) % 4
+            soil = numpy.where(generator.random(rows) < 0.8,
+                               (5 * labels + generator.integers(0, 5, rows))
+                               % 40,
+                               generator.integers(0, 40, rows))
+            positions = numpy.arange(rows)
+            block[positions, 10 + wilderness] = 1
+            block[positions, 14 + soil] = 1
+            block[:, 54] = labels + 1
+            numpy.savetxt(output, block, fmt='%d', delimiter=',')
+
+
+generators = {'iris': generate_iris, 'covtype': generate_covtype}
+
+
+class MemorySampler:
+    '''
+    Samples the resident memory of the process every memory_interval
+    seconds in a thread while it is used as a context manager, keeping the
+    peak in the attribute peak.
+    '''
+    def __init__(self):
+        self.peak = resident_memory()
+        self.__running = False
+        self.__thread = None
+
+    def __enter__(self):
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__sample, daemon=True)
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *exception):
+        self.__running = False
+        self.__thread.join()
+        self.peak = max(self.peak, resident_memory())
+
+    def __sample(self):
+        while self.__running:
+            self.peak = max(self.peak, resident_memory())
+            time.sleep(memory_interval)
+
+
+'''
+Runs function() measuring it as the stage of a benchmark that processes
+amount elements (instances, or nodes for the stages of the model), and adds
+its measures to stages[name]: the seconds, the elements per second, the peak
+resident memory and its growth over the memory before the stage (in bytes).
+Returns the result of function.
+'''
+
+
+def measure(stages, name, amount, function):
+    memory_before = resident_memory()
+    with MemorySampler() as sampler:
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+    stages[name] = {
+        'seconds': seconds,
+        'amount': amount,
+        'per_second': amount / seconds if seconds > 0 else None,
+        'peak_memory': sampler.peak,
+        'memory_growth': max(sampler.peak - memory_before, 0)
+    }
+    print('  {stage:<28} {seconds:10.3f} s {rate:>14} /s {mb:10.1f} MB'.format(
+        stage=name, seconds=seconds,
+        rate='-' if seconds == 0 else '{r:.0f}'.format(r=amount / seconds),
+        mb=sampler.peak / 2**20))
+    return result
+
+
+'''
+Classifies the instances of data (already discretized) one at a time with
+tree, walking its compiled tree once per instance as
+Classifier.classify_multi_label does with each tree of a forest.
+Returns the list of predicted class labels.
+'''
+
+
+def __classify_instances(tree, data):
+    flat_tree = FlatTree.FlatTree.compile(tree)
+    return [Classifier.classify_flat(flat_tree, data.dataset[index],
+                                     data.global_class_distribution)[0]
+            for index in range(len(data.dataset))]
+
+
+'''
+Runs the benchmark of the dataset data_name ('iris' or 'covtype') with
+amount_rows synthetic instances inside directory (see the module
+docstring). training_options are the options of ID3.ID3 and
+sample_rows the maximum amount of validation instances classified
+instance by instance (the vectorized prediction uses all of them).
+Returns a dictionary stage name -> measures (see measure).
+'''
+
+
+def run_benchmark(data_name, amount_rows, directory, seed, training_options,
+                  sample_rows, classifier_types=['Single', 'Forest']):
+    stages = {}
+    raw_path = os.path.join(directory, data_name + '.data')
+    binary_path = os.path.join(directory, data_name + Data.binary_extension)
+    metadata = Data.Data(data_name, instances=False)
+    measure(stages, 'generation', amount_rows,
+            lambda: generators[data_name](raw_path, amount_rows, seed))
+    measure(stages, 'preprocessing', amount_rows,
+            lambda: Parser.build_binary_data(data_name, raw_path,
+                                             binary_path, metadata.classes))
+    os.remove(raw_path)
+    data = measure(stages, 'loading', amount_rows,
+                   lambda: Data.load_data(data_name, binary_path,
+                                          columnar=True))
+    data_training, data_validation = measure(
+        stages, 'splitting', amount_rows,
+        lambda: data.apply_split(data.draw_split(0.8, seed=seed)))
+    amount_training = len(data_training.dataset)
+    amount_validation = len(data_validation.dataset)
+    matrix = data_validation.feature_matrix()
+    sample = data_validation.copy(instances=False)
+    sample.dataset = data_validation.dataset.take(
+        numpy.arange(min(sample_rows, amount_validation)))
+    model_path = os.path.join(directory, 'model' + Data.binary_extension)
+    for classifier_type in classifier_types:
+        prefix = classifier_type.lower() + '_'
+        if classifier_type == 'Single':
+            tree, breakpoints = measure(
+                stages, prefix + 'training', amount_training,
+                lambda: ID3.ID3(data_training, **training_options))
+            classifier = [(tree, breakpoints, None)]
+            members = [None]
+        else:
+            classifier = measure(
+                stages, prefix + 'training', amount_training,
+                lambda: Classifier.generate_forest_classifier(
+                    data_training, 1, **training_options))
+            members = data_training.classes
+        trees = [FlatTree.FlatTree.compile(tree[0], thresholds=True)
+                 for tree in classifier]
+        amount_nodes = sum(len(tree) for tree in trees)
+        measure(stages, prefix + 'model_save', amount_nodes,
+                lambda: FlatTree.save_model(
+                    model_path, data_name, data_training.classes, trees,
+                    [tree[1] for tree in classifier],
+                    [tree[2] for tree in classifier], members))
+        loaded = measure(stages, prefix + 'model_load', amount_nodes,
+                         lambda: FlatTree.load_model(model_path))
+        flat_trees = Classifier.raw_flat_trees(loaded[0], loaded[1])
+        measure(stages, prefix + 'prediction', amount_validation,
+                lambda: Classifier.predict_matrix(
+                    flat_trees, loaded[2], metadata.classes,
+                    metadata.global_class_distribution, matrix))
+        if classifier_type == 'Single':
+            discretized = sample.copy()
+            discretized.apply_breakpoints(breakpoints)
+            measure(stages, prefix + 'prediction_instances', len(sample.dataset),
+                    lambda: __classify_instances(tree, discretized))
+        else:
+            # Each tree reads the sample discretized with its own breakpoints
+            multiple_data = []
+            for tree in classifier:
+                discretized = sample.copy()
+                discretized.apply_breakpoints(tree[1])
+                multiple_data.append(discretized)
+            measure(stages, prefix + 'prediction_instances', len(sample.dataset),
+                    lambda: Classifier.classify_dataset_multi_label(
+                        classifier, multiple_data))
+    return stages
+
+
+'''
+Compares the measures of results with the ones of baseline (both as saved
+by this module). A stage is a regression if it took more than
+1 + tolerance times the seconds of the baseline, or if its peak memory grew
+by more than that proportion. Stages shorter than min_seconds in both runs
+are not compared by time, as their timings are mostly noise.
+Returns a list of tuples (rows, stage, measure, baseline value, value).
+'''
+
+
+def compare(results, baseline, tolerance, min_seconds=0.05):
+    regressions = []
+    for rows, stages in results['runs'].items():
+        baseline_stages = baseline['runs'].get(rows, {})
+        for stage, measures in stages.items():
+            if stage not in baseline_stages:
+                continue
+            reference = baseline_stages[stage]
+            if (max(measures['seconds'], reference['seconds']) >= min_seconds
+                    and measures['seconds'] >
+                    reference['seconds'] * (1 + tolerance)):
+                regressions.append((rows, stage, 'seconds',
+                                    reference['seconds'], measures['seconds']))
+            if measures['peak_memory'] > reference['peak_memory'] * (1 + tolerance):
+                regressions.append((rows, stage, 'peak_memory',
+                                    reference['peak_memory'],
+                                    measures['peak_memory']))
+    return regressions
+
+
+if __name__ == '__main__':
+    uso = """
+        Para medir el rendimiento invocar como:
+
+        python3 Benchmark.py [iris|covtype] [instancias ...] [opciones]
+
+        donde:
+        - iris o covtype indica la forma del dataset sintético que se genera.
+        - instancias es la cantidad de instancias de cada dataset generado (e.g. 10000 100000 1000000 10000000).
+        - opciones:
+            --salida [archivo] archivo json en el que se guardan los resultados (benchmark.json por defecto).
+            --base [archivo] archivo json de una ejecución anterior con el que se comparan los resultados; si alguna
+            etapa es más lenta o usa más memoria que la tolerancia, se listan las regresiones y el programa termina
+            con código 1. La base se lee antes de medir, por lo que puede ser el mismo archivo que --salida.
+            --tolerancia [proporción] proporción de aumento admitida respecto de la base (0.2 por defecto).
+            --clasificador [Single|Forest|ambos] clasificadores que se entrenan (ambos por defecto).
+            --profundidad [niveles] profundidad máxima de los árboles (3 por defecto, 0 para no limitarla).
+            --histograma [cubetas] entrena con histogramas de esa cantidad de cubetas.
+            --muestra [instancias] máxima cantidad de instancias que se clasifican de a una (20000 por defecto).
+            --semilla [entero] semilla de la generación y de la división (0 por defecto).
+            --directorio [directorio] directorio de trabajo para los archivos generados (uno temporal por defecto).\n
+    """
+    valued_options = ['salida', 'base', 'tolerancia', 'clasificador', 'profundidad', 'histograma', 'muestra',
+                      'semilla', 'directorio']
+    arguments = []
+    options = {}
+    index = 1
+    while index < len(sys.argv):
+        argument = sys.argv[index]
+        index += 1
+        if not argument.startswith('--'):
+            arguments.append(argument)
+        elif argument[2:] in valued_options and index < len(sys.argv):
+            options[argument[2:]] = sys.argv[index]
+            index += 1
+        else:
+            print('Error. Opción desconocida o sin valor {opt}.\n'.format(opt=argument))
+            print(uso)
+            exit()
+    if len(arguments) < 2 or arguments[0] not in generators:
+        print(uso)
+        exit()
+    if not all(rows.isdigit() and int(rows) > 0 for rows in arguments[1:]):
+        print('Error. Cantidad de instancias incorrecta. Debe ser un entero positivo\n')
+        print(uso)
+        exit()
+    data_name = arguments[0]
+    try:
+        tolerance = float(options.get('tolerancia', 0.2))
+        seed = int(options.get('semilla', 0))
+        sample_rows = int(options.get('muestra', 20000))
+        training_options = {}
+        if 'profundidad' in options:
+            training_options['max_depth'] = int(options['profundidad']) or None
+        if 'histograma' in options:
+            training_options['histogram_bins'] = int(options['histograma'])
+    except ValueError:
+        print('Error. Valor de opción incorrecto.\n')
+        print(uso)
+        exit()
+    classifier_types = {'Single': ['Single'], 'Forest': ['Forest'],
+                        'ambos': ['Single', 'Forest']}.get(options.get('clasificador', 'ambos'))
+    if classifier_types is None:
+        print('Error. Clasificador incorrecto. Solo puede ser "Single", "Forest" o "ambos"\n')
+        print(uso)
+        exit()
+
+    baseline = None
+    if 'base' in options:
+        # Read before running, so the output can replace the baseline file
+        try:
+            with open(options['base']) as baseline_file:
+                baseline = json.load(baseline_file)
+        except (OSError, ValueError):
+            baseline = None
+        if not isinstance(baseline, dict) or not isinstance(baseline.get('runs'), dict):
+            print('Error. No se pudo leer el archivo base {file}. Debe ser un json generado con --salida.\n'
+                  .format(file=options['base']))
+            print(uso)
+            exit()
+
+    results = {'dataset': data_name, 'seed': seed, 'training_options': training_options,
+               'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                           'processors': os.cpu_count()},
+               'runs': {}}
+    for rows in arguments[1:]:
+        directory = options.get('directorio') or tempfile.mkdtemp()
+        os.makedirs(directory, exist_ok=True)
+        print('{name} con {rows} instancias\n'.format(name=data_name, rows=rows))
+        try:
+            results['runs'][rows] = run_benchmark(data_name, int(rows), directory, seed, training_options,
+                                                  sample_rows, classifier_types)
+        finally:
+            if 'directorio' not in options:
+                shutil.rmtree(directory)
+        print()
+    output_file = options.get('salida', 'benchmark.json')
+    print('Guardando los resultados en {file}\n'.format(file=output_file))
+    with open(output_file, 'w') as output:
+        json.dump(results, output, indent=4)
+    if baseline is not None:
+        regressions = compare(results, baseline, tolerance)
+        for rows, stage, name, reference, value in regressions:
+            print('Regresión en {stage} con {rows} instancias: {name} pasó de {reference:.4g} a {value:.4g}'.format(
+                stage=stage, rows=rows, name=name, reference=reference, value=value))
+        if regressions:
+            exit(1)
+        print('Sin regresiones respecto de {file}\n'.format(file=options['base']))
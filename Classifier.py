@@ -6,12 +6,18 @@ ID3 decsion trees.
 '''
 
 import copy
+import FlatTree
+import numpy
 import ID3
 import Data
 import Utils
+import multiprocessing
 import random
 import re
 import os
+import shutil
+import Storage
+import tempfile
 
 
 # Returns the class of the instance according to the tree.
@@ -37,6 +43,153 @@ def classify(tree, instance, distribution):
     return current_node.tag
 
 
+'''
+Same as classify, but over a tree compiled with FlatTree.FlatTree.compile.
+Returns a tuple (class, instances) with the class label (as it appears in
+the tag of the leaf) and the amount of instances of the leaf.
+'''
+
+
+def classify_flat(flat_tree, instance, distribution):
+    leaf = flat_tree.leaf(instance)
+    if leaf < 0:
+        random_class = Utils.weighted_random(
+            list(distribution.keys()), distribution)
+        return str(random_class), distribution[random_class]
+    return (flat_tree.labels[flat_tree.leaf_class[leaf]],
+            int(flat_tree.leaf_count[leaf]))
+
+
+'''
+Batch prediction: takes a tree (a treelib tree or a FlatTree.FlatTree) and a
+set of instances to be evaluated (an instance of Data, already discretized)
+and routes all of them through the tree at once.
+Returns an integer vector with the position inside data.classes of the
+class predicted for each instance. When the path of an instance leaves the
+tree, a class is sorted following data.global_class_distribution (as in
+classify), in the order of the instances.
+'''
+
+
+def predict_dataset_tree(tree, data):
+    if not isinstance(tree, FlatTree.FlatTree):
+        tree = FlatTree.FlatTree.compile(tree)
+    return predict_matrix_tree(tree, data.feature_matrix(), data.classes,
+                               data.global_class_distribution)
+
+
+'''
+Same as predict_dataset_tree, over a FlatTree.FlatTree and a 2-D array of
+instances (one row per instance, without the class) of a dataset with the
+given classes and class distribution.
+'''
+
+
+def predict_matrix_tree(flat_tree, matrix, classes, distribution):
+    predictions = flat_tree.predict(matrix, classes)
+    class_index = {str(c): i for i, c in enumerate(classes)}
+    for i in numpy.flatnonzero(predictions < 0).tolist():
+        random_class = Utils.weighted_random(
+            list(distribution.keys()), distribution)
+        predictions[i] = class_index[str(random_class)]
+    return predictions
+
+
+'''
+Returns the trees of a classifier (treelib trees or FlatTree.FlatTree) as
+FlatTree.FlatTree that route raw instances, taking breakpoints[i] as the
+thresholds of the nodes of trees[i] without their own (the trees loaded
+from json files; see FlatTree.FlatTree.compile).
+'''
+
+
+def raw_flat_trees(trees, breakpoints):
+    flat_trees = []
+    for i in range(len(trees)):
+        tree = trees[i]
+        if not isinstance(tree, FlatTree.FlatTree):
+            tree = FlatTree.FlatTree.compile(tree, thresholds=True)
+        flat_trees.append(tree.with_breakpoints(breakpoints[i]))
+    return flat_trees
+
+
+'''
+Predicts the class of the rows of matrix (raw instances, one per row) with
+a single tree (if flat_trees has one element) or with a forest, see
+predict_matrix_tree and predict_matrix_forest.
+Returns an integer vector with the position inside classes of the class
+predicted for each row.
+'''
+
+
+def predict_matrix(flat_trees, distributions, classes, global_distribution,
+                   matrix):
+    if len(flat_trees) == 1:
+        return predict_matrix_tree(flat_trees[0], matrix, classes,
+                                   global_distribution)
+    return predict_matrix_forest(flat_trees, distributions, matrix)
+
+
+'''
+Classifies the raw instances of data (not discretized: the thresholds of
+the trees are applied on the fly) with the classifier given by flat_trees and
+distributions (see raw_flat_trees and predict_matrix), reading a single
+matrix of instances whatever the amount of trees.
+Returns a list of tuples (true_class, classified_class), as
+classify_dataset_tree.
+'''
+
+
+def classify_dataset(flat_trees, distributions, data):
+    predictions = predict_matrix(flat_trees, distributions, data.classes,
+                                 data.global_class_distribution,
+                                 data.feature_matrix())
+    true_classes = data.label_vector()
+    return [(data.classes[true_class], str(data.classes[classified_class]))
+            for true_class, classified_class
+            in zip(true_classes.tolist(), predictions.tolist())]
+
+
+'''
+Batch version of classify_multi_label: routes all the rows of matrix (a 2-D
+array of instances, one row per instance) through each one-versus-rest tree
+of the forest at once. flat_trees[i] is the FlatTree.FlatTree of the class
+in position i and distributions[i] its class distribution.
+The votes follow process_tags: among the trees whose leaf says 1 (or all of
+them, if none does) wins the one whose leaf has most instances, at random
+among the tied ones.
+Returns an integer vector with the position of the predicted class (the
+winning tree) for each row.
+'''
+
+
+def predict_matrix_forest(flat_trees, distributions, matrix):
+    amount_rows = len(matrix)
+    votes = numpy.zeros((amount_rows, len(flat_trees)), dtype=bool)
+    counts = numpy.zeros((amount_rows, len(flat_trees)))
+    for i in range(len(flat_trees)):
+        leaves = flat_trees[i].leaves(matrix)
+        labels = numpy.array(
+            [int(label) for label in flat_trees[i].labels] + [0])
+        leaf_class = flat_trees[i].leaf_class[leaves]
+        leaf_class[leaves < 0] = len(flat_trees[i].labels)
+        votes[:, i] = labels[leaf_class] == 1
+        counts[:, i] = flat_trees[i].leaf_count[leaves]
+        # The rows whose path leaves the tree sort a class (as in classify)
+        for row in numpy.flatnonzero(leaves < 0).tolist():
+            random_class = Utils.weighted_random(
+                list(distributions[i].keys()), distributions[i])
+            votes[row, i] = int(random_class) == 1
+            counts[row, i] = distributions[i][random_class]
+    voters = votes | ~votes.any(axis=1, keepdims=True)
+    scores = numpy.where(voters, counts, -numpy.inf)
+    winners = scores == scores.max(axis=1, keepdims=True)
+    guesses = winners.argmax(axis=1)
+    for row in numpy.flatnonzero(winners.sum(axis=1) > 1).tolist():
+        guesses[row] = random.choice(numpy.flatnonzero(winners[row]).tolist())
+    return guesses
+
+
 '''
 Takes a tree and a set of instances to be evaluated and
 returns a list of tuples (true_class, classified_class)
@@ -44,15 +197,11 @@ returns a list of tuples (true_class, classified_class)
 
 
 def classify_dataset_tree(tree, data):
-    result_list = []
-    # classify instances
-    for instance in data.dataset:
-        result_node_tag = classify(tree, instance,
-                                   data.global_class_distribution)
-        classified_class = re.findall(r'Class ([^,]+)', result_node_tag)[0]
-        true_class = instance[-1]
-        result_list.append((true_class, classified_class))
-    return result_list
+    predictions = predict_dataset_tree(tree, data)
+    true_classes = data.label_vector()
+    return [(data.classes[true_class], str(data.classes[classified_class]))
+            for true_class, classified_class
+            in zip(true_classes.tolist(), predictions.tolist())]
 
 
 '''
@@ -62,6 +211,8 @@ that attribute to 1, otherwise 0, generates new memory for the result.
 
 
 def map_dataset(dataset, label):
+    if isinstance(dataset, Storage.ColumnarDataset):
+        return dataset.one_versus_rest(label)
     new_dataset = copy.deepcopy(dataset)
     for row in new_dataset:
         row[-1] = 1 if row[-1] == label else 0
@@ -85,39 +236,116 @@ def classify_dataset_random(data):
     return result
 
 '''
-Receives data with 80 percent of the dataset for training.
+Builds the instance of Data used to train the tree of class_label in the
+forest classifier: the class of an instance is 1 if it is labeled with
+class_label and 0 otherwise.
+'''
+
+
+def one_versus_rest_data(data, class_label):
+    # Transform the data dataset
+    mapped_data = map_dataset(data.dataset, class_label)
+    new_data = data.copy(instances=False)
+    new_data.dataset = mapped_data
+    # Transform the data metadata
+    new_data.amount_classes = 2
+    new_data.classes = [1, 0]
+    label_distribution = data.class_distribution[class_label]
+    new_data.class_distribution = {1: label_distribution,
+                                   0: 1-label_distribution}
+    new_data.global_class_distribution = {1: label_distribution,
+                                          0: 1-label_distribution}
+    return new_data
+
+
+'''
+Receives data with 80 percent of the dataset for training and the training
+options for ID3.ID3.
+If processes is greater than 1, the trees are trained in parallel by that
+amount of worker processes (see __generate_forest_parallel).
 Returns array with n classification trees where n is the amount of classes.
 '''
 
 
-def generate_forest_classifier(data):
+def generate_forest_classifier(data, processes=1, **options):
+    if processes > 1:
+        return __generate_forest_parallel(data, processes, options)
     IDtrees = []
     for class_label in data.classes:
-        # Transform the data dataset
-        mapped_data = map_dataset(data.dataset, class_label)
-        new_data = data.copy()
-        new_data.dataset = mapped_data
-        # Transform the data metadata
-        new_data.amount_classes = 2
-        new_data.classes = [1, 0]
-        label_distribution = new_data.class_distribution[class_label]
-        new_data.class_distribution = {1: label_distribution,
-                                       0: 1-label_distribution}
-        new_data.global_class_distribution = {1: label_distribution,
-                                              0: 1-label_distribution}
-        idtree_result = ID3.ID3(new_data)
+        new_data = one_versus_rest_data(data, class_label)
+        idtree_result = ID3.ID3(new_data, **options)
         IDtrees.append((idtree_result[0], idtree_result[1], new_data.class_distribution))
     return IDtrees
 
 
+# Training data shared by the trees trained in a worker process
+__forest_worker_data = None
+__forest_worker_options = None
+
+
+def __init_forest_worker(file_path, metadata, options):
+    global __forest_worker_data, __forest_worker_options
+    # The instances are memory-mapped: every worker shares the same pages
+    dataset, _ = Storage.load_dataset(file_path)
+    metadata.columnar = True
+    metadata.dataset = dataset
+    __forest_worker_data = metadata
+    __forest_worker_options = options
+
+
+def __train_forest_tree(class_label, seed):
+    random.seed(seed)
+    new_data = one_versus_rest_data(__forest_worker_data, class_label)
+    idtree_result = ID3.ID3(new_data, **__forest_worker_options)
+    return (idtree_result[0], idtree_result[1], new_data.class_distribution)
+
+
+'''
+Trains the trees of the forest classifier in a pool of processes worker
+processes. The instances are saved once to a temporary binary file that
+every worker memory-maps read-only, and each task only receives the class
+label of its tree (each worker derives the binary labels itself), so the
+memory used does not grow with the amount of classes.
+Each tree gets its own random seed drawn from random, so the results are
+reproducible and do not depend on the scheduling of the workers.
+The workers train their trees serially: a worker can not open its own pool
+of processes to score the attributes.
+'''
+
+
+def __generate_forest_parallel(data, processes, options):
+    data = data.columnar_copy()
+    options = dict(ID3.worker_options(options, processes),
+                   attribute_processes=1)
+    seeds = [random.getrandbits(32) for _ in data.classes]
+    directory = tempfile.mkdtemp()
+    try:
+        file_path = os.path.join(directory, 'training' + Data.binary_extension)
+        data.save_data(file_path)
+        with multiprocessing.Pool(
+                processes, initializer=__init_forest_worker,
+                initargs=(file_path, data.copy(instances=False),
+                          options)) as pool:
+            return pool.starmap(__train_forest_tree, zip(data.classes, seeds))
+    finally:
+        shutil.rmtree(directory)
+
+
 # Classifies a multi-label dataset and returns the generated labels for it
+# The trees of the classifier are treelib trees or FlatTree.FlatTree
 def classify_dataset_multi_label(classifier, multiple_data):
     labels = []
+    flat_trees = []
+    for tree in classifier:
+        if isinstance(tree[0], FlatTree.FlatTree):
+            flat_trees.append(tree[0])
+        else:
+            flat_trees.append(FlatTree.FlatTree.compile(tree[0]))
     for index in range(len(multiple_data[0].dataset)):
         entries = []
         for d in range(len(multiple_data)):
             entries.append(multiple_data[d].dataset[index])
-        guess = classify_multi_label(classifier, entries)
+        guess = classify_multi_label(classifier, entries, flat_trees)
         guess_label = multiple_data[d].classes[guess]
         label = (multiple_data[0].dataset[index])[-1]
         labels.append([label, guess_label])
@@ -125,16 +353,24 @@ def classify_dataset_multi_label(classifier, multiple_data):
 
 
 # Classifies an entry using the multi-label classifier
-def classify_multi_label(classifier, entries):
+# flat_trees (optional) are the trees of the classifier compiled with
+# FlatTree.FlatTree.compile
+def classify_multi_label(classifier, entries, flat_trees=None):
     tags = []
     count = 0
     for i in range(len(classifier)):
         tree = classifier[i]
         entry = entries[i]
-        classify_result = classify(tree[0], entry, tree[2])
-        instances_count = float(re.findall(r'Instances (\d+)',
-                                classify_result)[0])
-        class_value = int(re.findall(r'Class (\d)+', classify_result)[0])
+        if flat_trees is None:
+            classify_result = classify(tree[0], entry, tree[2])
+            instances_count = float(re.findall(r'Instances (\d+)',
+                                    classify_result)[0])
+            class_value = int(re.findall(r'Class (\d)+', classify_result)[0])
+        else:
+            class_label, instances_count = classify_flat(
+                flat_trees[i], entry, tree[2])
+            instances_count = float(instances_count)
+            class_value = int(class_label)
         tags.append([count, class_value, instances_count])
         count += 1
     guess = tags[process_tags(tags)[0]][0]
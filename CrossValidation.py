@@ -0,0 +1,257 @@
+'''
+Cross validation module
+
+This module's responsibility is to estimate the metrics of a classifier
+(Single or Forest) with k-fold cross validation: the instances are divided
+into k folds, and for each fold a classifier is trained with the other k - 1
+folds and evaluated with it. The folds can be trained in parallel by worker
+processes that share a single copy of the instances.
+'''
+
+import Classifier
+import Data
+import Evaluator
+import ID3
+import json
+import math
+import multiprocessing
+import numpy
+import os
+import random
+import shutil
+import Storage
+import tempfile
+import time
+
+
+'''
+Divides the instances of data into amount_folds folds with a single random
+permutation drawn from seed (one per class if stratified, dealing the
+instances of each class to the folds in turn so every fold keeps the
+proportion of the classes).
+Returns a list with the index array of each fold.
+'''
+
+
+def draw_folds(data, amount_folds, stratified, seed):
+    generator = numpy.random.default_rng(seed)
+    if not stratified:
+        return numpy.array_split(generator.permutation(len(data.dataset)),
+                                 amount_folds)
+    labels = data.label_vector()
+    folds = [[] for _ in range(amount_folds)]
+    # The class members are dealt one after another, so the first folds do
+    # not always get the remainders
+    dealt = 0
+    for position in range(len(data.classes)):
+        members = generator.permutation(numpy.flatnonzero(labels == position))
+        for fold in range(amount_folds):
+            start = (fold - dealt) % amount_folds
+            folds[fold].append(members[start::amount_folds])
+        dealt += len(members)
+    return [generator.permutation(numpy.concatenate(fold)) for fold in folds]
+
+
+'''
+Trains a classifier of classifier_type with the instances of data_training
+and predicts the classes of the instances of data_validation (raw, see
+Classifier.predict_matrix). The class distributions are recalculated from
+the training instances, so nothing of the validation instances is seen
+before predicting them.
+Returns a dictionary with the confusion matrix and the seconds spent
+training and predicting.
+'''
+
+
+def evaluate_fold(data_training, data_validation, classifier_type,
+                  training_options):
+    start = time.perf_counter()
+    data_training.recalculate_distributions()
+    if classifier_type == 'Single':
+        tree, breakpoints = ID3.ID3(data_training, **training_options)
+        trees, breakpoints, distributions = [tree], [breakpoints], [None]
+    else:
+        forest = Classifier.generate_forest_classifier(data_training, 1,
+                                                       **training_options)
+        trees = [tree[0] for tree in forest]
+        breakpoints = [tree[1] for tree in forest]
+        distributions = [tree[2] for tree in forest]
+    training_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    flat_trees = Classifier.raw_flat_trees(trees, breakpoints)
+    predictions = Classifier.predict_matrix(
+        flat_trees, distributions, data_validation.classes,
+        data_training.global_class_distribution,
+        data_validation.feature_matrix())
+    prediction_seconds = time.perf_counter() - start
+    matrix = Evaluator.confusion_matrix(data_validation.label_vector(),
+                                        predictions,
+                                        len(data_validation.classes))
+    return {'confusion_matrix': matrix,
+            'training_instances': len(data_training.dataset),
+            'validation_instances': len(data_validation.dataset),
+            'training_seconds': training_seconds,
+            'prediction_seconds': prediction_seconds}
+
+
+# Instances and settings shared by the folds evaluated in a worker process
+__fold_worker_data = None
+__fold_worker_settings = None
+
+
+def __init_fold_worker(file_path, metadata, settings):
+    global __fold_worker_data, __fold_worker_settings
+    # The instances are memory-mapped: every worker shares the same pages
+    dataset, _ = Storage.load_dataset(file_path)
+    metadata.columnar = True
+    metadata.dataset = dataset
+    __fold_worker_data = metadata
+    __fold_worker_settings = settings
+
+
+def __evaluate_fold_in_worker(fold, training, validation, seed):
+    random.seed(seed)
+    data_training, data_validation = __fold_worker_data.apply_split(
+        {'training': training, 'validation': validation})
+    result = evaluate_fold(data_training, data_validation,
+                           *__fold_worker_settings)
+    result['fold'] = fold
+    return result
+
+
+'''
+Runs the cross validation of a classifier of classifier_type ('Single' or
+'Forest') over the instances of data with amount_folds folds (see
+draw_folds). training_options are the options of ID3.ID3.
+If processes is greater than 1, the folds are evaluated by that amount of
+worker processes, which memory-map the instances saved once to a temporary
+binary file and only receive the indices of their fold. Each fold gets its
+own random seed drawn from random, so the results do not depend on the
+scheduling of the workers.
+Returns the list of results of the folds (see evaluate_fold), in order.
+'''
+
+
+def cross_validate(data, classifier_type, amount_folds, processes=1,
+                   stratified=False, seed=None, **training_options):
+    if seed is None:
+        seed = random.getrandbits(32)
+    # Workers can not open their own pools of processes
+    training_options = dict(training_options, attribute_processes=1)
+    data = data.columnar_copy()
+    folds = draw_folds(data, amount_folds, stratified, seed)
+    tasks = []
+    for fold in range(amount_folds):
+        training = numpy.concatenate(
+            [folds[other] for other in range(amount_folds) if other != fold])
+        tasks.append((fold, training, folds[fold], random.getrandbits(32)))
+    if processes <= 1:
+        settings = (classifier_type, training_options)
+        results = []
+        for fold, training, validation, fold_seed in tasks:
+            random.seed(fold_seed)
+            data_training, data_validation = data.apply_split(
+                {'training': training, 'validation': validation})
+            result = evaluate_fold(data_training, data_validation, *settings)
+            result['fold'] = fold
+            results.append(result)
+        return results
+    settings = (classifier_type,
+                ID3.worker_options(training_options, processes))
+    directory = tempfile.mkdtemp()
+    try:
+        file_path = os.path.join(directory, 'instances' + Data.binary_extension)
+        data.save_data(file_path)
+        with multiprocessing.Pool(
+                processes, initializer=__init_fold_worker,
+                initargs=(file_path, data.copy(instances=False),
+                          settings)) as pool:
+            return pool.starmap(__evaluate_fold_in_worker, tasks)
+    finally:
+        shutil.rmtree(directory)
+
+
+def __mean_deviation(values):
+    mean = sum(values) / len(values)
+    deviation = math.sqrt(sum((value - mean)**2 for value in values) /
+                          len(values))
+    return mean, deviation
+
+
+'''
+Saves the report of a cross validation (the results of cross_validate) for
+a dataset with the given classes to file_path: the sizes, timings, accuracy
+and macro and micro F-Measure of each fold, their mean and standard
+deviation, and the metrics of the confusion matrix summed over all the
+folds (as in Evaluator.text_report). The same information, with all the
+metrics of each fold, is saved as json next to it (see
+Evaluator.save_metrics).
+'''
+
+
+def save_report(results, classes, file_path):
+    summaries = []
+    for result in results:
+        matrix = result['confusion_matrix']
+        metrics = Evaluator.compute_metrics(matrix, matrix.sum(axis=0))
+        summaries.append({
+            'fold': result['fold'],
+            'training_instances': result['training_instances'],
+            'validation_instances': result['validation_instances'],
+            'training_seconds': result['training_seconds'],
+            'prediction_seconds': result['prediction_seconds'],
+            'accuracy': int(numpy.trace(matrix)) / max(int(matrix.sum()), 1),
+            'confusion_matrix': matrix.tolist(),
+            'metrics': metrics
+        })
+    total_matrix = sum(result['confusion_matrix'] for result in results)
+    total_metrics = Evaluator.compute_metrics(total_matrix,
+                                              total_matrix.sum(axis=0))
+    columns = ['training_instances', 'validation_instances',
+               'training_seconds', 'prediction_seconds', 'accuracy']
+    aggregates = {}
+    for column in columns:
+        aggregates[column] = __mean_deviation(
+            [summary[column] for summary in summaries])
+    for average in ['macro', 'micro']:
+        aggregates[average + '_f_measure'] = __mean_deviation(
+            [summary['metrics'][average]['f_measure']
+             for summary in summaries])
+
+    spaces = 16
+    header = ['Fold', 'Training', 'Validation', 'Training s',
+              'Prediction s', 'Accuracy', 'Macro F', 'Micro F']
+    lines = ['Cross validation with {k} folds\n\n'.format(k=len(results)),
+             ''.join('%{s}s'.format(s=spaces) % name for name in header)
+             + '\n']
+    for summary in summaries:
+        values = [summary['fold'], summary['training_instances'],
+                  summary['validation_instances'],
+                  '%.4f' % summary['training_seconds'],
+                  '%.4f' % summary['prediction_seconds'],
+                  '%.4f' % summary['accuracy'],
+                  '%.4f' % summary['metrics']['macro']['f_measure'],
+                  '%.4f' % summary['metrics']['micro']['f_measure']]
+        lines.append(''.join('%{s}s'.format(s=spaces) % value
+                             for value in values) + '\n')
+    for name, index in [('Mean', 0), ('Std. deviation', 1)]:
+        values = [name] + ['%.4f' % aggregates[column][index] for column
+                           in columns + ['macro_f_measure',
+                                         'micro_f_measure']]
+        lines.append(''.join('%{s}s'.format(s=spaces) % value
+                             for value in values) + '\n')
+    lines.append('\nSummed over all the folds\n\n')
+    lines.append(Evaluator.text_report(total_matrix, total_metrics,
+                                       [str(c) for c in classes]))
+    with open(file_path, 'w') as output:
+        output.write(''.join(lines))
+    with open(os.path.splitext(file_path)[0] + '.json', 'w') as output:
+        json.dump({
+            'classes': [str(c) for c in classes],
+            'folds': summaries,
+            'mean': {name: aggregates[name][0] for name in aggregates},
+            'standard_deviation': {name: aggregates[name][1]
+                                   for name in aggregates},
+            'summed_confusion_matrix': total_matrix.tolist(),
+            'summed_metrics': total_metrics
+        }, output, indent=4)
@@ -5,12 +5,22 @@ This module's responsibility is to encapsule the parsed data as well as
 metadata from the given dataset.
 '''
 import ast
+import numpy
+import os
+import Parser
 import random
+import Storage
 import Utils
 import copy
 
 iris_processed_data = 'processed_data_iris.txt'
 covtype_processed_data = 'processed_data_covtype.txt'
+iris_binary_data = 'processed_data_iris.bin'
+covtype_binary_data = 'processed_data_covtype.bin'
+iris_raw_data = 'iris/iris.data'
+covtype_raw_data = 'covtype/covtype.data'
+# Extension of the instance files saved in the binary format of Storage
+binary_extension = '.bin'
 
 
 class Data:
@@ -23,9 +33,17 @@ class Data:
     with the corresponding types (list, str, int, float, etc...) and the
     numeric attributes where split in two ranges: 0 for those below or equal
     to some cutting point, and 1 for the rest.
+    columnar may be True or False. In the first case the instances are kept
+    in a Storage.ColumnarDataset (a 2-D array of attribute values and a
+    vector of class indices) instead of a list of lists.
+    The instances are read from the binary file of the dataset (see
+    Storage), which is rebuilt from the .data file when it is missing or
+    stale. If instances is False, only the metadata is initialized and the
+    dataset is left empty.
     '''
-    def __init__(self, data_name):
+    def __init__(self, data_name, columnar=False, instances=True):
         self.data_name = data_name
+        self.columnar = columnar
         # Indicates if all instances belong to the same class
         self.monoclass_instances = None
         if data_name == "iris":
@@ -42,13 +60,9 @@ class Data:
             self.global_class_distribution = {
                 'Iris-setosa': 1/3, 'Iris-versicolor': 1/3,
                 'Iris-virginica': 1/3}
-            with open(iris_processed_data, 'r') as instance_file:
-                instances_list = instance_file.readlines()
-                self.dataset = []
-                for line in instances_list:
-                    # Convert the list in the string to a list
-                    instance_as_list = ast.literal_eval(line)
-                    self.dataset.append(instance_as_list)
+            processed_data = iris_processed_data
+            binary_data = iris_binary_data
+            raw_data = iris_raw_data
         else:
             self.amount_attributes = 12
             self.attributes = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
@@ -69,13 +83,34 @@ class Data:
                 3: 2747/581012, 4: 9493/581012, 5: 17367/581012,
                 6: 20510/581012
             }
-            with open(covtype_processed_data, 'r') as instance_file:
-                instances_list = instance_file.readlines()
-                self.dataset = []
-                for line in instances_list:
-                    # Convert the list in the string to a list
-                    instance_as_list = ast.literal_eval(line)
-                    self.dataset.append(instance_as_list)
+            processed_data = covtype_processed_data
+            binary_data = covtype_binary_data
+            raw_data = covtype_raw_data
+        self.dataset = []
+        if instances:
+            self.__load_instances(processed_data, binary_data, raw_data)
+
+    '''
+    Loads the instances of the dataset into self.dataset. The binary file is
+    memory-mapped; it is first (re)built from the raw .data file if it is
+    missing or stale. If there is no usable binary file, the preprocessed
+    text file is read instead.
+    '''
+    def __load_instances(self, processed_data, binary_data, raw_data):
+        if update_binary_data(self.data_name, binary_data, raw_data,
+                              self.classes):
+            dataset, _ = Storage.load_dataset(binary_data)
+            self.dataset = dataset if self.columnar else list(dataset)
+            return
+        with open(processed_data, 'r') as instance_file:
+            instances_list = instance_file.readlines()
+            for line in instances_list:
+                # Convert the list in the string to a list
+                instance_as_list = ast.literal_eval(line)
+                self.dataset.append(instance_as_list)
+        if self.columnar:
+            self.dataset = Storage.ColumnarDataset.from_rows(
+                self.dataset, self.classes)
 
     '''
     Returns true iff the possible attribute values are 0 or 1.
@@ -90,6 +125,9 @@ class Data:
     attribute value.
     '''
     def split_attribute(self, attribute, cutting_value):
+        if self.columnar:
+            self.dataset.split_column(attribute, cutting_value)
+            return self
         for instance in self.dataset:
             if instance[attribute] <= cutting_value:
                 instance[attribute] = 0
@@ -98,18 +136,26 @@ class Data:
         return self
 
     '''
-    Find the best cutting value for an attribute from a random choice of 10
-    possible values from the dataset.
+    Find the best cutting value for an attribute.
+    If exact is True, every distinct value of the attribute is evaluated as
+    cutting point in a single sorted pass (see Utils.best_cutting_point) and
+    the best one is returned. Otherwise the best one from a random choice of
+    4 possible values from the dataset is returned.
 
     *** PRECONDITION ***: the attribute must be splitable
     '''
-    def best_cutting_value(self, attribute):
+    def best_cutting_value(self, attribute, exact=True):
+        if exact:
+            column, labels = self.attribute_arrays(attribute)
+            cutting_value, _ = Utils.best_cutting_point(
+                column, labels, len(self.classes))
+            return cutting_value
+
         best_cutting_value = None
         best_profit = None
 
         if len(self.dataset) > 4:
-            random_indices = random.sample(
-                list(range(len(self.dataset))), 4)
+            random_indices = random.sample(range(len(self.dataset)), 4)
         else:
             random_indices = list(range(len(self.dataset)))
 
@@ -127,17 +173,101 @@ class Data:
                 best_cutting_value = self.dataset[i][attribute]
         return best_cutting_value
     '''
-    Project the instances across attribute, returning a list with instances of
-    Data that doesn't share memory with the current instance.
-    The instances of each Data instance returned share the same value of the
+    Returns a 2-D numpy array with the attribute values of the instances
+    (one row per instance).
+    '''
+    def feature_matrix(self):
+        if self.columnar:
+            return self.dataset.feature_matrix()
+        return Storage.compact_features(
+            [instance[:-1] for instance in self.dataset]).reshape(
+                len(self.dataset), -1)
+
+    '''
+    Returns a numpy array with the position inside classes of the class of
+    each instance.
+    '''
+    def label_vector(self):
+        if self.columnar:
+            return self.dataset.label_vector()
+        class_index = {c: i for i, c in enumerate(self.classes)}
+        return numpy.fromiter(
+            (class_index[instance[-1]] for instance in self.dataset),
+            dtype=numpy.intp, count=len(self.dataset))
+
+    '''
+    Returns a tuple (column, labels) of numpy arrays with the values of the
+    attribute and the index of the class of each instance.
+    '''
+    def attribute_arrays(self, attribute):
+        if self.columnar:
+            return self.dataset.column(attribute), self.dataset.label_vector()
+        column = numpy.array([instance[attribute] for instance in self.dataset])
+        return column, self.label_vector()
+
+    '''
+    Builds amount_bins quantile buckets for each splitable attribute from
+    the current instances (see Storage.ColumnarDataset.build_bins), so that
+    histogram summarizes them by bucket.
+
+    *** PRECONDITION ***: the storage must be columnar
+    '''
+    def build_histogram_bins(self, amount_bins):
+        edges = {}
+        for attribute in self.attributes:
+            if self.splitable_attribute(attribute):
+                edges[attribute] = Utils.quantile_bin_edges(
+                    self.dataset.column(attribute), amount_bins)
+        self.dataset.build_bins(edges)
+
+    '''
+    Returns the contingency table of the attribute: an array with the
+    amount of instances of each class (columns) for each value of the
+    attribute, or for each quantile bucket if it has them (rows).
+    '''
+    def histogram(self, attribute):
+        labels = self.dataset.label_vector()
+        binned_column = self.dataset.binned_column(attribute)
+        if binned_column is not None:
+            codes, amount_buckets = binned_column
+            return Utils.contingency_table(codes, labels, amount_buckets,
+                                           len(self.classes))
+        values = self.attribute_values[attribute]
+        column = self.dataset.column(attribute)
+        if len(column) > 0:
+            column = Utils.value_codes(column, values)
+        return Utils.contingency_table(column, labels, len(values),
+                                       len(self.classes))
+
+    '''
+    Returns a copy of self whose instances are kept in a
+    Storage.ColumnarDataset (self if it is already columnar).
+    '''
+    def columnar_copy(self):
+        if self.columnar:
+            return self
+        data = self.copy(instances=False)
+        data.columnar = True
+        data.dataset = Storage.ColumnarDataset.from_rows(self.dataset,
+                                                         self.classes)
+        return data
+
+    '''
+    Project the instances across attribute, returning a dictionary
+    value -> instance of Data with the instances that have that value in the
     attribute.
+    The instances are not copied: in list mode the returned datasets hold
+    references to the same instance lists (so splitting an attribute of a
+    projection rewrites them; ID3 works on a copy of the caller's instances),
+    and in columnar mode they are index views of the same arrays. Only the
+    metadata is new memory.
     '''
     def project_attribute(self, attribute):
         # A dictionary value -> instances with that value in attribute
         projections_dict = {}
         for value in self.attribute_values[attribute]:
-            # Generate a copy of self
-            projected_data = self.copy()
+            # Generate a copy of the metadata of self
+            projected_data = self.copy(instances=False)
             # Adjust remaining attributes and amount of them
             projected_data.attributes.remove(attribute)
             projected_data.amount_attributes = self.amount_attributes - 1
@@ -147,7 +277,6 @@ class Data:
             for i in range(len(projected_data.class_distribution)):
                 projected_data.class_distribution[projected_data.classes[i]] = 0.0
 
-            projected_data.dataset = []
             # Add projected data to dictionary. It remains to filter the
             # instances and compute the class distributions for each new
             # instance of Data.
@@ -155,16 +284,27 @@ class Data:
 
         # Filter the instances and compute the class distributions
         # for each new instance of Data.
-        for instance in self.dataset:
-            # Check the value of the attribute
-            instance_attribute_value = instance[attribute]
-            projected_data = projections_dict[instance_attribute_value]
-            # Copy the instance to the corresponding sub dataset
-            projected_data.dataset.append(instance.copy())
-            # Update the class distributions (divide by total number of
-            # instances later)
-            instance_class = instance[-1]
-            projected_data.class_distribution[instance_class] += 1
+        if self.columnar:
+            partitions = self.dataset.partition(
+                attribute, self.attribute_values[attribute])
+            for value in projections_dict:
+                projected_data = projections_dict[value]
+                projected_data.dataset = partitions[value]
+                class_counts = projected_data.dataset.class_counts()
+                for i in range(len(self.classes)):
+                    projected_data.class_distribution[self.classes[i]] += (
+                        int(class_counts[i]))
+        else:
+            for instance in self.dataset:
+                # Check the value of the attribute
+                instance_attribute_value = instance[attribute]
+                projected_data = projections_dict[instance_attribute_value]
+                # Add the instance to the corresponding sub dataset
+                projected_data.dataset.append(instance)
+                # Update the class distributions (divide by total number of
+                # instances later)
+                instance_class = instance[-1]
+                projected_data.class_distribution[instance_class] += 1
 
         # Adjust the class distributions dividing by the number of instances
         for value in projections_dict:
@@ -194,68 +334,110 @@ class Data:
         return projections_dict
 
     '''
-    recalculates global and local distributions
-    taking current dataset
+    recalculates global and local distributions (the proportion of each
+    class) taking current dataset
     '''
     def recalculate_distributions(self):
         new_distribution = {}
         for c in self.classes:
             new_distribution[c] = 0
-        for instance in self.dataset:
-            new_distribution[instance[-1]] += 1
-        for value in new_distribution.values():
-            value /= len(self.dataset)
+        if self.columnar:
+            class_counts = self.dataset.class_counts()
+            for i in range(len(self.classes)):
+                new_distribution[self.classes[i]] = int(class_counts[i])
+        else:
+            for instance in self.dataset:
+                new_distribution[instance[-1]] += 1
+        # Proportions of the classes (all 0 if there are no instances)
+        amount_instances = max(len(self.dataset), 1)
+        for c in new_distribution:
+            new_distribution[c] /= amount_instances
         self.global_class_distribution = new_distribution
-        self.class_distribution = new_distribution
+        self.class_distribution = new_distribution.copy()
 
     '''
     creates both validation and training sets from data
     percentage takes values from 0 and 1
+    If stratified is True each class is split separately. The split is drawn
+    from seed (see draw_split and apply_split).
     '''
-    def divide_corpus(self, percetnage_training):
-        validation_set = self.dataset.copy()
-        training_set = []
-        partition_length = round(len(self.dataset) * percetnage_training)
-        for i in range(0, partition_length):
-            data_index = random.randint(0, len(validation_set)-1)
-            training_set.append(validation_set[data_index])
-            # data thats on training set cant be on validation set
-            del validation_set[data_index]
-
-        data_training = Data("iris")
-        data_training.dataset = training_set
-        data_training.data_name = self.data_name
-        data_training.amount_attributes = self.amount_attributes
-        data_training.attributes = self.attributes.copy()
-        data_training.attribute_values = self.attribute_values.copy()
-        data_training.amount_classes = self.amount_classes
-        data_training.classes = self.classes.copy()
-        data_training.class_distribution = self.class_distribution.copy()
-        data_training.global_class_distribution = self.global_class_distribution.copy()
-
-        data_validation = Data("iris")
-        data_validation.dataset = validation_set
-        data_validation.data_name = self.data_name
-        data_validation.amount_attributes = self.amount_attributes
-        data_validation.attributes = self.attributes.copy()
-        data_validation.attribute_values = self.attribute_values.copy()
-        data_validation.amount_classes = self.amount_classes
-        data_validation.classes = self.classes.copy()
-        data_validation.class_distribution = self.class_distribution.copy()
-        data_validation.global_class_distribution = self.global_class_distribution.copy()
+    def divide_corpus(self, percentage_training, stratified=False, seed=None):
+        split = self.draw_split(percentage_training, stratified, seed)
+        return self.apply_split(split)
+
+    '''
+    Draws the split used by divide_corpus with a single random permutation
+    of the instances (one per class if stratified, so that the proportion of
+    each class is the same in both sets). seed is the seed of the
+    permutation; if None, it is drawn from random.
+    Returns a dictionary with the seed, stratified, percentage_training and
+    the index arrays 'training' and 'validation' of the instances.
+    '''
+    def draw_split(self, percentage_training, stratified=False, seed=None):
+        if seed is None:
+            seed = random.getrandbits(32)
+        generator = numpy.random.default_rng(seed)
+        if stratified:
+            labels = self.label_vector()
+            training, validation = [], []
+            for position in range(len(self.classes)):
+                members = generator.permutation(
+                    numpy.flatnonzero(labels == position))
+                partition_length = round(len(members) * percentage_training)
+                training.append(members[:partition_length])
+                validation.append(members[partition_length:])
+            # Shuffle the classes together
+            training = generator.permutation(numpy.concatenate(training))
+            validation = generator.permutation(numpy.concatenate(validation))
+        else:
+            permutation = generator.permutation(len(self.dataset))
+            partition_length = round(len(self.dataset) * percentage_training)
+            training = permutation[:partition_length]
+            validation = permutation[partition_length:]
+        return {'seed': seed, 'stratified': stratified,
+                'percentage_training': percentage_training,
+                'training': training, 'validation': validation}
+
+    '''
+    Returns a tuple (data_training, data_validation) with the instances of
+    the split (see draw_split). In columnar mode both are index views of the
+    instances of self; in list mode they hold references to the same
+    instance lists.
+    '''
+    def apply_split(self, split):
+        subsets = []
+        for indices in [split['training'], split['validation']]:
+            subset = self.copy(instances=False)
+            if self.columnar:
+                subset.dataset = self.dataset.take(indices)
+            else:
+                subset.dataset = [self.dataset[i] for i in indices.tolist()]
+            subsets.append(subset)
+        data_training, data_validation = subsets
         return data_training, data_validation
 
     def apply_breakpoints(self, breakpoints):
         for attribute in breakpoints.keys():
+            if self.columnar:
+                self.dataset.split_column(attribute, breakpoints[attribute])
+                continue
             for data in self.dataset:
                 if data[attribute] <= breakpoints[attribute]:
                     data[attribute] = 0
                 else:
                     data[attribute] = 1
 
-    def copy(self):
-        data = Data('iris')     # Optimization
-        data.dataset = copy.deepcopy(self.dataset)
+    '''
+    Returns a copy of self that doesn't share memory with it (in columnar
+    mode, a view that never writes to the shared arrays). If instances is
+    False, only the metadata is copied and the dataset is left empty.
+    '''
+    def copy(self, instances=True):
+        data = Data(self.data_name, self.columnar, instances=False)
+        if instances and self.columnar:
+            data.dataset = self.dataset.copy()
+        elif instances:
+            data.dataset = copy.deepcopy(self.dataset)
         data.data_name = self.data_name
         data.amount_attributes = self.amount_attributes
         data.attributes = self.attributes.copy()
@@ -267,26 +449,179 @@ class Data:
         return data
 
     '''
-    Saves the instances to the given file_path.
+    Saves the instances to the given file_path. If file_path ends with
+    binary_extension the binary format of Storage is used; otherwise the
+    instances are written as text, one per line.
     '''
     def save_data(self, file_path):
+        if file_path.endswith(binary_extension):
+            dataset = self.dataset
+            if not self.columnar:
+                dataset = Storage.ColumnarDataset.from_rows(
+                    self.dataset, self.classes)
+            Storage.save_dataset(dataset, file_path, self.data_name)
+            return
         with open(file_path, 'w') as save_file:
             for instance in self.dataset:
                 save_file.write(str(instance) + '\n')
 
 
 '''
-Loads the instances from the given file_path of the corresponding dataset.
+Loads the instances from the given file_path of the corresponding dataset,
+either in the binary format of Storage or as text (as written by
+Data.save_data). If columnar is True, the instances are kept in a
+Storage.ColumnarDataset.
 Returns an instance of Data.
 '''
 
 
-def load_data(dataset_name, file_path):
-    data = Data(dataset_name)
-    data.dataset = []
+def load_data(dataset_name, file_path, columnar=False):
+    data = Data(dataset_name, columnar, instances=False)
+    if Storage.read_header(file_path) is not None:
+        dataset, _ = Storage.load_dataset(file_path)
+        data.dataset = dataset if columnar else list(dataset)
+        data.recalculate_distributions()
+        return data
     with open(file_path, 'r') as instances_file:
         instances_lines = instances_file.readlines()
         for instance_line in instances_lines:
             data.dataset.append(ast.literal_eval(instance_line))
+    if columnar:
+        data.dataset = Storage.ColumnarDataset.from_rows(
+            data.dataset, data.classes)
     data.recalculate_distributions()
     return data
+
+
+'''
+(Re)builds the binary file binary_data of the dataset data_name from its
+raw .data file raw_data when it is missing or stale. classes is the list of
+class labels of the dataset.
+Returns True iff binary_data is up to date afterwards.
+'''
+
+
+def update_binary_data(data_name, binary_data, raw_data, classes):
+    stale = Storage.is_stale(binary_data, raw_data, data_name)
+    if stale and os.path.isfile(raw_data):
+        Parser.build_binary_data(data_name, raw_data, binary_data, classes)
+        stale = False
+    return not stale
+
+
+'''
+Makes sure the binary file of the dataset dataset_name is up to date,
+without reading its instances (see update_binary_data).
+Returns the path of the binary file, or None if there is no usable binary
+file nor raw file to build it from.
+'''
+
+
+def binary_data(dataset_name):
+    data = Data(dataset_name, instances=False)
+    if dataset_name == 'iris':
+        binary_path, raw_path = iris_binary_data, iris_raw_data
+    else:
+        binary_path, raw_path = covtype_binary_data, covtype_raw_data
+    if update_binary_data(dataset_name, binary_path, raw_path, data.classes):
+        return binary_path
+    return None
+
+
+'''
+Reads the instances from the given file_path of the corresponding dataset
+(in any of the formats of load_data) in blocks of chunk_rows instances, so
+the memory used does not depend on the size of the file.
+Yields tuples (features, labels): a 2-D array with the attributes of the
+instances of the block and an integer vector with the position inside the
+classes of the dataset of their classes.
+'''
+
+
+def read_chunks(dataset_name, file_path, chunk_rows):
+    if Storage.read_header(file_path) is not None:
+        yield from Storage.read_chunks(file_path, chunk_rows)
+        return
+    classes = Data(dataset_name, instances=False).classes
+    class_index = {c: i for i, c in enumerate(classes)}
+    with open(file_path, 'r') as instances_file:
+        rows = []
+        for instance_line in instances_file:
+            rows.append(ast.literal_eval(instance_line))
+            if len(rows) == chunk_rows:
+                yield __rows_chunk(rows, class_index)
+                rows = []
+        if rows:
+            yield __rows_chunk(rows, class_index)
+
+
+def __rows_chunk(rows, class_index):
+    features = Storage.compact_features(
+        [row[:-1] for row in rows]).reshape(len(rows), -1)
+    labels = numpy.array([class_index[row[-1]] for row in rows],
+                         dtype=numpy.int64)
+    return features, labels
+
+
+'''
+Out of core version of Data.divide_corpus for the binary dataset file in
+file_path: each instance goes to training with probability
+percentage_training, and the instances of each set are written, block by
+block of chunk_rows instances, to training_path and validation_path in the
+binary format. The draws of each block come from its own generator seeded
+with (seed, block), so the file is read twice (to count and to write each
+set) without keeping the split in memory.
+Returns a tuple with the amount of training and validation instances.
+'''
+
+
+def split_chunks(file_path, percentage_training, seed, chunk_rows,
+                 training_path, validation_path):
+    header = Storage.read_header(file_path)
+    if header is None:
+        raise ValueError('Data.split_chunks: {file} is not a binary dataset '
+                         'file'.format(file=file_path))
+
+    def training_masks():
+        for block, (features, labels) in enumerate(
+                Storage.read_chunks(file_path, chunk_rows)):
+            generator = numpy.random.default_rng([seed, block])
+            yield (features, labels,
+                   generator.random(len(labels)) < percentage_training)
+
+    amount_training = sum(int(numpy.count_nonzero(mask))
+                          for _, _, mask in training_masks())
+    amount_validation = header['rows'] - amount_training
+    Storage.save_dataset_chunks(
+        ((features[mask], labels[mask])
+         for features, labels, mask in training_masks()),
+        training_path, amount_training, header)
+    Storage.save_dataset_chunks(
+        ((features[~mask], labels[~mask])
+         for features, labels, mask in training_masks()),
+        validation_path, amount_validation, header)
+    return amount_training, amount_validation
+
+
+'''
+Saves a split drawn by Data.draw_split to file_path (a numpy .npz file), so
+that it can be reproduced with load_split and Data.apply_split without
+saving the instances of both sets.
+'''
+
+
+def save_split(split, file_path):
+    numpy.savez(file_path, seed=split['seed'],
+                stratified=split['stratified'],
+                percentage_training=split['percentage_training'],
+                training=split['training'], validation=split['validation'])
+
+
+def load_split(file_path):
+    with numpy.load(file_path) as split_file:
+        return {'seed': int(split_file['seed']),
+                'stratified': bool(split_file['stratified']),
+                'percentage_training': float(
+                    split_file['percentage_training']),
+                'training': split_file['training'],
+                'validation': split_file['validation']}
@@ -6,14 +6,203 @@ over a given preprocessed data set.
 '''
 
 import Classifier
+import csv
 import Data
+import json
+import numpy
+import os
+
+# Names of the metrics computed for each class (see compute_metrics)
+count_metrics = ['true_positives', 'false_positives', 'false_negatives',
+                 'true_negatives']
+rate_metrics = ['precision', 'recall', 'fall_out', 'f_measure']
+
+
+'''
+Returns an integer vector with the position inside classes of each label in
+labels (compared as strings).
+'''
+
+
+def class_positions(labels, classes):
+    class_index = {str(c): i for i, c in enumerate(classes)}
+    return numpy.fromiter((class_index[str(label)] for label in labels),
+                          dtype=numpy.int64, count=len(labels))
+
+
+'''
+Computes the confusion matrix of the classification in a single pass:
+matrix[i][j] is the number of instances of class j classified as class i,
+given the positions of the true and classified classes of each instance
+(integer vectors).
+'''
+
+
+def confusion_matrix(true_positions, classified_positions, amount_classes):
+    cells = (numpy.asarray(classified_positions, dtype=numpy.int64) *
+             amount_classes + numpy.asarray(true_positions, dtype=numpy.int64))
+    return numpy.bincount(cells, minlength=amount_classes**2).reshape(
+        amount_classes, amount_classes)
+
+
+'''
+Derives the metrics of all the classes at once from a confusion matrix (see
+confusion_matrix). amount_instances[i] is the number of instances of class
+i, used to weight the micro measures, which are divided by instances_number
+(by default, the sum of amount_instances).
+Returns a dictionary metric name -> list with the value for each class (see
+count_metrics and rate_metrics), plus 'macro' and 'micro', dictionaries
+rate metric name -> value.
+'''
+
+
+def compute_metrics(matrix, amount_instances, instances_number=None):
+    matrix = numpy.asarray(matrix, dtype=numpy.int64)
+    true_positives = numpy.diag(matrix)
+    false_positives = matrix.sum(axis=1) - true_positives
+    false_negatives = matrix.sum(axis=0) - true_positives
+    true_negatives = (matrix.sum() - true_positives - false_positives -
+                      false_negatives)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        precision = numpy.where(
+            true_positives == 0, 0.0,
+            true_positives / (true_positives + false_positives))
+        recall = numpy.where(
+            true_positives == 0, 0.0,
+            true_positives / (true_positives + false_negatives))
+        fall_out = numpy.where(
+            false_positives == 0, 0.0,
+            false_positives / (false_positives + true_negatives))
+        f_measure = numpy.where(
+            (precision == 0) | (recall == 0), 0.0,
+            1 / ((0.5 / precision) + (0.5 / recall)))
+    metrics = {
+        'true_positives': true_positives.tolist(),
+        'false_positives': false_positives.tolist(),
+        'false_negatives': false_negatives.tolist(),
+        'true_negatives': true_negatives.tolist(),
+        'precision': precision.tolist(),
+        'recall': recall.tolist(),
+        'fall_out': fall_out.tolist(),
+        'f_measure': f_measure.tolist()
+    }
+    amount_instances = [int(amount) for amount in amount_instances]
+    if instances_number is None:
+        instances_number = sum(amount_instances)
+    metrics['macro'] = {}
+    metrics['micro'] = {}
+    # The sums run in the order of the classes, so the results do not
+    # depend on how numpy would group them
+    for name in rate_metrics:
+        metrics['macro'][name] = sum(metrics[name]) / len(matrix)
+        metrics['micro'][name] = sum(
+            amount * value for amount, value
+            in zip(amount_instances, metrics[name])) / instances_number
+    return metrics
+
+
+'''
+Returns the text report of the metrics of the classes (see compute_metrics)
+with the confusion matrix, as a single string.
+'''
+
+
+def text_report(matrix, metrics, classes):
+    spaces = 16
+    cell = '%{spaces}s'.format(spaces=spaces)
+    number = '%{spaces}d'.format(spaces=spaces)
+    lines = ['Confusion Matrix\n', ' '*(spaces + 4) + 'Actual class\n',
+             ' '*spaces + ''.join(cell % c for c in classes) + '\n']
+    for i in range(len(classes)):
+        lines.append(cell % classes[i] +
+                     ''.join(number % count for count in matrix[i]) + '\n')
+    lines.append('\n')
+    for i in range(len(classes)):
+        lines.append(''.join(number % count for count in matrix[i]) + '\n')
+    lines.append('\n')
+    lines.append('Metrics for a given class\nTrue Positives\n'
+                 'False Positives\nFalse Negatives\nTrue Negatives\n'
+                 'Precision\nRecall\nFall-out\nF-Measure\n\n')
+    for i in range(len(classes)):
+        lines.append('Metrics for class {c} classification\n'.format(
+            c=classes[i]))
+        for name in count_metrics + rate_metrics:
+            value = metrics[name][i]
+            # An undefined F-Measure has always been reported as 0
+            if name == 'f_measure' and value == 0:
+                value = 0
+            lines.append('{val}\n'.format(val=value))
+        lines.append('\n\n')
+    for average in ['macro', 'micro']:
+        lines.append('{a} measures\nPrecision\nRecall\nFall-out\n'
+                     'F-Measure\n'.format(a=average.capitalize()))
+        for name in rate_metrics:
+            lines.append('{val}\n'.format(val=metrics[average][name]))
+        lines.append('\n\n' if average == 'macro' else '\n')
+    return ''.join(lines)
+
+
+'''
+Saves the confusion matrix and the metrics (see compute_metrics) to
+file_path as a text report, and next to it (replacing the extension of
+file_path) as json and csv files.
+'''
+
+
+def save_metrics(matrix, metrics, classes, file_path):
+    with open(file_path, 'w') as output:
+        output.write(text_report(matrix, metrics, classes))
+    base_path = os.path.splitext(file_path)[0]
+    classes = [str(c) for c in classes]
+    with open(base_path + '.json', 'w') as output:
+        json.dump({
+            'classes': classes,
+            'confusion_matrix': numpy.asarray(matrix).tolist(),
+            'classes_metrics': {
+                classes[i]: {name: metrics[name][i]
+                             for name in count_metrics + rate_metrics}
+                for i in range(len(classes))},
+            'macro': metrics['macro'],
+            'micro': metrics['micro']
+        }, output, indent=4)
+    with open(base_path + '.csv', 'w', newline='') as output:
+        writer = csv.writer(output)
+        writer.writerow(['class'] + count_metrics + rate_metrics)
+        for i in range(len(classes)):
+            writer.writerow([classes[i]] + [metrics[name][i] for name
+                                            in count_metrics + rate_metrics])
+        for average in ['macro', 'micro']:
+            writer.writerow([average] + ['']*len(count_metrics) +
+                            [metrics[average][name] for name in rate_metrics])
+
+
+'''
+Evaluates a classifier over instances read in blocks, keeping only the
+running confusion matrix, so the memory used is bounded by the size of a
+block. chunks yields tuples (features, labels) as Data.read_chunks and
+predict receives the features of a block and returns the position inside
+classes of the class predicted for each instance.
+Saves the metrics to file_path (see save_metrics) and returns the confusion
+matrix.
+'''
+
+
+def evaluate_chunks(chunks, predict, classes, file_path):
+    matrix = numpy.zeros((len(classes), len(classes)), dtype=numpy.int64)
+    for features, labels in chunks:
+        matrix += confusion_matrix(labels, predict(features), len(classes))
+    # The instances of each class are the columns of the matrix
+    metrics = compute_metrics(matrix, matrix.sum(axis=0))
+    save_metrics(matrix, metrics, classes, file_path)
+    return matrix
 
 
 '''
 This function evaluates a given classifier's metrics: true positives,
 true negatives, false positives, false negatives, precision, recall, fall-out
 and F-measure.
-It saves the metrics and the confusion matrix to a given file's path.
+It saves the metrics and the confusion matrix to a given file's path (see
+save_metrics).
 - 'classification' is a list of tuples (true_class, classified_class).
 - 'classes' is a list with all the possible class labels.
 - 'instances' is a list of instances (a list of lists) corresponding to the
@@ -26,173 +215,32 @@ verification instances.
 def evaluate_classificator(classification, classes,
                            instances, instances_number,
                            file_path):
-    '''
-    Dictionary of dictionaries: confusion_matrix[class] has a dictionary
-    with the instance number of each class.
-    confusion_matrix[class_i][class_j] is the number of instances from
-    class_i classified as class_j.
-    '''
-    confusion_matrix = {}
-    # Initialize confusion_matrix
-    for c1 in classes:
-        confusion_matrix[c1] = {}
-        for c2 in classes:
-            confusion_matrix[c1][c2] = 0
-
+    true_positions = class_positions(
+        [true_class for true_class, _ in classification], classes)
+    classified_positions = class_positions(
+        [classified_class for _, classified_class in classification],
+        classes)
+    matrix = confusion_matrix(true_positions, classified_positions,
+                              len(classes))
     # Amount of examples of each class
-    amount_instances = {}
-    for c in classes:
-        amount_instances[c] = 0
-
-    for instance in instances:
-        amount_instances[str(instance[-1])] += 1
-
-    for true_class, classified_class in classification:
-        confusion_matrix[str(classified_class)][str(true_class)] += 1
-
-    precision_macro, recall_macro, fall_out_macro, f_measure_macro = 0, 0, 0, 0
-    precision_micro, recall_micro, fall_out_micro, f_measure_micro = 0, 0, 0, 0
-    with open(file_path, 'w') as output:
-        spaces = 16
-        output.write('Confusion Matrix\n')
-        output.write(' '*(spaces + 4) + 'Actual class\n')
-        output.write(' '*spaces)
-        for c in classes:
-            output.write('%{spaces}s'.format(spaces=spaces) % c)
-        output.write('\n')
-        for c1 in classes:
-            output.write('%{spaces}s'.format(spaces=spaces) % c1)
-            for c2 in classes:
-                output.write('%{spaces}d'.format(
-                    spaces=spaces) % confusion_matrix[c1][c2])
-            output.write('\n')
-
-        output.write('\n')
-        for c1 in classes:
-            for c2 in classes:
-                output.write('%{spaces}d'.format(
-                    spaces=spaces) % confusion_matrix[c1][c2])
-            output.write('\n')
-
-        output.write('\n')
-
-        output.write('Metrics for a given class\n')
-        output.write('True Positives\n')
-        output.write('False Positives\n')
-        output.write('False Negatives\n')
-        output.write('True Negatives\n')
-        output.write('Precision\n')
-        output.write('Recall\n')
-        output.write('Fall-out\n')
-        output.write('F-Measure\n')
-
-        output.write('\n')
-        for c in classes:
-            output.write('Metrics for class {c} classification\n'.format(c=c))
-
-            true_positives = confusion_matrix[c][c]
-            output.write('{val}\n'.format(val=true_positives))
-
-            false_positives, false_negatives = 0, 0
-            for c2 in classes:
-                if c != c2:
-                    false_positives += confusion_matrix[c][c2]
-                    false_negatives += confusion_matrix[c2][c]
-            output.write('{val}\n'.format(
-                val=false_positives))
-            output.write('{val}\n'.format(
-                val=false_negatives))
-
-            true_negatives = 0
-            for c1 in classes:
-                for c2 in classes:
-                    if c1 != c and c2 != c:
-                        true_negatives += confusion_matrix[c1][c2]
-            output.write('{val}\n'.format(val=true_negatives))
-
-            if true_positives == 0:
-                precision = 0.0
-            else:
-                precision = true_positives/(true_positives+false_positives)
-            output.write('{val}\n'.format(val=precision))
-
-            if true_positives == 0:
-                recall = 0.0
-            else:
-                recall = true_positives/(true_positives+false_negatives)
-            output.write('{val}\n'.format(val=recall))
-
-            if false_positives == 0:
-                fall_out = 0.0
-            else:
-                fall_out = false_positives/(false_positives+true_negatives)
-            output.write('{val}\n'.format(val=fall_out))
-
-            if precision == 0 or recall == 0:
-                f_measure = 0
-            else:
-                f_measure = 1/((0.5/precision) + (0.5/recall))
-            output.write('{val}\n'.format(val=f_measure))
-
-            precision_macro += precision
-            recall_macro += recall
-            fall_out_macro += fall_out
-            f_measure_macro += f_measure
-
-            precision_micro += amount_instances[c]*precision
-            recall_micro += amount_instances[c]*recall
-            fall_out_micro += amount_instances[c]*fall_out
-            f_measure_micro += amount_instances[c]*f_measure
-
-            output.write('\n\n')
-
-        class_number = len(classes)
-
-        precision_macro /= class_number
-        recall_macro /= class_number
-        fall_out_macro /= class_number
-        f_measure_macro /= class_number
-
-        precision_micro /= instances_number
-        recall_micro /= instances_number
-        fall_out_micro /= instances_number
-        f_measure_micro /= instances_number
-
-        output.write('Macro measures\n')
-        output.write('Precision\n')
-        output.write('Recall\n')
-        output.write('Fall-out\n')
-        output.write('F-Measure\n')
-        output.write('{val}\n'.format(val=precision_macro))
-        output.write('{val}\n'.format(val=recall_macro))
-        output.write('{val}\n'.format(val=fall_out_macro))
-        output.write('{val}\n'.format(val=f_measure_macro))
-
-        output.write('\n\n')
-
-        output.write('Micro measures\n')
-        output.write('Precision\n')
-        output.write('Recall\n')
-        output.write('Fall-out\n')
-        output.write('F-Measure\n')
-        output.write('{val}\n'.format(val=precision_micro))
-        output.write('{val}\n'.format(val=recall_micro))
-        output.write('{val}\n'.format(val=fall_out_micro))
-        output.write('{val}\n'.format(val=f_measure_micro))
-
-        output.write('\n')
+    if hasattr(instances, 'class_counts'):
+        amount_instances = instances.class_counts()
+    else:
+        amount_instances = numpy.bincount(
+            class_positions([instance[-1] for instance in instances],
+                            classes), minlength=len(classes))
+    metrics = compute_metrics(matrix, amount_instances, instances_number)
+    save_metrics(matrix, metrics, classes, file_path)
 
 
 if __name__ == '__main__':
     data = Data.Data('iris')
     (data_training, data_validation) = data.divide_corpus(0.8)
     classifier = Classifier.generate_forest_classifier(data_training)
-    modified_data_validations = []
-    for elem in classifier:
-        new_validation_data = data_validation.copy()
-        new_validation_data.apply_breakpoints(elem[1])
-        modified_data_validations.append(new_validation_data)
-    classification = Classifier.classify_dataset_multi_label(classifier, modified_data_validations)
+    flat_trees = Classifier.raw_flat_trees([elem[0] for elem in classifier],
+                                           [elem[1] for elem in classifier])
+    classification = Classifier.classify_dataset(
+        flat_trees, [elem[2] for elem in classifier], data_validation)
     evaluate_classificator(classification, data_validation.classes,
                            data_validation.dataset,
                            len(data_validation.dataset), 'Evaluator.out')
\ No newline at end of file
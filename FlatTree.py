@@ -0,0 +1,285 @@
+'''
+Flat tree module
+
+This module's responsibility is to compile a decision tree generated by ID3
+(a treelib tree, either trained or loaded with ID3.load_tree) into flat
+arrays, so that classifying an instance only takes integer indexing instead
+of building node identifiers and parsing node tags.
+It also saves and loads classifiers (one or more compiled trees) in a
+versioned binary model file whose arrays are memory-mapped when loaded.
+'''
+import numpy
+import re
+import Storage
+
+# Binary model files start with model_magic and a format version
+model_magic = b'AA19MODL'
+model_version = 1
+
+
+class FlatTree:
+    '''
+    The nodes are numbered in breadth-first order (the root is node 0).
+    - 'feature[n]' is the attribute checked by node n, or -1 if n is a leaf.
+    - 'child_offset[n]' and 'child_count[n]': the child of node n for the
+    attribute value v is children[child_offset[n] + v], for v between 0 and
+    child_count[n] - 1 (-1 if there is no child for that value).
+    - 'leaf_class[n]' is the position in labels of the class of leaf n
+    (-1 for internal nodes) and 'leaf_count[n]' its amount of instances.
+    - 'labels' is the list of class labels as they appear in the leaf tags.
+    - 'threshold[n]' is the cutting value used by node n to split its
+    continuous attribute (NaN if the attribute of n is not cut at n). Trees
+    with thresholds route raw instances: the value of the attribute of node n
+    is replaced by 0 if it is less than or equal to threshold[n] and by 1
+    otherwise, so the breakpoints must not be applied to the instances.
+    '''
+    def __init__(self, feature, child_offset, child_count, children,
+                 leaf_class, leaf_count, labels, threshold=None):
+        self.feature = feature
+        self.child_offset = child_offset
+        self.child_count = child_count
+        self.children = children
+        self.leaf_class = leaf_class
+        self.leaf_count = leaf_count
+        self.labels = labels
+        if threshold is None:
+            threshold = numpy.full(len(feature), numpy.nan)
+        self.threshold = threshold
+        self.has_thresholds = bool((~numpy.isnan(threshold)).any())
+        # Python lists are faster than numpy arrays for scalar indexing. They
+        # are built on the first scalar access, so loading a model does not
+        # read every node.
+        self.__lists = None
+
+    '''
+    Compiles the treelib tree generated by ID3 into a FlatTree.
+    If thresholds is True, the cutting values recorded by ID3 in the data of
+    the internal nodes are kept (see threshold); trees loaded from their
+    json files do not have them.
+    '''
+    @staticmethod
+    def compile(tree, thresholds=False):
+        nodes = [tree.get_node(tree.root)]
+        feature, child_offset, child_count, children = [], [], [], []
+        leaf_class, leaf_count, labels = [], [], []
+        threshold = []
+        label_index = {}
+        position = 0
+        while position < len(nodes):
+            node = nodes[position]
+            position += 1
+            if 'Class' in node.tag:
+                label = re.findall(r'Class ([^,]+)', node.tag)[0]
+                if label not in label_index:
+                    label_index[label] = len(labels)
+                    labels.append(label)
+                feature.append(-1)
+                threshold.append(numpy.nan)
+                child_offset.append(len(children))
+                child_count.append(0)
+                leaf_class.append(label_index[label])
+                leaf_count.append(
+                    int(re.findall(r'Instances (\d+)', node.tag)[0]))
+                continue
+            feature.append(int(re.findall(r'\d+', node.tag)[0]))
+            cutting_value = None
+            if thresholds and isinstance(node.data, dict):
+                cutting_value = node.data.get('cutting_value')
+            threshold.append(numpy.nan if cutting_value is None
+                             else float(cutting_value))
+            leaf_class.append(-1)
+            leaf_count.append(0)
+            # The identifier of a child ends with 'Attribute a = value,'
+            node_children = {}
+            for child in tree.children(node.identifier):
+                value = child.identifier[:-1].rsplit(' = ', 1)[1]
+                node_children[int(value)] = child
+            amount_values = max(node_children) + 1 if node_children else 0
+            child_offset.append(len(children))
+            child_count.append(amount_values)
+            for value in range(amount_values):
+                if value in node_children:
+                    children.append(len(nodes))
+                    nodes.append(node_children[value])
+                else:
+                    children.append(-1)
+        return FlatTree(numpy.array(feature, dtype=numpy.int32),
+                        numpy.array(child_offset, dtype=numpy.int32),
+                        numpy.array(child_count, dtype=numpy.int32),
+                        numpy.array(children, dtype=numpy.int32),
+                        numpy.array(leaf_class, dtype=numpy.int32),
+                        numpy.array(leaf_count, dtype=numpy.int64), labels,
+                        numpy.array(threshold, dtype=numpy.float64))
+
+    '''
+    Returns the leaf reached by the instance (a list of attribute values,
+    already discretized), or -1 if the path of the instance leaves the tree
+    (an attribute value without a child).
+    '''
+    def leaf(self, instance):
+        if self.__lists is None:
+            self.__lists = (self.feature.tolist(), self.child_offset.tolist(),
+                            self.child_count.tolist(), self.children.tolist(),
+                            self.threshold.tolist())
+        feature, child_offset, child_count, children, threshold = self.__lists
+        node = 0
+        while feature[node] >= 0:
+            value = instance[feature[node]]
+            # NaN is the only value different from itself
+            if threshold[node] == threshold[node]:
+                value = 0 if value <= threshold[node] else 1
+            if (not 0 <= value < child_count[node] or
+                    value != int(value)):
+                return -1
+            node = children[child_offset[node] + int(value)]
+            if node < 0:
+                return -1
+        return node
+
+    '''
+    Batch version of leaf: routes all the rows of matrix (a 2-D array of
+    discretized attribute values, one row per instance) through the tree
+    level by level, using array masks.
+    Returns an array with the leaf reached by each row (-1 if its path
+    leaves the tree).
+    '''
+    def leaves(self, matrix):
+        matrix = numpy.asarray(matrix)
+        node = numpy.zeros(matrix.shape[0], dtype=numpy.int32)
+        # Rows that are still on an internal node
+        active = numpy.arange(matrix.shape[0])
+        while active.size > 0:
+            feature = self.feature[node[active]]
+            internal = feature >= 0
+            active, feature = active[internal], feature[internal]
+            if active.size == 0:
+                break
+            parent = node[active]
+            values = matrix[active, feature]
+            if self.has_thresholds:
+                cut = self.threshold[parent]
+                has_cut = ~numpy.isnan(cut)
+                values = numpy.where(has_cut, values > cut, values)
+            valid = (values >= 0) & (values < self.child_count[parent])
+            if not numpy.issubdtype(values.dtype, numpy.integer):
+                valid &= values == numpy.floor(values)
+            child = numpy.full(active.size, -1, dtype=numpy.int32)
+            child[valid] = self.children[self.child_offset[parent[valid]] +
+                                         values[valid].astype(numpy.int64)]
+            node[active] = child
+            active = active[child >= 0]
+        return node
+
+    '''
+    Batch prediction: returns an integer vector with the position inside
+    classes of the class predicted for each row of matrix (see leaves), or
+    -1 for the rows whose path leaves the tree.
+    '''
+    def predict(self, matrix, classes):
+        class_index = {str(c): i for i, c in enumerate(classes)}
+        leaf_codes = numpy.array(
+            [class_index[label] for label in self.labels] + [-1],
+            dtype=numpy.int32)
+        leaves = self.leaves(matrix)
+        leaf_class = self.leaf_class[leaves]
+        # leaf_class[-1] must not be used for rows without a leaf
+        leaf_class[leaves < 0] = len(self.labels)
+        return leaf_codes[leaf_class]
+
+    '''
+    Returns a FlatTree that routes raw instances (see threshold): the nodes
+    without a threshold whose attribute has a breakpoint (a dictionary
+    attribute -> cutting value, as returned by ID3.ID3) take it as their
+    threshold. The arrays other than threshold are shared with self.
+    '''
+    def with_breakpoints(self, breakpoints):
+        threshold = numpy.array(self.threshold, dtype=numpy.float64)
+        for attribute in breakpoints:
+            nodes = (self.feature == attribute) & numpy.isnan(threshold)
+            threshold[nodes] = breakpoints[attribute]
+        return FlatTree(self.feature, self.child_offset, self.child_count,
+                        self.children, self.leaf_class, self.leaf_count,
+                        self.labels, threshold)
+
+    def __len__(self):
+        return len(self.feature)
+
+
+'''
+Saves a classifier to file_path in the binary model format: the arrays of
+the FlatTrees in trees are concatenated (one array per field), and the
+header records where each tree starts, its leaf labels, breakpoints and
+class distribution (distributions[i] is None for a single tree), and the
+class it was trained for (members[i], None for a single tree).
+classes are the class labels of the dataset data_name.
+'''
+
+
+def save_model(file_path, data_name, classes, trees, breakpoints,
+               distributions, members):
+    header = {'data_name': data_name, 'classes': list(classes), 'trees': []}
+    arrays = {}
+    fields = ['feature', 'child_offset', 'child_count', 'leaf_class',
+              'leaf_count', 'threshold', 'children']
+    for field in fields:
+        arrays[field] = numpy.concatenate(
+            [getattr(tree, field) for tree in trees])
+    node_start, children_start = 0, 0
+    for i in range(len(trees)):
+        distribution = None
+        if distributions[i] is not None:
+            distribution = [[c, float(distributions[i][c])]
+                            for c in distributions[i]]
+        header['trees'].append({
+            'nodes': [node_start, node_start + len(trees[i])],
+            'children': [children_start,
+                         children_start + len(trees[i].children)],
+            'labels': trees[i].labels,
+            # json objects only have string keys
+            'breakpoints': [[int(a), float(breakpoints[i][a])]
+                            for a in breakpoints[i]],
+            'distribution': distribution,
+            'member': members[i]
+        })
+        node_start += len(trees[i])
+        children_start += len(trees[i].children)
+    Storage.save_arrays(file_path, model_magic, model_version, header, arrays)
+
+
+'''
+Returns True iff file_path is a binary model file of the current version.
+'''
+
+
+def is_model(file_path):
+    return Storage.read_header(file_path, model_magic,
+                               model_version) is not None
+
+
+'''
+Loads a classifier saved with save_model, memory-mapping its arrays: the
+trees are views of them, so no node is read until it is used.
+Returns a tuple (trees, breakpoints, distributions, members, header) with
+the lists given to save_model.
+'''
+
+
+def load_model(file_path):
+    header, arrays = Storage.load_arrays(file_path, model_magic,
+                                         model_version)
+    trees, breakpoints, distributions, members = [], [], [], []
+    for tree in header['trees']:
+        nodes = slice(*tree['nodes'])
+        trees.append(FlatTree(
+            arrays['feature'][nodes], arrays['child_offset'][nodes],
+            arrays['child_count'][nodes],
+            arrays['children'][slice(*tree['children'])],
+            arrays['leaf_class'][nodes], arrays['leaf_count'][nodes],
+            tree['labels'], arrays['threshold'][nodes]))
+        breakpoints.append({a: value for a, value in tree['breakpoints']})
+        distribution = None
+        if tree['distribution'] is not None:
+            distribution = {c: value for c, value in tree['distribution']}
+        distributions.append(distribution)
+        members.append(tree['member'])
+    return trees, breakpoints, distributions, members, header
@@ -0,0 +1,321 @@
+'''
+Hoeffding tree module
+
+This module's responsibility is to learn a decision tree online, from
+instances that arrive one at a time or in small batches, at a constant cost
+per instance (a Hoeffding tree, or VFDT). Each leaf keeps the bucket (or
+value) x class histograms of its remaining attributes; once a leaf has seen
+grace_period new instances, the information gain of its attributes is
+computed from them (as Utils.profit does) and the leaf is split on the best
+attribute if the Hoeffding bound says that, with probability 1 - delta, it
+is better than the second best one.
+The tree is exported with the identifiers and data of the trees of ID3.ID3
+(see HoeffdingTree.to_tree), so it is saved, evaluated and served as any
+other Single classifier.
+'''
+
+import json
+import math
+import numpy
+import OutOfCore
+from treelib import Tree
+from Utils import histogram_cutting_point, information_gain
+from Utils import quantile_bin_edges
+
+
+'''
+Returns the quantile bucket edges (see Utils.quantile_bin_edges) of the
+continuous attributes of data computed over features, a 2-D array of
+instances (e.g. the first batch of the stream).
+'''
+
+
+def initial_edges(data, features, amount_bins):
+    edges = {}
+    for attribute in data.attributes:
+        if data.splitable_attribute(attribute):
+            edges[attribute] = quantile_bin_edges(features[:, attribute],
+                                                  amount_bins)
+    return edges
+
+
+class HoeffdingTree:
+    '''
+    Online decision tree for the instances of a dataset described by data
+    (an instance of Data, only its metadata is used). The continuous
+    attributes are cut at the bucket edges in edges (see initial_edges) and
+    used once per path, as in ID3.ID3.
+    - delta: probability of choosing a split other than the one the
+    infinite stream would choose.
+    - tie_threshold: the leaf is split anyway when the bound is smaller than
+    this, as the best attributes are then equally good.
+    - grace_period: instances a leaf sees between two evaluations.
+    - max_depth: the leaves at this depth are never split (no limit if
+    None).
+    '''
+    def __init__(self, data, edges, delta=1e-7, tie_threshold=0.05,
+                 grace_period=200, max_depth=None):
+        self.data = data
+        self.edges = edges
+        self.settings = {'delta': delta, 'tie_threshold': tie_threshold,
+                         'grace_period': grace_period, 'max_depth': max_depth}
+        self.amount_instances = 0
+        self.nodes = {name: numpy.zeros(0, dtype=dtype) for name, dtype
+                      in [('feature', numpy.intp), ('threshold', float),
+                          ('offset', numpy.intp), ('count', numpy.intp),
+                          ('depth', numpy.intp), ('slot', numpy.intp),
+                          ('seen', numpy.int64), ('profit', float),
+                          ('instances', numpy.int64)]}
+        self.nodes['counts'] = numpy.zeros((0, len(data.classes)),
+                                           dtype=numpy.int64)
+        self.nodes['attributes'] = numpy.zeros((0, len(data.attributes)),
+                                               dtype=bool)
+        # Histograms of the leaves, one slot per leaf (see __new_slot)
+        self.histograms = {}
+        for attribute in data.attributes:
+            if attribute in edges:
+                amount_buckets = len(edges[attribute]) + 1
+            else:
+                amount_buckets = len(data.attribute_values[attribute])
+            self.histograms[attribute] = numpy.zeros(
+                (0, amount_buckets, len(data.classes)), dtype=numpy.int64)
+        self.free_slots = []
+        self.amount_nodes = 0
+        self.__add_node(0, numpy.ones(len(data.attributes), dtype=bool),
+                        numpy.zeros(len(data.classes), dtype=numpy.int64))
+
+    '''
+    Adds a leaf at depth with the given remaining attributes (a mask over
+    data.attributes) and class counts. Returns its position.
+    '''
+    def __add_node(self, depth, attributes, counts):
+        position = self.amount_nodes
+        if position == len(self.nodes['feature']):
+            # The arrays double their capacity when they are full
+            capacity = max(2 * position, 16)
+            for name, array in self.nodes.items():
+                grown = numpy.zeros((capacity,) + array.shape[1:],
+                                    dtype=array.dtype)
+                grown[:position] = array[:position]
+                self.nodes[name] = grown
+        self.nodes['feature'][position] = -1
+        self.nodes['threshold'][position] = numpy.nan
+        self.nodes['offset'][position] = 0
+        self.nodes['count'][position] = 0
+        self.nodes['depth'][position] = depth
+        self.nodes['seen'][position] = 0
+        self.nodes['profit'][position] = 0
+        self.nodes['instances'][position] = 0
+        self.nodes['counts'][position] = counts
+        self.nodes['attributes'][position] = attributes
+        self.nodes['slot'][position] = self.__new_slot()
+        self.amount_nodes += 1
+        return position
+
+    def __new_slot(self):
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            for histogram in self.histograms.values():
+                histogram[slot] = 0
+            return slot
+        slot = len(next(iter(self.histograms.values())))
+        for attribute, histogram in self.histograms.items():
+            # As the nodes, the slots double their capacity
+            grown = numpy.zeros((max(2 * slot, 16),) + histogram.shape[1:],
+                                dtype=histogram.dtype)
+            grown[:slot] = histogram
+            self.histograms[attribute] = grown
+        self.free_slots = list(range(max(2 * slot, 16) - 1, slot, -1))
+        return slot
+
+    '''
+    Learns from a batch of instances: features is a 2-D array with one
+    instance per row and labels the position inside data.classes of their
+    classes. Each instance updates the histograms of its leaf; the leaves
+    that saw grace_period instances since their last evaluation are then
+    evaluated (a batch of one instance is the classic algorithm).
+    '''
+    def learn(self, features, labels):
+        self.amount_instances += len(labels)
+        positions = OutOfCore.route_rows(self.nodes, features)
+        order = numpy.argsort(positions, kind='stable')
+        leaves, starts = numpy.unique(positions[order], return_index=True)
+        ends = numpy.append(starts[1:], len(order))
+        amount_classes = len(self.data.classes)
+        for leaf, start, end in zip(leaves.tolist(), starts.tolist(),
+                                    ends.tolist()):
+            if leaf < 0:
+                continue
+            rows = order[start:end]
+            leaf_labels = labels[rows].astype(numpy.intp)
+            self.nodes['counts'][leaf] += numpy.bincount(
+                leaf_labels, minlength=amount_classes)
+            self.nodes['seen'][leaf] += len(rows)
+            slot = self.nodes['slot'][leaf]
+            for attribute, histogram in self.histograms.items():
+                column = features[rows, attribute]
+                if attribute in self.edges:
+                    codes = numpy.searchsorted(self.edges[attribute], column,
+                                               'left')
+                else:
+                    codes = column.astype(numpy.intp)
+                histogram[slot] += numpy.bincount(
+                    codes * amount_classes + leaf_labels,
+                    minlength=histogram[slot].size).reshape(
+                        histogram[slot].shape)
+            if self.nodes['seen'][leaf] >= self.settings['grace_period']:
+                self.nodes['seen'][leaf] = 0
+                self.__try_split(leaf)
+
+    '''
+    Computes the information gain of each remaining attribute of leaf from
+    its histograms and splits it on the best one if the Hoeffding bound
+    allows it.
+    '''
+    def __try_split(self, leaf):
+        counts = self.nodes['counts'][leaf]
+        if (numpy.count_nonzero(counts) <= 1 or
+                (self.settings['max_depth'] is not None and
+                 self.nodes['depth'][leaf] >= self.settings['max_depth'])):
+            return
+        slot = self.nodes['slot'][leaf]
+        candidates = []
+        for position, attribute in enumerate(self.data.attributes):
+            if not self.nodes['attributes'][leaf][position]:
+                continue
+            histogram = self.histograms[attribute][slot]
+            if attribute in self.edges:
+                cutting_value, gain = histogram_cutting_point(
+                    histogram, self.edges[attribute])
+                if cutting_value is None:
+                    continue
+            else:
+                cutting_value, gain = None, information_gain(histogram)
+            candidates.append((gain, position, attribute, cutting_value))
+        if not candidates:
+            return
+        # The attribute order breaks the ties, so learning is deterministic
+        candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+        best_gain = candidates[0][0]
+        second_gain = candidates[1][0] if len(candidates) > 1 else 0.0
+        amount = int(self.histograms[candidates[0][2]][slot].sum())
+        # The information gain ranges over log2(classes) bits
+        gain_range = math.log2(len(self.data.classes))
+        bound = math.sqrt(gain_range**2 * math.log(1 / self.settings['delta'])
+                          / (2 * amount))
+        if best_gain <= 0 or (best_gain - second_gain <= bound and
+                              bound >= self.settings['tie_threshold']):
+            return
+        self.__split(leaf, *candidates[0])
+
+    def __split(self, leaf, gain, position, attribute, cutting_value):
+        slot = self.nodes['slot'][leaf]
+        histogram = self.histograms[attribute][slot]
+        if cutting_value is not None:
+            below = histogram[:numpy.searchsorted(self.edges[attribute],
+                                                  cutting_value) + 1].sum(0)
+            children_counts = [below, histogram.sum(axis=0) - below]
+        else:
+            children_counts = list(histogram)
+        self.free_slots.append(slot)
+        self.nodes['slot'][leaf] = -1
+        self.nodes['feature'][leaf] = attribute
+        self.nodes['threshold'][leaf] = (
+            numpy.nan if cutting_value is None else cutting_value)
+        self.nodes['profit'][leaf] = gain
+        self.nodes['instances'][leaf] = int(self.nodes['counts'][leaf].sum())
+        self.nodes['count'][leaf] = len(children_counts)
+        attributes = self.nodes['attributes'][leaf].copy()
+        attributes[position] = False
+        depth = self.nodes['depth'][leaf] + 1
+        offset = None
+        for counts in children_counts:
+            child = self.__add_node(depth, attributes, counts)
+            if offset is None:
+                offset = child
+        self.nodes['offset'][leaf] = offset
+
+    '''
+    Returns the tree learned so far as ID3.ID3 does: a treelib tree with the
+    identifiers and data of its nodes (the leaves are labeled with the most
+    frequent class of the instances that reached them, or of their parent if
+    none did) and the cutting values.
+    '''
+    def to_tree(self):
+        tree = Tree()
+        cutting_values = {}
+        pending = [(0, 'Attribute None = None,', None, None)]
+        while pending:
+            position, identifier, parent, parent_counts = pending.pop()
+            counts = self.nodes['counts'][position]
+            attribute = int(self.nodes['feature'][position])
+            if attribute < 0:
+                if counts.sum() == 0 and parent_counts is not None:
+                    counts = parent_counts
+                label = self.data.classes[int(numpy.argmax(counts))]
+                tree.create_node('Class {c},Instances {inst}'.format(
+                    c=label, inst=int(self.nodes['counts'][position].sum())),
+                    identifier, parent)
+                continue
+            cutting_value = None
+            if not numpy.isnan(self.nodes['threshold'][position]):
+                cutting_value = self.nodes['threshold'][position].item()
+                cutting_values[attribute] = cutting_value
+            tree.create_node('Attribute {attr}'.format(attr=attribute),
+                             identifier, parent,
+                             data={'profit': self.nodes['profit'][position].item(),
+                                   'cutting_value': cutting_value,
+                                   'instances': int(self.nodes['instances'][position])})
+            values = self.data.attribute_values[attribute]
+            offset = int(self.nodes['offset'][position])
+            # Pushed in reverse, so the first child is created first
+            for i in reversed(range(len(values))):
+                pending.append((offset + i, identifier +
+                                'Attribute {attr} = {val},'.format(
+                                    attr=attribute, val=values[i]),
+                                identifier, counts))
+        return tree, cutting_values
+
+    '''
+    Saves the state of the learner to file_path (a numpy .npz file), so it
+    can keep learning later (see load).
+    '''
+    def save(self, file_path):
+        arrays = {'node_' + name: array[:self.amount_nodes]
+                  for name, array in self.nodes.items()}
+        for attribute, histogram in self.histograms.items():
+            arrays['histogram_{a}'.format(a=attribute)] = histogram
+        for attribute, edges in self.edges.items():
+            arrays['edges_{a}'.format(a=attribute)] = edges
+        arrays['free_slots'] = numpy.array(self.free_slots, dtype=numpy.intp)
+        arrays['state'] = numpy.array(json.dumps({
+            'data_name': self.data.data_name,
+            'settings': self.settings,
+            'amount_instances': self.amount_instances
+        }))
+        numpy.savez(file_path, **arrays)
+
+    '''
+    Loads a learner saved by save for the dataset described by data.
+    '''
+    @staticmethod
+    def load(file_path, data):
+        with numpy.load(file_path) as arrays:
+            state = json.loads(str(arrays['state']))
+            if state['data_name'] != data.data_name:
+                raise ValueError('Hoeffding.HoeffdingTree.load: {file} is a '
+                                 'learner of {name}'.format(
+                                     file=file_path, name=state['data_name']))
+            edges = {attribute: arrays['edges_{a}'.format(a=attribute)]
+                     for attribute in data.attributes
+                     if 'edges_{a}'.format(a=attribute) in arrays.files}
+            learner = HoeffdingTree(data, edges, **state['settings'])
+            learner.amount_instances = state['amount_instances']
+            for name in learner.nodes:
+                learner.nodes[name] = arrays['node_' + name].copy()
+            learner.amount_nodes = len(learner.nodes['feature'])
+            for attribute in learner.histograms:
+                learner.histograms[attribute] = arrays[
+                    'histogram_{a}'.format(a=attribute)].copy()
+            learner.free_slots = arrays['free_slots'].tolist()
+        return learner
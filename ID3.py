@@ -16,10 +16,21 @@ Example:
                     /                \                  |
             (tag=c2, id v11)    (tag=c1, id=v12)    (tag=c3, id=v21)
 '''
+import Data
+import heapq
 import json
+import math
+import multiprocessing
+import numpy
+import os
+import shutil
+import Storage
+import tempfile
 from treelib import Tree
-from Utils import profit, weighted_random
+from Utils import profit, weighted_random, information_gain
+from Utils import histogram_cutting_point, resident_memory
 import random
+import time
 
 
 # Saves the tree in treelib format into target_file in json format
@@ -71,153 +82,566 @@ def load_tree(target_file):
     return __dictionary_to_tree(dictionary, Tree())
 
 
+# Default values of the training options accepted by ID3
+default_options = {
+    # 'exact' evaluates every cutting point of the continuous attributes,
+    # 'sampled' only 4 random ones (see Data.best_cutting_value)
+    'cutting_search': 'exact',
+    # If not None, the continuous attributes are binned into this amount of
+    # quantile buckets at the root and the splits are found from per node
+    # bucket x class histograms (see __child_histograms)
+    'histogram_bins': None,
+    # If greater than 1, the attributes of the nodes with at least
+    # parallel_min_rows instances are scored by this amount of worker
+    # processes (see __open_scoring_pool)
+    'attribute_processes': 1,
+    'parallel_min_rows': 10000,
+    # If not None, the attributes of the nodes with at least race_min_rows
+    # instances are first scored on growing random samples of them, starting
+    # with race_sample_rows instances, until the lead of the best one is
+    # significant with probability 1 - race_delta (see __race_split)
+    'race_min_rows': None,
+    'race_sample_rows': 1000,
+    'race_delta': 1e-3,
+    # Order in which the open nodes are expanded: 'depth' (depth-first),
+    # 'breadth' (breadth-first) or 'best' (the node whose best split has
+    # the largest profit weighted by its amount of instances first)
+    'expansion': 'depth',
+    # The nodes max_depth levels below the root become leaves (no limit if
+    # None), as do the nodes with fewer than min_rows instances. Once the
+    # tree has max_nodes nodes (no limit if None), the open nodes become
+    # leaves
+    'max_depth': 3,
+    'min_rows': 1,
+    'max_nodes': None,
+    # If not None, once time.time() reaches deadline or the resident memory
+    # of the process and its worker processes (see __open_scoring_pool)
+    # reaches memory_limit bytes the open nodes become majority leaves (see
+    # __budget_exceeded). A tree trained inside a worker process (see
+    # Classifier.generate_forest_classifier) gets a share of the limit
+    'deadline': None,
+    'memory_limit': None,
+    # If not None, an instance of Profiler.Profiler that records the time
+    # (and memory) spent in each phase of the work of each node
+    'profiler': None,
+}
+
+
 '''
-Given data (an instance of the Data class), returns a classification tree
-following an extension of the ID3 algorithm and the cutting points generated.
+Returns a dictionary with the default training options updated with the
+given ones. Raises ValueError if an option is unknown.
 '''
 
 
-def ID3(data):
-    tree = Tree()
-    return __ID3(tree, data, None, None, None, {}, 0)
+def training_options(options):
+    for name in options:
+        if name not in default_options:
+            raise ValueError('ID3: unknown training option ' + name)
+    result = dict(default_options)
+    result.update(options)
+    return result
 
 
 '''
-ID3 algorithm.
-Recursively receives the training examples and the remaining attributes to
-process inside an instance of Data class.
-data is an instance of Data class. It has the remaining attributes to process.
-data.attributes is a list of indices that represent the remaining attributes.
-Returns a decision tree of treelib type.
-'''
-
-
-def __ID3(tree, data, parent_attribute, parent_attribute_value,
-          path_to_parent, cutting_values, depth):
-    if depth >= 3:
-        random_class = weighted_random(data.classes, data.class_distribution)
-        tree.create_node('Class {c},Instances {inst}'.format(
-                c=random_class, inst=len(data.dataset)),
-                            path_to_parent + 'Attribute {attr} = {val}'.format(
-                            attr=parent_attribute, val=parent_attribute_value)
-                            + ",", path_to_parent)
-        return tree, cutting_values
+Returns a copy of options (the training options of ID3) for the trees
+trained by each of processes worker processes: the memory budget
+memory_limit minus the resident memory of the current process is divided
+among them, so together they stay within it (the shared pages of the
+memory-mapped instances are counted by every worker, so the division errs
+on the safe side).
+'''
+
+
+def worker_options(options, processes):
+    options = dict(options)
+    if options.get('memory_limit') is not None:
+        options['memory_limit'] = max(
+            options['memory_limit'] - resident_memory(), 0) // processes
+    return options
+
+
+'''
+Given data (an instance of the Data class, which is not modified), returns a
+classification tree following an extension of the ID3 algorithm and the
+cutting points generated.
+options are the training options (see default_options).
+'''
+
+
+def ID3(data, **options):
+    tree = Tree()
+    options = training_options(options)
+    # The splits write the cuts of the continuous attributes into the
+    # instances (list mode) or the thresholds of the view (columnar mode), so
+    # the tree is grown from a copy and the caller's data is never modified
+    root = data.copy(instances=False)
+    root.monoclass_instances = data.monoclass_instances
+    if data.columnar:
+        root.dataset = data.dataset.copy()
     else:
-        depth += 1
-        parent_id = path_to_parent
-        if path_to_parent is None:
-            path_to_parent = ""
-        # All remaining instances belong to the same class
-        if data.monoclass_instances is not None:
-            tree.create_node('Class {c},Instances {inst}'.format(
-                c=data.monoclass_instances, inst=len(data.dataset)),
-                            path_to_parent + 'Attribute {attr} = {val}'.format(
-                            attr=parent_attribute, val=parent_attribute_value)
-                            + ",", parent_id)
-            return tree, cutting_values
-        # The are no attributes left
-        if data.amount_attributes == 0:
-            # First consider the case where there are no examples left
-            if len(data.dataset) == 0:
-                # Any label is likely (check data.global_class_distribution)
-                sorted_class = weighted_random(data.classes,
-                                            data.global_class_distribution)
-                tree.create_node('Class {c},Instances {inst}'.format(
-                    c=sorted_class, inst=0), path_to_parent +
-                    'Attribute {attr} = {val}'.format(
-                        attr=parent_attribute,
-                        val=parent_attribute_value) + ",", parent_id)
-                return tree, cutting_values
-            # If there are examples left, sort the label according to the
-            # class distribution known by the parent node
-            else:
-                # Use data.class_distribution to label
-                sorted_class = weighted_random(
-                    data.classes, list(data.class_distribution.values()))
-                tree.create_node('Class {c},Instances {inst}'.format(
-                    c=sorted_class, inst=len(data.dataset)), path_to_parent +
-                    'Attribute {attr} = {val}'.format(
-                        attr=parent_attribute, val=parent_attribute_value) +
-                    ",", parent_id)
-                return tree, cutting_values
-        # There are attributes left
-        if data.amount_attributes > 0:
-            # Shorten the tree depth to total_attribute_number / 2 in case of covtype dataset
-            if len(data.dataset) == 0:
-                # Any label is likely (check data.global_class_distribution)
-                sorted_class = weighted_random(
-                    data.classes, list(data.global_class_distribution.values()))
-                tree.create_node('Class {c},Instances {inst}'.format(
-                    c=sorted_class, inst=0), path_to_parent +
-                    'Attribute {attr} = {val}'.format(
-                        attr=parent_attribute, val=parent_attribute_value) + ",",
-                    parent_id)
-                return tree, cutting_values
-            else:
-                # Choose best attribute
-                best_root_attribute_list = []
-                best_profit = None
-                spliting_value_for_attribute = {}
-                for attribute in data.attributes:
-                    if data.splitable_attribute(attribute):
-                        spliting_value_for_attribute[attribute] = (
-                            data.best_cutting_value(attribute))
-                        new_profit = profit(data.dataset, attribute,
-                                            [spliting_value_for_attribute[
-                                                attribute]],
-                                            data.classes)
-                    else:
-                        new_profit = profit(data.dataset, attribute,
-                                            data.attribute_values[attribute],
-                                            data.classes)
-                    # If more than one attributes have equal profit,
-                    # choose one at random
-                    if (best_profit is None) or (new_profit > best_profit):
-                        best_profit = new_profit
-                        best_root_attribute_list = [attribute]
-                    elif best_profit == new_profit:
-                        best_root_attribute_list.append(attribute)
-
-                best_root_attribute = random.choice(best_root_attribute_list)
-                # Create root node for this case
-                tree.create_node('Attribute {attr}'.format(
-                    attr=best_root_attribute),
-                    path_to_parent + 'Attribute {attr} = {val}'.format(
-                    attr=parent_attribute, val=parent_attribute_value) + ",",
-                    parent_id)
-                if data.splitable_attribute(best_root_attribute):
-                    data.split_attribute(best_root_attribute,
-                                         spliting_value_for_attribute[
-                                            best_root_attribute])
-                    cutting_values[best_root_attribute] = (
-                        spliting_value_for_attribute[best_root_attribute])
-                # Generate a branch for each possible value of the attribute
-                filtered_data_dict = data.project_attribute(best_root_attribute)
-                for value in data.attribute_values[best_root_attribute]:
-                    # If there are no examples left, sort the label according to
-                    # the class distribution known by the parent node
-                    if len(filtered_data_dict[value].dataset) == 0:
-                        # Use filtered_data_dict[value].class_distribution to label
-                        sorted_class = weighted_random(
-                            data.classes,
-                            data.global_class_distribution)
-                        tree.create_node('Class {c},Instances {inst}'.format(
-                            c=sorted_class, inst=len(data.dataset)), path_to_parent
-                            + 'Attribute {attr} = {val},'.format(
-                                attr=parent_attribute, val=parent_attribute_value)
-                            + 'Attribute {attr} = {val}'.format(
-                            attr=best_root_attribute, val=value) + ",",
-                            parent_id + 'Attribute {attr} = {val},'.format(
-                                attr=parent_attribute, val=parent_attribute_value))
-                        return tree, cutting_values
-                    # Recursive call
-                    elif len(filtered_data_dict[value].dataset) > 0:
-                        __ID3(tree, filtered_data_dict[value],
-                            best_root_attribute, value, path_to_parent +
-                            "Attribute {attr} = {val}".format(
-                            attr=parent_attribute,
-                            val=parent_attribute_value) + ",", cutting_values, depth)
-                return tree, cutting_values
-        # Exception
+        root.dataset = [instance.copy() for instance in data.dataset]
+    data = root
+    histograms = None
+    if options['histogram_bins'] is not None:
+        data = data.columnar_copy()
+        data.build_histogram_bins(options['histogram_bins'])
+        histograms = {}
+        for attribute in data.attributes:
+            histograms[attribute] = data.histogram(attribute)
+    elif options['attribute_processes'] > 1:
+        data = data.columnar_copy().copy(instances=True)
+        # The workers index the instances by their position in the root
+        data.dataset = data.dataset.compacted()
+        scoring_pool = __open_scoring_pool(data, options)
+        try:
+            return __ID3(tree, data, {}, options, histograms,
+                         scoring_pool)
+        finally:
+            __close_scoring_pool(scoring_pool)
+    return __ID3(tree, data, {}, options, histograms, None)
+
+
+# Root instances and training options of an attribute scoring worker
+__scoring_worker_data = None
+__scoring_worker_options = None
+
+
+def __init_scoring_worker(file_path, metadata, options):
+    global __scoring_worker_data, __scoring_worker_options
+    dataset, _ = Storage.load_dataset(file_path)
+    metadata.columnar = True
+    metadata.dataset = dataset
+    __scoring_worker_data = metadata
+    __scoring_worker_options = options
+
+
+def __score_in_worker(indices, attribute, seed):
+    if seed is not None:
+        random.seed(seed)
+    data = __scoring_worker_data.copy(instances=False)
+    data.dataset = __scoring_worker_data.dataset
+    if indices is not None:
+        data.dataset = data.dataset.take(indices)
+    return __score_attribute(data, attribute, __scoring_worker_options, None)
+
+
+'''
+Opens a pool of options['attribute_processes'] worker processes that score
+the candidate attributes of a node concurrently.
+data is the root of the tree: a columnar instance of Data whose dataset owns
+its arrays, so that the nodes (index views of it) are sent to the workers as
+arrays of indices. The instances are saved once to a temporary binary file
+that every worker memory-maps.
+Returns a dictionary with the pool and its settings.
+'''
+def __open_scoring_pool(data, options):
+    directory = tempfile.mkdtemp()
+    file_path = os.path.join(directory, 'training' + Data.binary_extension)
+    data.save_data(file_path)
+    pool = multiprocessing.Pool(
+        options['attribute_processes'], initializer=__init_scoring_worker,
+        initargs=(file_path, data.copy(instances=False),
+                  dict(options, profiler=None)))
+    return {'pool': pool, 'directory': directory,
+            'min_rows': options['parallel_min_rows'],
+            'sampled': options['cutting_search'] == 'sampled'}
+
+
+'''
+Scores each attribute of data.attributes in the workers of scoring_pool.
+Returns the list of results of __score_attribute in the order of
+data.attributes, whatever the order in which the workers finish, so the
+choice of the best attribute is deterministic. When the cutting points are
+sampled, each task gets its own seed drawn from random.
+'''
+def __score_in_pool(scoring_pool, data):
+    indices = data.dataset.indices
+    if indices is not None:
+        indices = indices.astype(numpy.int32)
+    tasks = []
+    for attribute in data.attributes:
+        seed = random.getrandbits(32) if scoring_pool['sampled'] else None
+        tasks.append((indices, attribute, seed))
+    return scoring_pool['pool'].starmap(__score_in_worker, tasks)
+
+
+def __close_scoring_pool(scoring_pool):
+    scoring_pool['pool'].close()
+    scoring_pool['pool'].join()
+    shutil.rmtree(scoring_pool['directory'])
+
+
+'''
+Computes the histograms (see Data.histogram) of the remaining attributes of
+each child in children (a dictionary value -> instance of Data, as returned
+by Data.project_attribute) given the histograms of their parent.
+The histograms of the child with most instances are derived by subtracting
+those of its siblings from the parent's, so its instances are never read.
+Returns a dictionary value -> dictionary attribute -> histogram.
+'''
+
+
+def __child_histograms(histograms, children):
+    largest = max(children, key=lambda value: len(children[value].dataset))
+    result = {}
+    for value in children:
+        if value != largest:
+            result[value] = {}
+            for attribute in children[value].attributes:
+                result[value][attribute] = children[value].histogram(
+                    attribute)
+    result[largest] = {}
+    for attribute in children[largest].attributes:
+        result[largest][attribute] = histograms[attribute].copy()
+        for value in result:
+            if value != largest:
+                result[largest][attribute] -= result[value][attribute]
+    return result
+
+
+'''
+Computes the profit of splitting data across the attribute.
+histograms is None or a dictionary attribute -> histogram of data (see
+__child_histograms).
+Returns a tuple (profit, cutting_value) where cutting_value is the best
+cutting point if the attribute is splitable and None otherwise.
+'''
+
+
+def __score_attribute(data, attribute, options, histograms):
+    profiler = options['profiler']
+    if not data.splitable_attribute(attribute):
+        if histograms is not None:
+            new_profit = information_gain(histograms[attribute])
         else:
-            return "ID3.__ID3: data.amount_attributes can't be negative."
+            new_profit = profit(data.dataset, attribute,
+                                data.attribute_values[attribute],
+                                data.classes)
+        if profiler is not None:
+            profiler.record('profit')
+        return new_profit, None
+    if histograms is not None:
+        cutting_value, new_profit = histogram_cutting_point(
+            histograms[attribute], data.dataset.bin_edges(attribute))
+        if profiler is not None:
+            profiler.record('cutting_point')
+        # Without bucket edges, fall back to the search over the instances
+        if cutting_value is not None:
+            return new_profit, cutting_value
+    cutting_value = data.best_cutting_value(
+        attribute, options['cutting_search'] == 'exact')
+    if profiler is not None:
+        profiler.record('cutting_point')
+    new_profit = profit(data.dataset, attribute, [cutting_value],
+                        data.classes)
+    if profiler is not None:
+        profiler.record('profit')
+    return new_profit, cutting_value
+
+
+'''
+Races the attributes of data on growing uniform random samples of its
+instances: options['race_sample_rows'] of them, doubled after each round. As
+soon as the profit of the best attribute on the sample leads the second
+best by more than the Hoeffding bound R * sqrt(ln(1 / race_delta) / 2n) (R
+is the range of the profit, log2 of the amount of classes, and n the size of
+the sample), the best one wins and only it is scored again on all the
+instances of data, to find its cutting value and profit.
+Returns the same as __best_split, or None if the race is still close when
+the sample would reach half of the instances.
+'''
+
+
+def __race_split(data, options):
+    amount = len(data.dataset)
+    generator = numpy.random.default_rng(random.getrandbits(32))
+    order = generator.permutation(amount)
+    gain_range = math.log2(len(data.classes))
+    sample_rows = options['race_sample_rows']
+    while 2 * sample_rows <= amount:
+        sample = data.copy(instances=False)
+        if data.columnar:
+            sample.dataset = data.dataset.take(order[:sample_rows])
+        else:
+            sample.dataset = [data.dataset[i]
+                              for i in order[:sample_rows].tolist()]
+        scores = []
+        for attribute in data.attributes:
+            sample_profit, _ = __score_attribute(sample, attribute, options,
+                                                 None)
+            scores.append((sample_profit, attribute))
+        scores.sort(key=lambda score: score[0], reverse=True)
+        bound = gain_range * math.sqrt(math.log(1 / options['race_delta']) /
+                                       (2 * sample_rows))
+        if len(scores) == 1 or scores[0][0] - scores[1][0] > bound:
+            attribute = scores[0][1]
+            new_profit, cutting_value = __score_attribute(data, attribute,
+                                                          options, None)
+            return attribute, cutting_value, new_profit
+        sample_rows *= 2
+    return None
+
+
+'''
+Chooses the attribute to split data with: the one with the largest profit
+(see __score_attribute), at random among the tied ones. Without histograms,
+the nodes with at least options['race_min_rows'] instances first try to
+choose it from samples of their instances (see __race_split).
+Returns a tuple (attribute, cutting_value, profit) where cutting_value is
+None if the attribute is not splitable.
+'''
+
+
+def __best_split(data, options, histograms, scoring_pool):
+    if (options['race_min_rows'] is not None and histograms is None and
+            len(data.dataset) >= options['race_min_rows']):
+        split = __race_split(data, options)
+        if split is not None:
+            if options['profiler'] is not None:
+                options['profiler'].record('scoring', len(data.attributes))
+            return split
+    best_root_attribute_list = []
+    best_profit = None
+    spliting_value_for_attribute = {}
+    scores = None
+    if (scoring_pool is not None and
+            len(data.dataset) >= scoring_pool['min_rows']):
+        scores = __score_in_pool(scoring_pool, data)
+    for position, attribute in enumerate(data.attributes):
+        if scores is not None:
+            new_profit, cutting_value = scores[position]
+        else:
+            new_profit, cutting_value = __score_attribute(
+                data, attribute, options, histograms)
+        spliting_value_for_attribute[attribute] = cutting_value
+        # If more than one attributes have equal profit, choose one at random
+        if (best_profit is None) or (new_profit > best_profit):
+            best_profit = new_profit
+            best_root_attribute_list = [attribute]
+        elif best_profit == new_profit:
+            best_root_attribute_list.append(attribute)
+    best_root_attribute = random.choice(best_root_attribute_list)
+    if options['profiler'] is not None:
+        options['profiler'].record('scoring', len(data.attributes))
+    return (best_root_attribute,
+            spliting_value_for_attribute[best_root_attribute], best_profit)
+
+
+'''
+Returns the class label of node if it must be a leaf, or None if it can be
+split. node is an open node of __ID3.
+'''
+
+
+def __leaf_class(node, options):
+    data = node['data']
+    # There are no examples left: any label is likely
+    if len(data.dataset) == 0:
+        return weighted_random(data.classes, data.global_class_distribution)
+    # All remaining instances belong to the same class
+    if data.monoclass_instances is not None:
+        return data.monoclass_instances
+    # There are no attributes left, the node is too deep or too small: sort
+    # the label according to the class distribution of the node
+    if (data.amount_attributes == 0 or
+            (options['max_depth'] is not None and
+             node['depth'] >= options['max_depth']) or
+            len(data.dataset) < options['min_rows']):
+        return weighted_random(data.classes, data.class_distribution)
+    return None
+
+
+'''
+Adds node to the open nodes, keeping them ordered by options['expansion']:
+order is the position of node among all the pushed ones. The nodes are
+taken last in first out for 'depth', first in first out for 'breadth', and by
+decreasing profit of their best split weighted by their amount of instances
+for 'best' (the split is chosen here, so the nodes that become leaves are
+taken out first).
+'''
+
+
+def __push_node(open_nodes, node, order, options, scoring_pool):
+    if options['expansion'] == 'depth':
+        key = -order
+    elif options['expansion'] == 'breadth':
+        key = order
+    else:
+        profiler = options['profiler']
+        if profiler is not None:
+            profiler.record('children')
+            parent = profiler.enter(node)
+        node['class'] = __leaf_class(node, options)
+        if profiler is not None:
+            profiler.record('leaf_check')
+        key = float('-inf')
+        if node['class'] is None:
+            node['split'] = __best_split(node['data'], options,
+                                         node['histograms'], scoring_pool)
+            key = -node['split'][2] * len(node['data'].dataset)
+        if profiler is not None:
+            profiler.enter(parent)
+    heapq.heappush(open_nodes, (key, order, node))
+
+
+'''
+Returns the most frequent class of data, or a class drawn from the global
+distribution if data has no instances.
+'''
+
+
+def __majority_class(data):
+    if len(data.dataset) == 0:
+        return weighted_random(data.classes, data.global_class_distribution)
+    return max(data.classes, key=lambda c: data.class_distribution[c])
+
+
+'''
+Checks the time and memory budgets of options.
+Returns None if none of them was reached, or a dictionary describing where
+the training stopped: the budget reached ('time' or 'memory'), the seconds
+elapsed since start and the resident memory in bytes (of the process and
+its live child processes).
+'''
+
+
+def __budget_exceeded(options, start):
+    now = time.time()
+    memory = None
+    if options['memory_limit'] is not None:
+        # The workers scoring the attributes count against the same budget
+        memory = resident_memory() + sum(
+            resident_memory(child.pid)
+            for child in multiprocessing.active_children())
+    if options['deadline'] is not None and now >= options['deadline']:
+        reason = 'time'
+    elif memory is not None and memory >= options['memory_limit']:
+        reason = 'memory'
+    else:
+        return None
+    return {'reason': reason, 'seconds': now - start, 'memory': memory}
+
+
+def __create_leaf(tree, node, label):
+    tree.create_node('Class {c},Instances {inst}'.format(
+        c=label, inst=len(node['data'].dataset)), node['identifier'],
+        node['parent'])
+
+
+'''
+ID3 algorithm.
+Grows the tree from data (an instance of Data class with the training
+examples and the remaining attributes to process) expanding the open nodes
+one at a time, in the order given by options['expansion'] (see __push_node).
+A node becomes a leaf if its examples belong to a single class, if there
+are no attributes left, if it is options['max_depth'] levels below the root
+or has fewer than options['min_rows'] examples, or if splitting it would
+make the tree exceed options['max_nodes'] nodes.
+The identifier of a node is the path from the root: the identifier of its
+parent followed by 'Attribute a = v,' (a = None and v = None for the root).
+Internal nodes hold in their data the profit and cutting value of their
+split and their amount of instances.
+If a time or memory budget of options is reached, the remaining open nodes
+become majority leaves, and the data of the root records where the training
+stopped (under the key 'stopped', see __budget_exceeded) with the amount of
+nodes expanded and closed.
+If options['profiler'] is not None, the work of each node is reported to it
+phase by phase (see Profiler.Profiler); otherwise it is not measured at all.
+Returns a decision tree of treelib type and the cutting values.
+'''
+
+
+def __ID3(tree, data, cutting_values, options, histograms, scoring_pool):
+    profiler = options['profiler']
+    if profiler is not None:
+        profiler.begin_tree()
+    open_nodes = []
+    __push_node(open_nodes, {
+        'data': data, 'identifier': 'Attribute None = None,', 'parent': None,
+        'depth': 0, 'histograms': histograms
+    }, 0, options, scoring_pool)
+    # Amount of pushed nodes: the nodes of the tree plus the open ones
+    amount_nodes = 1
+    start = time.time()
+    budgeted = (options['deadline'] is not None or
+                options['memory_limit'] is not None)
+    stopped = None
+    while open_nodes:
+        node = heapq.heappop(open_nodes)[2]
+        data = node['data']
+        if profiler is not None:
+            profiler.enter(node)
+        if budgeted and stopped is None:
+            stopped = __budget_exceeded(options, start)
+            if stopped is not None:
+                stopped['expanded_nodes'] = tree.size()
+                stopped['closed_nodes'] = len(open_nodes) + 1
+        if stopped is not None:
+            __create_leaf(tree, node, __majority_class(data))
+            if profiler is not None:
+                profiler.record('tree_nodes')
+            continue
+        if 'class' not in node:
+            node['class'] = __leaf_class(node, options)
+        if profiler is not None:
+            profiler.record('leaf_check')
+        if node['class'] is not None:
+            __create_leaf(tree, node, node['class'])
+            if profiler is not None:
+                profiler.record('tree_nodes')
+            continue
+        if 'split' not in node:
+            node['split'] = __best_split(data, options, node['histograms'],
+                                         scoring_pool)
+        attribute, cutting_value, attribute_profit = node['split']
+        values = data.attribute_values[attribute]
+        if (options['max_nodes'] is not None and
+                amount_nodes + len(values) > options['max_nodes']):
+            __create_leaf(tree, node, weighted_random(
+                data.classes, data.class_distribution))
+            if profiler is not None:
+                profiler.record('tree_nodes')
+            continue
+        tree.create_node('Attribute {attr}'.format(attr=attribute),
+                         node['identifier'], node['parent'],
+                         data={'profit': attribute_profit,
+                               'cutting_value': cutting_value,
+                               'instances': len(data.dataset)})
+        if profiler is not None:
+            profiler.record('tree_nodes')
+        if data.splitable_attribute(attribute):
+            data.split_attribute(attribute, cutting_value)
+            cutting_values[attribute] = cutting_value
+        # Generate a branch for each possible value of the attribute
+        filtered_data_dict = data.project_attribute(attribute)
+        if profiler is not None:
+            profiler.record('projection')
+        children_histograms = {}
+        if node['histograms'] is not None:
+            children_histograms = __child_histograms(node['histograms'],
+                                                     filtered_data_dict)
+            if profiler is not None:
+                profiler.record('histograms')
+        children = []
+        for value in values:
+            children.append({
+                'data': filtered_data_dict[value],
+                'identifier': node['identifier'] +
+                'Attribute {attr} = {val},'.format(attr=attribute, val=value),
+                'parent': node['identifier'], 'depth': node['depth'] + 1,
+                'histograms': children_histograms.get(value)
+            })
+        # The first child is expanded first when the nodes are taken last
+        # in first out
+        if options['expansion'] == 'depth':
+            children.reverse()
+        for child in children:
+            __push_node(open_nodes, child, amount_nodes, options,
+                        scoring_pool)
+            amount_nodes += 1
+        if profiler is not None:
+            profiler.record('children')
+    if stopped is not None:
+        root = tree.get_node(tree.root)
+        root.data = dict(root.data or {}, stopped=stopped)
+    return tree, cutting_values
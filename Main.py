@@ -4,31 +4,264 @@ Main module of the project.
 
 import ast
 import Classifier
-import copy
+import CrossValidation
 import Data
 import Evaluator
+import FlatTree
+import Hoeffding
 import ID3
 import os
+import OutOfCore
+import Profiler
+import random
+import Server
 import sys
+import time
 
-training_file_name = 'training.txt'
-validation_file_name = 'validation.txt'
+training_file_name = 'training.bin'
+validation_file_name = 'validation.bin'
+# Directories generated before the binary format hold the instances as text
+legacy_validation_file_name = 'validation.txt'
 classifier_file_name_prefix = 'classifier'
 breakpoints_file_name_prefix = 'breakpoints'
 distribution_file_name_prefix = 'distribution'
 evaluation_file_name = 'evaluation.txt'
+stop_file_name = 'parada.txt'
+model_file_name = 'model.bin'
+profile_file_name_prefix = 'perfil'
+split_file_name = 'split.npz'
+hoeffding_file_name = 'hoeffding.npz'
+cross_validation_file_name = 'crossvalidation.txt'
+
+'''
+Splits the command line arguments in the positional ones and the options.
+Options have the form --name (for the names in flags) or --name value (for
+the names in valued_options).
+Returns a tuple (arguments, options) where arguments is the list of
+positional arguments and options is a dictionary name -> value (True for
+flags). Returns (None, error message) if an option is unknown or lacks its
+value.
+'''
+
+
+def parse_arguments(argv, flags, valued_options):
+    arguments = []
+    options = {}
+    index = 0
+    while index < len(argv):
+        argument = argv[index]
+        index += 1
+        if not argument.startswith('--'):
+            arguments.append(argument)
+            continue
+        name = argument[2:]
+        if name in flags:
+            options[name] = True
+        elif name in valued_options:
+            if index == len(argv):
+                return None, 'Error. Falta el valor de la opción {opt}.\n'.format(opt=argument)
+            options[name] = argv[index]
+            index += 1
+        else:
+            return None, 'Error. Opción desconocida {opt}.\n'.format(opt=argument)
+    return arguments, options
+
+
+'''
+Reads the options of the training of the trees (the options of ID3.ID3)
+from options, the dictionary of options of the command line (see
+parse_arguments). start_time is the time the program started, from which
+the time budget is counted.
+Returns a tuple (training_options, None), or (None, error message) if the
+value of an option is invalid.
+'''
+
+
+def parse_training_options(options, start_time):
+    training_options = {}
+    if 'corte' in options:
+        if options['corte'] not in ['exacto', 'muestreo']:
+            return None, 'Error. Búsqueda de puntos de corte incorrecta. Solo puede ser "exacto" o "muestreo"\n'
+        training_options['cutting_search'] = (
+            'exact' if options['corte'] == 'exacto' else 'sampled')
+    if 'histograma' in options:
+        if not options['histograma'].isdigit() or int(options['histograma']) < 2:
+            return None, 'Error. Cantidad de cubetas incorrecta. Debe ser un entero mayor o igual a 2\n'
+        training_options['histogram_bins'] = int(options['histograma'])
+    if 'expansion' in options:
+        expansions = {'profundidad': 'depth', 'anchura': 'breadth', 'ganancia': 'best'}
+        if options['expansion'] not in expansions:
+            return None, 'Error. Orden de expansión incorrecto. Solo puede ser "profundidad", "anchura" o "ganancia"\n'
+        training_options['expansion'] = expansions[options['expansion']]
+    if 'profundidad' in options:
+        if not options['profundidad'].isdigit():
+            return None, 'Error. Profundidad máxima incorrecta. Debe ser un entero no negativo\n'
+        # 0 means no limit
+        training_options['max_depth'] = int(options['profundidad']) or None
+    if 'minimo' in options:
+        if not options['minimo'].isdigit() or int(options['minimo']) < 1:
+            return None, 'Error. Cantidad mínima de instancias incorrecta. Debe ser un entero positivo\n'
+        training_options['min_rows'] = int(options['minimo'])
+    if 'nodos' in options:
+        if not options['nodos'].isdigit() or int(options['nodos']) < 1:
+            return None, 'Error. Cantidad máxima de nodos incorrecta. Debe ser un entero positivo\n'
+        training_options['max_nodes'] = int(options['nodos'])
+    if 'tiempo' in options:
+        if not options['tiempo'].isdigit() or int(options['tiempo']) < 1:
+            return None, 'Error. Tiempo máximo de entrenamiento incorrecto. Debe ser un entero positivo\n'
+        training_options['deadline'] = start_time + int(options['tiempo'])
+    if 'memoria' in options:
+        if not options['memoria'].isdigit() or int(options['memoria']) < 1:
+            return None, 'Error. Memoria máxima incorrecta. Debe ser un entero positivo\n'
+        training_options['memory_limit'] = int(options['memoria']) * 2**20
+    if 'carrera' in options:
+        if not options['carrera'].isdigit() or int(options['carrera']) < 1:
+            return None, 'Error. Cantidad mínima de instancias de la carrera incorrecta. Debe ser un entero positivo\n'
+        training_options['race_min_rows'] = int(options['carrera'])
+    if 'confianza' in options:
+        if 'carrera' not in options and 'incremental' not in options:
+            return None, 'Error. La opción --confianza solo se puede usar con --carrera o --incremental\n'
+        try:
+            delta = float(options['confianza'])
+        except ValueError:
+            delta = 0
+        if not 0 < delta < 1:
+            return None, 'Error. Confianza incorrecta. Debe ser un número entre 0 y 1 (e.g. 1e-7)\n'
+        if 'carrera' in options:
+            training_options['race_delta'] = delta
+    return training_options, None
+
+
+'''
+Writes to file_path a note for each tree of trees whose training stopped
+because a time or memory budget was reached (see ID3.ID3), saying where it
+stopped. Nothing is written if every tree was trained completely.
+'''
+
+
+def write_stop_note(file_path, trees):
+    notes = []
+    for i in range(len(trees)):
+        root_data = trees[i].get_node(trees[i].root).data
+        if not root_data or 'stopped' not in root_data:
+            continue
+        stopped = root_data['stopped']
+        reason = 'tiempo' if stopped['reason'] == 'time' else 'memoria'
+        note = ('Árbol {i}: el entrenamiento se detuvo por {reason} luego de {seconds:.2f} segundos'
+                .format(i=i, reason=reason, seconds=stopped['seconds']))
+        if stopped['memory'] is not None:
+            note += ', con {mb:.1f} MB de memoria residente'.format(mb=stopped['memory'] / 2**20)
+        note += ('. Se habían expandido {expanded} nodos y {closed} nodos abiertos se cerraron como hojas con la clase '
+                 'mayoritaria.\n'.format(expanded=stopped['expanded_nodes'], closed=stopped['closed_nodes']))
+        notes.append(note)
+    if notes:
+        with open(file_path, 'w') as stop_file:
+            stop_file.write(''.join(notes))
+
+
+'''
+Stops profiler and saves its measures in directory: the summary by depth,
+the counters of each node and the folded stacks (see Profiler.Profiler).
+'''
+
+
+def save_profile(profiler, directory):
+    profiler.stop()
+    prefix = directory + '/' + profile_file_name_prefix
+    print('Guardando el perfil del entrenamiento en {file}.txt, {file}.json y {file}.folded\n'.format(file=prefix))
+    profiler.save_summary(prefix + '.txt')
+    profiler.save_nodes(prefix + '.json')
+    profiler.save_folded(prefix + '.folded')
+
+
+'''
+Loads the classifier saved by the Entrenar mode in directory, from its
+binary model file if there is one and from the json and text files
+otherwise. amount_classes is the amount of classes of the dataset.
+Returns a tuple (trees, breakpoints, distributions) of lists with an element
+per tree: the trees are FlatTree.FlatTree (which route the raw instances)
+if they were loaded from the model file and treelib trees otherwise, and
+the distributions are empty for a single tree loaded from json.
+'''
+
+
+def load_classifier(directory, amount_classes):
+    trees = []
+    breakpoints = []
+    distributions = []
+
+    model_file_path = directory + '/' + model_file_name
+    if os.path.isfile(model_file_path) and FlatTree.is_model(model_file_path):
+        # The trees of the model route the raw instances (see FlatTree.FlatTree)
+        print('Cargando el modelo binario del archivo {file}'.format(file=model_file_path))
+        trees, breakpoints, distributions, _, _ = FlatTree.load_model(model_file_path)
+        return trees, breakpoints, distributions
+    # Walk through the tree files inside the directory
+    for root, dirs, files in os.walk(directory):
+        # Load the tree(s) from the files "classifier0.json", "classifier1.json", etc.
+        for i in range(amount_classes):
+            tree_file_name = classifier_file_name_prefix + str(i) + '.json'
+            if tree_file_name in files:
+                print('Cargando árbol del archivo {file}'.format(file=directory + '/' + tree_file_name))
+                trees.append(ID3.load_tree(directory + '/' + tree_file_name))
+            else:
+                break
+            breakpoints_file_name = breakpoints_file_name_prefix + str(i) + '.txt'
+            if breakpoints_file_name in files:
+                print('Cargando breakpoints del archivo {file}'.format(file=directory + '/' + breakpoints_file_name))
+                with open(directory + '/' + breakpoints_file_name, 'r') as breakpoints_file:
+                    breakpoints.append((ast.literal_eval((breakpoints_file.read()))))
+            distribution_file_name = distribution_file_name_prefix + str(i) + '.txt'
+            if distribution_file_name in files:
+                print('Cargando distribuciones de clases del archivo {file}'.format(file=directory + '/' + distribution_file_name))
+                with open(directory + '/' + distribution_file_name, 'r') as distribution_file:
+                    distributions.append((ast.literal_eval((distribution_file.read()))))
+    # Single tree classifier
+    if len(trees) == 1 and not breakpoints:
+        print('Cargando breakpoints generados durante el entrenamiento\n')
+        with (open(directory + '/' + breakpoints_file_name_prefix + '.txt')) as breakpoints_file:
+            breakpoints.append(ast.literal_eval(breakpoints_file.read()))
+    return trees, breakpoints, distributions
+
+
+'''
+Saves the tree learned so far by learner (a Hoeffding.HoeffdingTree for the
+dataset dataset_name) to directory as a Single classifier (model.bin,
+classifier0.json and breakpoints.txt), together with the state of the
+learner (hoeffding.npz) so the mode Actualizar can keep training it.
+Returns the tree.
+'''
+
+
+def save_incremental_model(learner, directory, dataset_name):
+    print('Guardando el estado del aprendiz en {file}\n'.format(file=directory + '/' + hoeffding_file_name))
+    learner.save(directory + '/' + hoeffding_file_name)
+    tree, breakpoints = learner.to_tree()
+    print('Guardando el modelo binario en {file}\n'.format(file=directory + '/' + model_file_name))
+    FlatTree.save_model(directory + '/' + model_file_name, dataset_name, learner.data.classes,
+                        [FlatTree.FlatTree.compile(tree, thresholds=True)], [breakpoints], [None], [None])
+    classifier_file_name = directory + '/' + classifier_file_name_prefix + '0.json'
+    print('Guardando el clasificador en {file}\n'.format(file=classifier_file_name))
+    ID3.save_tree(tree, classifier_file_name)
+    with open(directory + '/' + breakpoints_file_name_prefix + '.txt', 'w') as breakpoints_file:
+        breakpoints_file.write(str(breakpoints))
+    return tree
+
 
 if __name__ == '__main__':
     uso_general = """
-        Hay tres modos de uso: Entrenar, Evaluar y EvaluarAleatorio. El primero genera el clasificador y separa las instancias
-        para entrenamiento y para verificación; el segundo evalúa un clasificador generado previamente con
-        el modo Entrenar y el tercero evalúa un clasificador aleatorio que sortea las etiquetas de clase basándose en
-        la cantidad de instancias que hay de cada clase.\n
+        Hay seis modos de uso: Entrenar, Evaluar, EvaluarAleatorio, Servir, CrossValidar y Actualizar. El primero
+        genera el clasificador y separa las instancias para entrenamiento y para verificación; el segundo evalúa un
+        clasificador generado previamente con el modo Entrenar; el tercero evalúa un clasificador aleatorio que sortea
+        las etiquetas de clase basándose en la cantidad de instancias que hay de cada clase; el cuarto atiende pedidos de
+        clasificación con un clasificador generado previamente; el quinto estima las métricas de un clasificador con
+        validación cruzada y el sexto sigue entrenando con nuevas instancias un clasificador generado con
+        Entrenar --incremental.\n
     """
     uso_entrenar = """
         Para Entrenar invocar como
 
-        python3 Main.py Entrenar [iris|covtype] [Single|Forest] [training] [directorio]
+        python3 Main.py Entrenar [iris|covtype] [Single|Forest] [training] [directorio] [opciones]
 
         donde:
         - iris o covtype indica el nombre del dataset que se utilizará.
@@ -40,17 +273,62 @@ if __name__ == '__main__':
         un número entre 0 y 1 (e.g. 0.8).
         - directorio es el nombre del directorio en donde se van a guardar el clasificador
         y los archivos de instancias (se guardan las de entrenamiento y verificación en dos
-        archivos diferentes). No debe existir otro directorio con el mismo nombre.\n
+        archivos diferentes). No debe existir otro directorio con el mismo nombre.
+        - opciones:
+            --columnas guarda las instancias en arreglos por columnas en lugar de listas.
+            --corte [exacto|muestreo] elige cómo se buscan los puntos de corte de los atributos continuos:
+            exacto evalúa todos los valores en una pasada ordenada (por defecto) y muestreo sólo 4 valores al azar.
+            --histograma [cubetas] agrupa los valores de los atributos continuos en esa cantidad de cubetas por
+            cuantiles y busca los puntos de corte en histogramas de cubetas por clase.
+            --procesos [cantidad] entrena en paralelo con esa cantidad de procesos (con Single, los atributos de los nodos
+            grandes se evalúan en paralelo; con Forest, un árbol por proceso).
+            --expansion [profundidad|anchura|ganancia] orden en que se expanden los nodos: en profundidad (por defecto),
+            en anchura o primero el de mayor ganancia.
+            --profundidad [niveles] profundidad máxima del árbol (3 por defecto, 0 para no limitarla).
+            --minimo [instancias] los nodos con menos instancias se convierten en hojas (1 por defecto).
+            --nodos [cantidad] cantidad máxima de nodos del árbol (sin límite por defecto).
+            --tiempo [segundos] y --memoria [MB] limitan el tiempo de ejecución y la memoria residente del entrenamiento:
+            al alcanzar un límite los nodos abiertos se cierran como hojas, se guarda el clasificador y en parada.txt se
+            indica dónde se detuvo. La memoria es la de todos los procesos: con --procesos, los procesos que evalúan
+            atributos cuentan en el límite del árbol y, con Forest o CrossValidar, el límite (menos lo que ya usa el
+            proceso principal) se reparte en partes iguales entre los procesos.
+            --estratificado divide las instancias de cada clase por separado, manteniendo la proporción de las clases.
+            --semilla [entero] semilla de la división en entrenamiento y validación (al azar por defecto). La semilla y
+            los índices de la división se guardan en split.npz.
+            --perfil [tiempo|memoria] mide el tiempo de cada fase del trabajo de cada nodo (con memoria, también los bytes
+            reservados, lo que hace más lento el entrenamiento) y guarda en perfil.txt un resumen por profundidad, en
+            perfil.json los contadores de cada nodo y en perfil.folded las pilas para generar un flame graph. Con Forest
+            los árboles se entrenan en un único proceso.
+            --disco [instancias] (solo Single) divide y entrena leyendo las instancias del archivo binario en bloques de
+            esa cantidad, sin cargarlas en memoria: el árbol crece por niveles con histogramas de cubetas por clase
+            (--histograma, 256 cubetas por defecto) y la memoria depende de la cantidad de nodos abiertos, no de la
+            cantidad de instancias.
+            --incremental [lote] (solo Single) divide como --disco y entrena un árbol de Hoeffding que aprende de las
+            instancias de entrenamiento en lotes de esa cantidad (1 para aprender de a una), como si llegaran de un
+            flujo: cada hoja cuenta los valores por clase de sus atributos y se divide por el de mayor ganancia cuando
+            la cota de Hoeffding asegura que es mejor que el segundo. Los atributos continuos se agrupan en cubetas
+            (--histograma, 256 por defecto) calculadas con el primer bloque. --confianza [delta] probabilidad de
+            elegir una división equivocada (1e-7 por defecto) y --gracia [instancias] instancias que ve una hoja entre
+            dos evaluaciones (200 por defecto). El estado del aprendiz se guarda en hoeffding.npz, desde donde el modo
+            Actualizar sigue entrenándolo con nuevas instancias.
+            --carrera [instancias] en los nodos con al menos esa cantidad de instancias (sin --histograma), los atributos
+            se evalúan primero sobre muestras al azar de 1000, 2000, 4000... instancias del nodo hasta que la ventaja del
+            mejor supera la cota de Hoeffding para --confianza [delta] (1e-3 por defecto); solo ese atributo se evalúa
+            luego sobre todas las instancias. Si la muestra llega a la mitad del nodo sin un ganador claro, se evalúan
+            todos los atributos sobre todas las instancias.\n
     """
     uso_evaluar = """
         Para Evaluar invocar como:
 
-        python3 Main.py Evaluar [iris|covtype] [directorio]
+        python3 Main.py Evaluar [iris|covtype] [directorio] [opciones]
 
         donde:
         - directorio es un directorio generado tal como se genera con el modo Entrenar (para que funcione
         correctamente, no se pueden modificar los archivos de dicho directorio). Los resultados de la evaluación
-        se guardan en un archivo dentro de ese mismo directorio.\n
+        se guardan en un archivo dentro de ese mismo directorio.
+        - opciones:
+            --bloque [instancias] las instancias de validación se leen, clasifican y cuentan en bloques de esa cantidad
+            de instancias (65536 por defecto), por lo que la memoria usada no depende de la cantidad de instancias.\n
     """
     uso_evaluar_aleatorio = """
         Para EvaluarAleatorio invocar como:
@@ -62,52 +340,233 @@ if __name__ == '__main__':
         para calcular las métricas.
         - salida es el nombre del archivo en donde se escriben las métricas de la evaluación.\n
     """
+    uso_servir = """
+        Para Servir invocar como:
+
+        python3 Main.py Servir [iris|covtype] [directorio] [puerto] [opciones]
+
+        donde:
+        - directorio es un directorio generado con el modo Entrenar.
+        - puerto es el puerto de localhost en el que se atienden los pedidos (POST /clasificar con un json
+        {"instancias": [[...], ...]}; la respuesta es {"clases": [...]}).
+        - opciones:
+            --lote [instancias] cantidad máxima de instancias que se clasifican juntas (1024 por defecto).
+            --espera [milisegundos] tiempo máximo que espera un pedido a que se junten otros (2 por defecto).\n
+    """
+    uso_cross_validar = """
+        Para CrossValidar invocar como:
+
+        python3 Main.py CrossValidar [iris|covtype] [Single|Forest] [pliegues] [directorio] [opciones]
+
+        donde:
+        - pliegues es la cantidad de partes (al menos 2) en que se dividen las instancias. Para cada parte se entrena
+        un clasificador con las restantes y se evalúa con ella.
+        - directorio es el nombre del directorio en donde se guardan las métricas de cada parte y las agregadas
+        (crossvalidation.txt y crossvalidation.json). No debe existir otro directorio con el mismo nombre.
+        - opciones: las mismas opciones de entrenamiento del modo Entrenar (--columnas no tiene efecto). Con
+        --procesos [cantidad] las partes se entrenan en paralelo, una por proceso, y todos los procesos comparten una
+        única copia de las instancias. --estratificado mantiene la proporción de las clases en cada parte y
+        --semilla [entero] fija la división en partes y el entrenamiento.\n
+    """
+
+    uso_actualizar = """
+        Para Actualizar invocar como:
+
+        python3 Main.py Actualizar [iris|covtype] [directorio] [instancias] [opciones]
+
+        donde:
+        - directorio es un directorio generado con el modo Entrenar y la opción --incremental. El árbol de Hoeffding
+        guardado en hoeffding.npz aprende de las nuevas instancias y el clasificador del directorio (model.bin,
+        classifier0.json, breakpoints.txt y hoeffding.npz) se reemplaza por el actualizado.
+        - instancias es un archivo con las nuevas instancias, en el formato binario (.bin) o como texto con una
+        instancia por línea (como los datasets preprocesados, con la clase al final).
+        - opciones:
+            --lote [instancias] cantidad de instancias de cada lote de aprendizaje (1000 por defecto; 1 para aprender
+            de a una).\n
+    """
 
     # Sanitize arguments
-    if len(sys.argv) < 4:
-        print(uso_general + uso_entrenar + uso_evaluar + uso_evaluar_aleatorio)
+    arguments, options = parse_arguments(sys.argv, ['columnas', 'estratificado'],
+                                         ['corte', 'histograma', 'procesos', 'expansion', 'profundidad', 'minimo',
+                                          'nodos', 'tiempo', 'memoria', 'lote', 'espera', 'bloque', 'semilla',
+                                          'perfil', 'disco', 'incremental', 'confianza', 'gracia',
+                                          'carrera'])
+    start_time = time.time()
+    if arguments is None:
+        print(options)
+        print(uso_general + uso_entrenar + uso_evaluar + uso_evaluar_aleatorio + uso_servir +
+              uso_cross_validar + uso_actualizar)
+        exit()
+    if len(arguments) < 4:
+        print(uso_general + uso_entrenar + uso_evaluar + uso_evaluar_aleatorio + uso_servir +
+              uso_cross_validar + uso_actualizar)
         exit()
 
-    mode = sys.argv[1]
+    columnar = options.get('columnas', False)
+    mode = arguments[1]
     if mode == 'Entrenar':
-        if len(sys.argv) != 6:
+        if len(arguments) != 6:
             print('Error. Número incorrecto de parámetros.\n')
             print(uso_entrenar)
             exit()
-        dataset_name = sys.argv[2]
+        dataset_name = arguments[2]
         if dataset_name not in ['iris', 'covtype']:
             print('Error. Nombre de dataset incorrecto. Solo puede ser "iris" o "covtype"\n')
             print(uso_entrenar)
             exit()
-        classifier_type = sys.argv[3]
+        classifier_type = arguments[3]
         if classifier_type not in ['Single', 'Forest']:
             print('Error. Tipo de clasificador incorrecto. Solo puede ser "Single" o "Forest"\n')
             print(uso_entrenar)
             exit()
-        training_percentage = float(sys.argv[4])
+        training_percentage = float(arguments[4])
         if training_percentage <= 0 or training_percentage > 1:
             print('Error. Valor de proporción de instancias de entrenamiento' +
                   ' incorrecto. Solo puede ser un numero entre 0 y 1, 1 inclusive (e.g. 0.8)\n')
             print(uso_entrenar)
             exit()
-        directory = sys.argv[5]
+        directory = arguments[5]
         if os.path.isdir(directory):
             print('Error. Ya existe el directorio especificado. Especificar uno nuevo.\n')
             print(uso_entrenar)
             exit()
+        training_options, error = parse_training_options(options, start_time)
+        if training_options is None:
+            print(error)
+            print(uso_entrenar)
+            exit()
+        seed = None
+        if 'semilla' in options:
+            if not options['semilla'].isdigit() or int(options['semilla']) >= 2**32:
+                print('Error. Semilla incorrecta. Debe ser un entero entre 0 y 2^32 - 1\n')
+                print(uso_entrenar)
+                exit()
+            seed = int(options['semilla'])
+        processes = 1
+        if 'procesos' in options:
+            if not options['procesos'].isdigit() or int(options['procesos']) < 1:
+                print('Error. Cantidad de procesos incorrecta. Debe ser un entero positivo\n')
+                print(uso_entrenar)
+                exit()
+            processes = int(options['procesos'])
+        profiler = None
+        if 'perfil' in options:
+            if options['perfil'] not in ['tiempo', 'memoria']:
+                print('Error. Perfil incorrecto. Solo puede ser "tiempo" o "memoria"\n')
+                print(uso_entrenar)
+                exit()
+            profiler = Profiler.Profiler(track_memory=options['perfil'] == 'memoria')
+            training_options['profiler'] = profiler
+        chunk_rows = None
+        if 'disco' in options:
+            if not options['disco'].isdigit() or int(options['disco']) < 1:
+                print('Error. Tamaño de bloque incorrecto. Debe ser un entero positivo\n')
+                print(uso_entrenar)
+                exit()
+            if classifier_type != 'Single' or 'estratificado' in options or profiler is not None:
+                print('Error. La opción --disco solo se puede usar con Single, sin --estratificado ni --perfil\n')
+                print(uso_entrenar)
+                exit()
+            chunk_rows = int(options['disco'])
+        batch_rows = None
+        if 'incremental' in options:
+            if not options['incremental'].isdigit() or int(options['incremental']) < 1:
+                print('Error. Tamaño de lote incorrecto. Debe ser un entero positivo\n')
+                print(uso_entrenar)
+                exit()
+            if (classifier_type != 'Single' or 'estratificado' in options or profiler is not None or
+                    chunk_rows is not None):
+                print('Error. La opción --incremental solo se puede usar con Single, sin --estratificado, --perfil ni '
+                      '--disco\n')
+                print(uso_entrenar)
+                exit()
+            batch_rows = int(options['incremental'])
+            chunk_rows = max(batch_rows, 65536)
+        hoeffding_options = {}
+        if batch_rows is not None and 'confianza' in options:
+            # Already validated by parse_training_options
+            hoeffding_options['delta'] = float(options['confianza'])
+        if 'gracia' in options:
+            if not options['gracia'].isdigit() or int(options['gracia']) < 1:
+                print('Error. Período de gracia incorrecto. Debe ser un entero positivo\n')
+                print(uso_entrenar)
+                exit()
+            hoeffding_options['grace_period'] = int(options['gracia'])
+        if 'gracia' in options and batch_rows is None:
+            print('Error. La opción --gracia solo se puede usar con --incremental\n')
+            print(uso_entrenar)
+            exit()
 
         # Create directory for saving the results
         print('Creando directorio {dir}\n'.format(dir=directory))
         os.mkdir(directory)
 
+        if chunk_rows is not None:
+            # Out of core or incremental training: the instances are only read in blocks
+            # Only the binary file of the dataset is built (if needed), its instances are not loaded
+            source_path = Data.binary_data(dataset_name)
+            if source_path is None:
+                print('Error. No se encontró el archivo {file} del corpus {name}\n'.format(
+                    file=Data.iris_raw_data if dataset_name == 'iris' else Data.covtype_raw_data, name=dataset_name))
+                exit()
+            if seed is None:
+                seed = random.getrandbits(32)
+            print('Dividiendo corpus por bloques de {rows} instancias con la semilla {seed}\n'
+                  .format(rows=chunk_rows, seed=seed))
+            amount_training, amount_validation = Data.split_chunks(
+                source_path, training_percentage, seed, chunk_rows,
+                directory + '/' + training_file_name, directory + '/' + validation_file_name)
+            print('{training} instancias para entrenamiento y {validation} para validar\n'
+                  .format(training=amount_training, validation=amount_validation))
+            classes = Data.Data(dataset_name, instances=False).classes
+            if batch_rows is None:
+                print('Entrenando al clasificador por niveles, leyendo las instancias por bloques\n')
+                tree, breakpoints = OutOfCore.ID3_out_of_core(dataset_name, directory + '/' + training_file_name,
+                                                              chunk_rows, seed=seed, **training_options)
+            else:
+                print('Entrenando un árbol de Hoeffding con lotes de {rows} instancias\n'.format(rows=batch_rows))
+                training_options = ID3.training_options(training_options)
+                learner = None
+                for features, labels in Data.read_chunks(dataset_name, directory + '/' + training_file_name,
+                                                         chunk_rows):
+                    if learner is None:
+                        # The buckets of the continuous attributes come from the first block
+                        metadata = Data.Data(dataset_name, instances=False)
+                        edges = Hoeffding.initial_edges(
+                            metadata, features, training_options['histogram_bins'] or OutOfCore.default_bins)
+                        learner = Hoeffding.HoeffdingTree(metadata, edges, max_depth=training_options['max_depth'],
+                                                          **hoeffding_options)
+                    for start in range(0, len(labels), batch_rows):
+                        learner.learn(features[start:start + batch_rows], labels[start:start + batch_rows])
+                if learner is None:
+                    print('Error. No hay instancias de entrenamiento.\n')
+                    exit()
+                print(save_incremental_model(learner, directory, dataset_name))
+                exit()
+            print('Guardando el modelo binario en {file}\n'.format(file=directory + '/' + model_file_name))
+            FlatTree.save_model(directory + '/' + model_file_name, dataset_name, classes,
+                                [FlatTree.FlatTree.compile(tree, thresholds=True)], [breakpoints], [None], [None])
+            classifier_file_name = directory + '/' + classifier_file_name_prefix + '0.json'
+            print('Guardando el clasificador en {file}\n'.format(file=classifier_file_name))
+            ID3.save_tree(tree, classifier_file_name)
+            with open(directory + '/' + breakpoints_file_name_prefix + '.txt', 'w') as breakpoints_file:
+                breakpoints_file.write(str(breakpoints))
+            print(tree)
+            exit()
+
         # Read instances
         print('Leyendo dataset\n')
-        data = Data.Data(dataset_name)
+        data = Data.Data(dataset_name, columnar)
 
         # Divide corpus and save the training and validation instances
         print('Dividiendo corpus en {training}% para entrenamiento y {validation}% para validar\n'
               .format(training=training_percentage*100, validation=100-(training_percentage*100)))
-        data_training, data_validation = data.divide_corpus(training_percentage)
+        split = data.draw_split(training_percentage, options.get('estratificado', False), seed)
+        data_training, data_validation = data.apply_split(split)
+        # The seed and the indices of the split allow to reproduce it (see Data.load_split)
+        print('Guardando la semilla y los índices de la división en {file}\n'
+              .format(file=directory + '/' + split_file_name))
+        Data.save_split(split, directory + '/' + split_file_name)
 
         # Save the training and validation instances for later
         print('Guardando las instancias de entrenamiento y validación\n')
@@ -116,18 +575,36 @@ if __name__ == '__main__':
 
         # Generate classifier
         print('Entrenando al clasificador\n')
+        if profiler is not None:
+            # The trees of a forest report to the same profiler
+            if classifier_type == 'Forest':
+                processes = 1
+            profiler.start()
         if classifier_type == 'Single':
-            tree, breakpoints = ID3.ID3(data_training)
+            training_options['attribute_processes'] = processes
+            tree, breakpoints = ID3.ID3(data_training, **training_options)
+            if profiler is not None:
+                save_profile(profiler, directory)
+            print('Guardando el modelo binario en {file}\n'.format(file=directory + '/' + model_file_name))
+            FlatTree.save_model(directory + '/' + model_file_name, dataset_name, data_training.classes,
+                                [FlatTree.FlatTree.compile(tree, thresholds=True)], [breakpoints], [None], [None])
             classifier_file_name = directory + '/' + classifier_file_name_prefix + '0.json'
             print('Guardando el clasificador en {file}\n'.format(file=classifier_file_name))
             ID3.save_tree(tree, classifier_file_name)
             print('Guardando los breakpoints de los atributos con valores continuos\n')
             with open(directory + '/' + breakpoints_file_name_prefix + '.txt', 'w') as breakpoints_file:
                 breakpoints_file.write(str(breakpoints))
+            write_stop_note(directory + '/' + stop_file_name, [tree])
             print(tree)
             exit()
         elif classifier_type == 'Forest':
-            trees = Classifier.generate_forest_classifier(data_training)
+            trees = Classifier.generate_forest_classifier(data_training, processes, **training_options)
+            if profiler is not None:
+                save_profile(profiler, directory)
+            print('Guardando el modelo binario en {file}\n'.format(file=directory + '/' + model_file_name))
+            FlatTree.save_model(directory + '/' + model_file_name, dataset_name, data_training.classes,
+                                [FlatTree.FlatTree.compile(tree[0], thresholds=True) for tree in trees],
+                                [tree[1] for tree in trees], [tree[2] for tree in trees], data_training.classes)
             print('Guardando los árboles que componen al clasificador en el directorio {dir}'.format(dir=directory))
             for i in range(len(trees)):
                 tree_file_name = directory + '/' + classifier_file_name_prefix + str(i) + '.json'
@@ -141,103 +618,79 @@ if __name__ == '__main__':
                 print('Guardando distribuciones de clases para votación en {file}'.format(file=distribution_file_name))
                 with open(distribution_file_name, 'w') as distribution_file:
                     distribution_file.write(str(trees[i][2]))
+            write_stop_note(directory + '/' + stop_file_name, [tree[0] for tree in trees])
             exit()
         else:
             print('Main.py: Exception, impossible case.\n')
 
     elif mode == 'Evaluar':
-        if len(sys.argv) != 4:
+        if len(arguments) != 4:
             print('Error. Número incorrecto de parámetros.\n')
             print(uso_evaluar)
             exit()
-        dataset_name = sys.argv[2]
+        dataset_name = arguments[2]
         if dataset_name not in ['iris', 'covtype']:
             print('Error. Nombre de dataset incorrecto. Solo puede ser "iris" o "covtype"\n')
             print(uso_evaluar)
             exit()
-        directory = sys.argv[3]
+        directory = arguments[3]
         if not os.path.isdir(directory):
             print('Error. No existe el directorio especificado. Especificar un directorio que haya sido creado con el modo Entrenar.\n')
             print(uso_evaluar)
             exit()
 
         # Load validation data
-        print('Leyendo instancias para validar\n')
-        data_validation = Data.load_data(dataset_name, directory + '/' + validation_file_name)
-
-        trees = []
-        breakpoints = []
-        distributions = []
-
-        # Walk through the tree files inside the directory
-        for root, dirs, files in os.walk(directory):
-            # Load the tree(s) from the files "classifier0.json", "classifier1.json", etc.
-            for i in range(data_validation.amount_classes):
-                tree_file_name = classifier_file_name_prefix + str(i) + '.json'
-                if tree_file_name in files:
-                    print('Cargando árbol del archivo {file}'.format(file=directory + '/' + tree_file_name))
-                    trees.append(ID3.load_tree(directory + '/' + tree_file_name))
-                else:
-                    break
-                breakpoints_file_name = breakpoints_file_name_prefix + str(i) + '.txt'
-                if breakpoints_file_name in files:
-                    print('Cargando breakpoints del archivo {file}'.format(file=directory + '/' + breakpoints_file_name))
-                    with open(directory + '/' + breakpoints_file_name, 'r') as breakpoints_file:
-                        breakpoints.append((ast.literal_eval((breakpoints_file.read()))))
-                distribution_file_name = distribution_file_name_prefix + str(i) + '.txt'
-                if distribution_file_name in files:
-                    print('Cargando distribuciones de clases del archivo {file}'.format(file=directory + '/' + distribution_file_name))
-                    with open(directory + '/' + distribution_file_name, 'r') as distribution_file:
-                        distributions.append((ast.literal_eval((distribution_file.read()))))
-
-        # Single tree classifier
-        if len(trees) == 1:
-            # Load breakpoints
-            print('Cargando breakpoints generados durante el entrenamiento\n')
-            with (open(directory + '/' + breakpoints_file_name_prefix + '.txt')) as breakpoints_file:
-                breakpoints = ast.literal_eval(breakpoints_file.read())
-            print('Aplicando breakpoints a los atributos continuos de las instancias de validación\n')
-            data_validation.apply_breakpoints(breakpoints)
-            print('Ejecutando el clasificador sobre las instancias de validación\n')
-            classification = Classifier.classify_dataset_tree(trees[0], data_validation)
-        # Forest classifier
-        else:
-            classifier = []
+        chunk_rows = 65536
+        if 'bloque' in options:
+            if not options['bloque'].isdigit() or int(options['bloque']) < 1:
+                print('Error. Tamaño de bloque incorrecto. Debe ser un entero positivo\n')
+                print(uso_evaluar)
+                exit()
+            chunk_rows = int(options['bloque'])
+
+        metadata = Data.Data(dataset_name, instances=False)
+        trees, breakpoints, distributions = load_classifier(directory, metadata.amount_classes)
+
+        if len(trees) > 1:
             assert len(trees) == len(breakpoints) and len(breakpoints) == len(distributions)
-            for i in range(len(trees)):
-                classifier.append((trees[i], breakpoints[i], distributions[i]))
-            data_validation_list = []
-            for i in range(len(trees)):
-                data_validation_list.append(copy.deepcopy(data_validation))
-            print('Ejecutando el clasificador sobre las instancias de validación\n')
-            classification = Classifier.classify_dataset_multi_label(classifier, data_validation_list)
+        # Each tree applies its own breakpoints to the attributes it checks, so all of them read the same
+        # instances, which are not discretized
+        flat_trees = Classifier.raw_flat_trees(trees, breakpoints)
 
-        print('Evaluando clasificador\n')
+        def predict(matrix):
+            return Classifier.predict_matrix(flat_trees, distributions, metadata.classes,
+                                             metadata.global_class_distribution, matrix)
+
+        # The validation instances are read, classified and counted in blocks of chunk_rows instances
+        validation_file_path = directory + '/' + validation_file_name
+        if not os.path.isfile(validation_file_path):
+            validation_file_path = directory + '/' + legacy_validation_file_name
+        print('Ejecutando y evaluando el clasificador sobre las instancias de validación en bloques de {n} instancias\n'
+              .format(n=chunk_rows))
         print('Guardando métricas en {file}'.format(file=directory + '/' + evaluation_file_name))
         classes = []
-        for c in data_validation.classes:
+        for c in metadata.classes:
             classes.append(str(c))
-        Evaluator.evaluate_classificator(classification, classes,
-                                         data_validation.dataset, len(data_validation.dataset),
-                                         directory + '/' + evaluation_file_name)
+        Evaluator.evaluate_chunks(Data.read_chunks(dataset_name, validation_file_path, chunk_rows), predict, classes,
+                                  directory + '/' + evaluation_file_name)
         exit()
     elif mode == 'EvaluarAleatorio':
-        if len(sys.argv) != 5:
+        if len(arguments) != 5:
             print('Error. Número incorrecto de parámetros.\n')
             print(uso_evaluar_aleatorio)
             exit()
-        dataset_name = sys.argv[2]
+        dataset_name = arguments[2]
         if dataset_name not in ['iris', 'covtype']:
             print('Error. Nombre de dataset incorrecto. Solo puede ser "iris" o "covtype"\n')
             print(uso_evaluar_aleatorio)
             exit()
-        validation_precentage = float(sys.argv[3])
+        validation_precentage = float(arguments[3])
         if validation_precentage <= 0 or validation_precentage > 1:
             print('Error. Valor de proporción de instancias de validación' +
                   ' incorrecto. Solo puede ser un numero entre 0 y 1, 1 inclusive (e.g. 0.8)\n')
             print(uso_evaluar_aleatorio)
             exit()
-        output_file = sys.argv[4]
+        output_file = arguments[4]
         if os.path.isfile(output_file):
             print('Error. Ya existe el archivo especificado o no es un nombre válido de archivo.\n')
             print(uso_evaluar_aleatorio)
@@ -258,7 +711,173 @@ if __name__ == '__main__':
                                          data_validation.dataset, len(data_validation.dataset),
                                          output_file)
         exit()
+    elif mode == 'Servir':
+        if len(arguments) != 5:
+            print('Error. Número incorrecto de parámetros.\n')
+            print(uso_servir)
+            exit()
+        dataset_name = arguments[2]
+        if dataset_name not in ['iris', 'covtype']:
+            print('Error. Nombre de dataset incorrecto. Solo puede ser "iris" o "covtype"\n')
+            print(uso_servir)
+            exit()
+        directory = arguments[3]
+        if not os.path.isdir(directory):
+            print('Error. No existe el directorio especificado. Especificar un directorio que haya sido creado con el modo Entrenar.\n')
+            print(uso_servir)
+            exit()
+        if not arguments[4].isdigit() or int(arguments[4]) > 65535:
+            print('Error. Puerto incorrecto. Debe ser un entero entre 0 y 65535\n')
+            print(uso_servir)
+            exit()
+        port = int(arguments[4])
+        max_batch = 1024
+        if 'lote' in options:
+            if not options['lote'].isdigit() or int(options['lote']) < 1:
+                print('Error. Tamaño de lote incorrecto. Debe ser un entero positivo\n')
+                print(uso_servir)
+                exit()
+            max_batch = int(options['lote'])
+        max_delay = 2
+        if 'espera' in options:
+            if not options['espera'].isdigit():
+                print('Error. Tiempo de espera incorrecto. Debe ser un entero no negativo\n')
+                print(uso_servir)
+                exit()
+            max_delay = int(options['espera'])
+
+        metadata = Data.Data(dataset_name, instances=False)
+        trees, breakpoints, distributions = load_classifier(directory, metadata.amount_classes)
+        flat_trees = Classifier.raw_flat_trees(trees, breakpoints)
+
+        def predict(matrix):
+            predictions = Classifier.predict_matrix(flat_trees, distributions, metadata.classes,
+                                                    metadata.global_class_distribution, matrix)
+            return [metadata.classes[p] for p in predictions.tolist()]
+
+        server = Server.create_server(predict, metadata.amount_attributes, port, max_batch, max_delay / 1000)
+        print('Atendiendo pedidos en http://{host}:{port}/clasificar (Ctrl+C para terminar)\n'
+              .format(host=server.server_address[0], port=server.server_address[1]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print('Deteniendo el servidor\n')
+        server.server_close()
+        exit()
+    elif mode == 'CrossValidar':
+        if len(arguments) != 6:
+            print('Error. Número incorrecto de parámetros.\n')
+            print(uso_cross_validar)
+            exit()
+        dataset_name = arguments[2]
+        if dataset_name not in ['iris', 'covtype']:
+            print('Error. Nombre de dataset incorrecto. Solo puede ser "iris" o "covtype"\n')
+            print(uso_cross_validar)
+            exit()
+        classifier_type = arguments[3]
+        if classifier_type not in ['Single', 'Forest']:
+            print('Error. Tipo de clasificador incorrecto. Solo puede ser "Single" o "Forest"\n')
+            print(uso_cross_validar)
+            exit()
+        if not arguments[4].isdigit() or int(arguments[4]) < 2:
+            print('Error. Cantidad de pliegues incorrecta. Debe ser un entero mayor o igual a 2\n')
+            print(uso_cross_validar)
+            exit()
+        amount_folds = int(arguments[4])
+        directory = arguments[5]
+        if os.path.isdir(directory):
+            print('Error. Ya existe el directorio especificado. Especificar uno nuevo.\n')
+            print(uso_cross_validar)
+            exit()
+        training_options, error = parse_training_options(options, start_time)
+        if training_options is None:
+            print(error)
+            print(uso_cross_validar)
+            exit()
+        seed = None
+        if 'semilla' in options:
+            if not options['semilla'].isdigit() or int(options['semilla']) >= 2**32:
+                print('Error. Semilla incorrecta. Debe ser un entero entre 0 y 2^32 - 1\n')
+                print(uso_cross_validar)
+                exit()
+            seed = int(options['semilla'])
+            # The seeds of the folds are drawn from random
+            random.seed(seed)
+        processes = 1
+        if 'procesos' in options:
+            if not options['procesos'].isdigit() or int(options['procesos']) < 1:
+                print('Error. Cantidad de procesos incorrecta. Debe ser un entero positivo\n')
+                print(uso_cross_validar)
+                exit()
+            processes = int(options['procesos'])
+
+        print('Creando directorio {dir}\n'.format(dir=directory))
+        os.mkdir(directory)
+        print('Leyendo dataset\n')
+        data = Data.Data(dataset_name, columnar=True)
+        if amount_folds > len(data.dataset):
+            print('Error. Hay más pliegues que instancias.\n')
+            exit()
+        print('Validando con {k} pliegues en {p} proceso(s)\n'.format(k=amount_folds, p=processes))
+        results = CrossValidation.cross_validate(data, classifier_type, amount_folds, processes,
+                                                 options.get('estratificado', False), seed, **training_options)
+        for result in results:
+            print('Pliegue {fold}: {seconds_training:.3f} segundos de entrenamiento, {seconds_prediction:.3f} de '
+                  'clasificación\n'.format(fold=result['fold'], seconds_training=result['training_seconds'],
+                                           seconds_prediction=result['prediction_seconds']))
+        output_file = directory + '/' + cross_validation_file_name
+        print('Guardando las métricas en {file}\n'.format(file=output_file))
+        CrossValidation.save_report(results, data.classes, output_file)
+        exit()
+    elif mode == 'Actualizar':
+        if len(arguments) != 5:
+            print('Error. Número incorrecto de parámetros.\n')
+            print(uso_actualizar)
+            exit()
+        dataset_name = arguments[2]
+        if dataset_name not in ['iris', 'covtype']:
+            print('Error. Nombre de dataset incorrecto. Solo puede ser "iris" o "covtype"\n')
+            print(uso_actualizar)
+            exit()
+        directory = arguments[3]
+        if not os.path.isfile(directory + '/' + hoeffding_file_name):
+            print('Error. El directorio no tiene el estado de un árbol de Hoeffding. Especificar un directorio que haya '
+                  'sido creado con el modo Entrenar y la opción --incremental.\n')
+            print(uso_actualizar)
+            exit()
+        instances_file = arguments[4]
+        if not os.path.isfile(instances_file):
+            print('Error. No existe el archivo de instancias especificado.\n')
+            print(uso_actualizar)
+            exit()
+        batch_rows = 1000
+        if 'lote' in options:
+            if not options['lote'].isdigit() or int(options['lote']) < 1:
+                print('Error. Tamaño de lote incorrecto. Debe ser un entero positivo\n')
+                print(uso_actualizar)
+                exit()
+            batch_rows = int(options['lote'])
+
+        print('Cargando el estado del aprendiz de {file}\n'.format(file=directory + '/' + hoeffding_file_name))
+        try:
+            learner = Hoeffding.HoeffdingTree.load(directory + '/' + hoeffding_file_name,
+                                                   Data.Data(dataset_name, instances=False))
+        except ValueError:
+            print('Error. El árbol de Hoeffding del directorio no es del dataset {name}.\n'.format(name=dataset_name))
+            exit()
+        amount_before = learner.amount_instances
+        print('Aprendiendo de las instancias de {file} en lotes de {rows} instancias\n'
+              .format(file=instances_file, rows=batch_rows))
+        for features, labels in Data.read_chunks(dataset_name, instances_file, max(batch_rows, 65536)):
+            for start in range(0, len(labels), batch_rows):
+                learner.learn(features[start:start + batch_rows], labels[start:start + batch_rows])
+        print('{new} instancias nuevas, {total} en total\n'
+              .format(new=learner.amount_instances - amount_before, total=learner.amount_instances))
+        print(save_incremental_model(learner, directory, dataset_name))
+        exit()
     else:
-        print('Error. Modo de uso inválido. Los posibles modos de uso son Entrenar y Evaluar\n')
-        print(uso_general + uso_entrenar + uso_evaluar + uso_evaluar_aleatorio)
+        print('Error. Modo de uso inválido. Los posibles modos de uso son Entrenar, Evaluar, EvaluarAleatorio, Servir,\n'
+              ' CrossValidar y Actualizar\n')
+        print(uso_general + uso_entrenar + uso_evaluar + uso_evaluar_aleatorio + uso_servir +
+              uso_cross_validar + uso_actualizar)
         exit()
@@ -0,0 +1,304 @@
+'''
+Out of core training module
+
+This module's responsibility is to train a decision tree (as ID3.ID3 with
+histograms) from instances that do not fit in memory. The instances are read
+from disk in blocks (see Data.read_chunks) and the tree is grown one level
+at a time: a pass over the file routes each instance through the tree built
+so far and adds it to the bucket x class histograms of the attributes of its
+open node; the splits of all the open nodes of the level are then chosen
+from their histograms. The memory used is proportional to the amount of
+open nodes x attributes x buckets x classes, whatever the amount of
+instances.
+'''
+
+import Data
+import ID3
+import numpy
+import random
+from treelib import Tree
+from Utils import histogram_cutting_point, information_gain
+from Utils import quantile_bin_edges, weighted_random
+
+# Buckets of the continuous attributes if histogram_bins is not given
+default_bins = 256
+
+
+'''
+Reads file_path once and returns a tuple (edges, class_counts): the quantile
+bucket edges of each continuous attribute (see Utils.quantile_bin_edges),
+computed over a uniform random sample of at most sample_rows instances, and
+the amount of instances of each class.
+'''
+
+
+def __sample_pass(chunks, data, amount_bins, sample_rows, generator):
+    continuous = [attribute for attribute in data.attributes
+                  if data.splitable_attribute(attribute)]
+    class_counts = numpy.zeros(len(data.classes), dtype=numpy.int64)
+    keys = numpy.zeros(0)
+    sample = numpy.zeros((0, len(continuous)))
+    for features, labels in chunks:
+        class_counts += numpy.bincount(labels, minlength=len(data.classes))
+        # The sample keeps the instances with the smallest random keys
+        keys = numpy.concatenate([keys, generator.random(len(labels))])
+        sample = numpy.concatenate([sample, features[:, continuous]])
+        if len(keys) > sample_rows:
+            kept = numpy.argpartition(keys, sample_rows)[:sample_rows]
+            keys = keys[kept]
+            sample = sample[kept]
+    edges = {}
+    for position, attribute in enumerate(continuous):
+        edges[attribute] = quantile_bin_edges(sample[:, position],
+                                              amount_bins)
+    return edges, class_counts
+
+
+'''
+Returns the node of each row of features (its position in the arrays of
+nodes) after routing it through the internal nodes, or -1 if the value of an
+attribute has no branch. nodes is a dictionary of arrays indexed by node:
+'feature' (the attribute of the node, or -1 if it is not internal),
+'threshold' (its cutting value, NaN for discrete attributes), 'offset' (the
+position of its first child) and 'count' (its amount of children).
+'''
+
+
+def route_rows(nodes, features):
+    positions = numpy.zeros(len(features), dtype=numpy.intp)
+    while True:
+        rows = numpy.flatnonzero(positions >= 0)
+        rows = rows[nodes['feature'][positions[rows]] >= 0]
+        if len(rows) == 0:
+            return positions
+        current = positions[rows]
+        attributes = nodes['feature'][current]
+        values = features[rows, attributes]
+        thresholds = nodes['threshold'][current]
+        continuous = ~numpy.isnan(thresholds)
+        values = numpy.where(continuous, values > thresholds, values)
+        values = values.astype(numpy.intp)
+        valid = (values >= 0) & (values < nodes['count'][current])
+        positions[rows] = numpy.where(valid,
+                                      nodes['offset'][current] + values, -1)
+
+
+'''
+Reads the instances once and returns, for each attribute, an array with the
+bucket (or value) x class histogram of each open node, indexed by the
+position of the node in the open ones.
+'''
+
+
+def __count_pass(chunks, data, edges, nodes, amount_open):
+    amount_classes = len(data.classes)
+    histograms = {}
+    for attribute in data.attributes:
+        if attribute in edges:
+            amount_buckets = len(edges[attribute]) + 1
+        else:
+            amount_buckets = len(data.attribute_values[attribute])
+        histograms[attribute] = numpy.zeros(
+            (amount_open, amount_buckets, amount_classes), dtype=numpy.int64)
+    for features, labels in chunks:
+        positions = route_rows(nodes, features)
+        open_positions = numpy.where(positions >= 0,
+                                     nodes['open'][positions], -1)
+        rows = numpy.flatnonzero(open_positions >= 0)
+        if len(rows) == 0:
+            continue
+        open_positions = open_positions[rows]
+        labels = labels[rows].astype(numpy.intp)
+        for attribute, histogram in histograms.items():
+            column = features[rows, attribute]
+            if attribute in edges:
+                codes = numpy.searchsorted(edges[attribute], column, 'left')
+            else:
+                codes = column.astype(numpy.intp)
+            amount_buckets = histogram.shape[1]
+            cells = ((open_positions * amount_buckets + codes) *
+                     amount_classes + labels)
+            histogram += numpy.bincount(
+                cells, minlength=histogram.size).reshape(histogram.shape)
+    return histograms
+
+
+'''
+Returns the class label of node if it must be a leaf, or None if it can be
+split, with the same rules as ID3 (see ID3.__leaf_class).
+'''
+
+
+def __leaf_class(node, data, options, global_distribution):
+    total = int(node['counts'].sum())
+    if total == 0:
+        return weighted_random(data.classes, global_distribution)
+    if numpy.count_nonzero(node['counts']) == 1:
+        return data.classes[int(numpy.flatnonzero(node['counts'])[0])]
+    if (len(node['attributes']) == 0 or
+            (options['max_depth'] is not None and
+             node['depth'] >= options['max_depth']) or
+            total < options['min_rows']):
+        return weighted_random(data.classes, __distribution(node, data))
+    return None
+
+
+def __distribution(node, data):
+    total = max(int(node['counts'].sum()), 1)
+    return {data.classes[i]: int(node['counts'][i]) / total
+            for i in range(len(data.classes))}
+
+
+'''
+Chooses the attribute to split node with from its histograms, as
+ID3.__best_split: the one with the largest information gain, at random among
+the tied ones. The continuous attributes are cut at the best bucket edge.
+Returns a tuple (attribute, cutting_value, profit, children_counts), where
+children_counts has the class counts of each branch, or None if no
+attribute can be split.
+'''
+
+
+def __best_split(node, histograms, edges, data):
+    candidates = {}
+    for attribute in node['attributes']:
+        histogram = histograms[attribute][node['open']]
+        if attribute in edges:
+            cutting_value, gain = histogram_cutting_point(histogram,
+                                                          edges[attribute])
+            if cutting_value is None:
+                continue
+            below = histogram[:numpy.searchsorted(edges[attribute],
+                                                  cutting_value) + 1].sum(0)
+            children_counts = [below, histogram.sum(axis=0) - below]
+        else:
+            cutting_value = None
+            gain = information_gain(histogram)
+            children_counts = list(histogram)
+        candidates[attribute] = (gain, cutting_value, children_counts)
+    if not candidates:
+        return None
+    best_profit = max(candidate[0] for candidate in candidates.values())
+    best_attribute = random.choice([attribute for attribute in candidates
+                                    if candidates[attribute][0] ==
+                                    best_profit])
+    gain, cutting_value, children_counts = candidates[best_attribute]
+    return best_attribute, cutting_value, gain, children_counts
+
+
+'''
+Trains a decision tree with the instances of the dataset dataset_name
+('iris' or 'covtype') in file_path (in any format of Data.read_chunks),
+reading them in blocks of chunk_rows instances: a first pass samples at
+most sample_rows instances to compute the quantile buckets of the continuous
+attributes, and each level of the tree takes another pass (see the module
+docstring).
+options are the training options of ID3.ID3. histogram_bins (by default
+default_bins), max_depth, min_rows and max_nodes are used as in it; the
+nodes are always expanded level by level ('breadth').
+seed is the seed of the sample (if None, it is drawn from random).
+Returns the same as ID3.ID3: a treelib tree whose nodes follow the
+identifiers and data of ID3 and the cutting values.
+'''
+
+
+def ID3_out_of_core(dataset_name, file_path, chunk_rows=65536,
+                    sample_rows=1000000, seed=None, **options):
+    options = ID3.training_options(options)
+    if seed is None:
+        seed = random.getrandbits(32)
+    data = Data.Data(dataset_name, instances=False)
+    amount_bins = options['histogram_bins'] or default_bins
+    edges, class_counts = __sample_pass(
+        Data.read_chunks(dataset_name, file_path, chunk_rows), data,
+        amount_bins, sample_rows, numpy.random.default_rng(seed))
+    total = max(int(class_counts.sum()), 1)
+    global_distribution = {data.classes[i]: int(class_counts[i]) / total
+                           for i in range(len(data.classes))}
+
+    tree = Tree()
+    cutting_values = {}
+    # Routing arrays of the nodes (see route_rows) and their descriptions
+    nodes = {'feature': [-1], 'threshold': [numpy.nan], 'offset': [0],
+             'count': [0], 'open': [-1]}
+    level = [{'position': 0, 'identifier': 'Attribute None = None,',
+              'parent': None, 'depth': 0, 'attributes': list(data.attributes),
+              'counts': class_counts}]
+    amount_nodes = 1
+    while level:
+        # Which nodes are leaves does not depend on random, so the
+        # histograms are only computed for the open ones
+        open_nodes = []
+        for node in level:
+            counts = node['counts']
+            if (counts.sum() == 0 or numpy.count_nonzero(counts) == 1 or
+                    len(node['attributes']) == 0 or
+                    (options['max_depth'] is not None and
+                     node['depth'] >= options['max_depth']) or
+                    counts.sum() < options['min_rows']):
+                continue
+            node['open'] = len(open_nodes)
+            nodes['open'][node['position']] = node['open']
+            open_nodes.append(node)
+        histograms = {}
+        if open_nodes:
+            arrays = {name: numpy.array(values)
+                      for name, values in nodes.items()}
+            histograms = __count_pass(
+                Data.read_chunks(dataset_name, file_path, chunk_rows), data,
+                edges, arrays, len(open_nodes))
+        next_level = []
+        for node in level:
+            nodes['open'][node['position']] = -1
+            label = __leaf_class(node, data, options, global_distribution)
+            split = None
+            if label is None:
+                split = __best_split(node, histograms, edges, data)
+            if split is not None:
+                attribute, cutting_value, gain, children_counts = split
+                values = data.attribute_values[attribute]
+                if (options['max_nodes'] is not None and
+                        amount_nodes + len(values) > options['max_nodes']):
+                    split = None
+                    label = weighted_random(data.classes,
+                                            __distribution(node, data))
+            elif label is None:
+                label = weighted_random(data.classes,
+                                        __distribution(node, data))
+            if split is None:
+                tree.create_node('Class {c},Instances {inst}'.format(
+                    c=label, inst=int(node['counts'].sum())),
+                    node['identifier'], node['parent'])
+                continue
+            tree.create_node('Attribute {attr}'.format(attr=attribute),
+                             node['identifier'], node['parent'],
+                             data={'profit': gain,
+                                   'cutting_value': cutting_value,
+                                   'instances': int(node['counts'].sum())})
+            if cutting_value is not None:
+                cutting_values[attribute] = cutting_value
+            position = node['position']
+            nodes['feature'][position] = attribute
+            nodes['threshold'][position] = (
+                numpy.nan if cutting_value is None else cutting_value)
+            nodes['offset'][position] = len(nodes['feature'])
+            nodes['count'][position] = len(values)
+            for i, value in enumerate(values):
+                nodes['feature'].append(-1)
+                nodes['threshold'].append(numpy.nan)
+                nodes['offset'].append(0)
+                nodes['count'].append(0)
+                nodes['open'].append(-1)
+                next_level.append({
+                    'position': len(nodes['feature']) - 1,
+                    'identifier': node['identifier'] +
+                    'Attribute {attr} = {val},'.format(attr=attribute,
+                                                      val=value),
+                    'parent': node['identifier'], 'depth': node['depth'] + 1,
+                    'attributes': [a for a in node['attributes']
+                                   if a != attribute],
+                    'counts': numpy.asarray(children_counts[i])
+                })
+                amount_nodes += 1
+        level = next_level
+    return tree, cutting_values
@@ -6,6 +6,15 @@ structure.
 '''
 
 import ast
+import numpy
+import os
+import Storage
+
+# Approximate amount of bytes of the raw file parsed at once
+chunk_bytes = 16 * 1024 * 1024
+
+# Columns of the one-hot blocks of covtype (wilderness area and soil type)
+covtype_one_hot_blocks = [(10, 14), (14, 54)]
 
 '''
 Reads data from the file in "file_route" and saves it as Python objects
@@ -46,16 +55,167 @@ def process_binary(lines_of_split_data):
     return result_list
 
 
+'''
+Reads the file in file_route in chunks of about chunk_bytes bytes, printing
+the progress. Yields lists with the non-empty lines of each chunk.
+'''
+
+
+def read_chunks(file_route):
+    total_bytes = max(os.path.getsize(file_route), 1)
+    read_bytes = 0
+    with open(file_route, 'r') as file_to_parse:
+        while True:
+            lines = file_to_parse.readlines(chunk_bytes)
+            if len(lines) == 0:
+                break
+            # The files are ASCII, so characters and bytes match
+            read_bytes += sum(len(line) for line in lines)
+            print('Parsing {file}: {pct:.0f}%'.format(
+                file=file_route, pct=min(100, 100 * read_bytes / total_bytes)))
+            yield [line for line in lines if line.strip()]
+
+
+'''
+Parses a chunk of lines of a comma separated file with amount_columns
+numeric columns followed by the class label.
+Returns a tuple (values, labels) with a 2-D float array and an array with
+the labels as they appear in the file.
+'''
+
+
+def __parse_chunk(lines, amount_columns, numeric_labels):
+    if numeric_labels:
+        values = numpy.loadtxt(lines, delimiter=',', ndmin=2)
+        return values[:, :amount_columns], values[:, amount_columns]
+    values = numpy.loadtxt(lines, delimiter=',', ndmin=2,
+                           usecols=range(amount_columns))
+    labels = numpy.array([line.rstrip().rsplit(',', 1)[1] for line in lines])
+    return values, labels
+
+
+'''
+Parses the comma separated file in file_route block by block and yields a
+tuple (features, labels) per block of lines: a 2-D float array with the
+attribute values and an array with the index (inside classes) of the class
+of each instance. The arguments are those of parse_data_fast.
+'''
+
+
+def __parse_blocks(file_route, amount_columns, classes, one_hot_blocks):
+    numeric_labels = not isinstance(classes[0], str)
+    one_hot_columns = set()
+    for start, stop in one_hot_blocks:
+        one_hot_columns.update(range(start, stop))
+    plain_columns = [i for i in range(amount_columns)
+                     if i not in one_hot_columns]
+    class_index = {c: i for i, c in enumerate(classes)}
+    first_line = 1
+    for lines in read_chunks(file_route):
+        values, labels = __parse_chunk(lines, amount_columns, numeric_labels)
+        features = numpy.empty((values.shape[0],
+                                len(plain_columns) + len(one_hot_blocks)))
+        features[:, :len(plain_columns)] = values[:, plain_columns]
+        for i, (start, stop) in enumerate(one_hot_blocks):
+            block = values[:, start:stop]
+            missing = numpy.flatnonzero(block.max(axis=1) != 1)
+            if len(missing) > 0:
+                raise ValueError(
+                    'Parser.parse_data_fast: line {line} of {file} has no 1 '
+                    'in columns {start} to {stop}'.format(
+                        line=first_line + missing[0], file=file_route,
+                        start=start, stop=stop - 1))
+            # Index of the first 1, as list.index(1) in process_binary
+            features[:, len(plain_columns) + i] = block.argmax(axis=1)
+        if numeric_labels:
+            labels = labels.astype(numpy.int64) - 1
+        # Encode the labels as indices inside classes
+        unique_labels, inverse = numpy.unique(labels, return_inverse=True)
+        codes = numpy.array(
+            [class_index[label] for label in unique_labels.tolist()],
+            dtype=Storage.label_dtype(len(classes)))
+        yield features, codes[inverse]
+        first_line += values.shape[0]
+    print('Finished parsing dataset file')
+
+
+'''
+Vectorized replacement of parse_data followed by process_binary.
+Parses the comma separated file in file_route in bulk and returns its
+instances as a Storage.ColumnarDataset.
+- 'amount_columns' is the number of attribute columns in the file (the
+class label is the last column).
+- 'classes' is the list of class labels. If they are numbers, the label in
+the file is the position of the class plus one (as in covtype.data).
+- 'one_hot_blocks' is a list of ranges (start, stop) of columns that hold a
+one-hot encoded attribute; each block is replaced by the index of its 1.
+'''
+
+
+def parse_data_fast(file_route, amount_columns, classes, one_hot_blocks=[]):
+    features_chunks = []
+    labels_chunks = []
+    for features, labels in __parse_blocks(file_route, amount_columns,
+                                           classes, one_hot_blocks):
+        features_chunks.append(features)
+        labels_chunks.append(labels)
+    features = Storage.compact_features(numpy.concatenate(features_chunks))
+    return Storage.ColumnarDataset(features, numpy.concatenate(labels_chunks),
+                                   list(classes))
+
+
+'''
+Parses the raw file raw_path of the dataset data_name ('iris' or 'covtype')
+and saves the preprocessed instances to binary_path in the binary format of
+Storage. A fingerprint of raw_path is recorded in the file, so that it is
+rebuilt when the raw file changes.
+The raw file is parsed twice, holding a single block of instances in memory
+at a time: the first pass counts the instances and picks the types of the
+attribute values (as Storage.compact_features), and the second one writes
+the blocks.
+'''
+
+
+def build_binary_data(data_name, raw_path, binary_path, classes):
+    if data_name == 'iris':
+        arguments = (raw_path, 4, classes, [])
+        attributes = 4
+    else:
+        arguments = (raw_path, 54, classes, covtype_one_hot_blocks)
+        attributes = 54 - sum(stop - start for start, stop
+                              in covtype_one_hot_blocks) + \
+            len(covtype_one_hot_blocks)
+    rows = 0
+    discrete = numpy.ones(attributes, dtype=bool)
+    int32 = numpy.iinfo(numpy.int32)
+    in_range = True
+    for features, _ in __parse_blocks(*arguments):
+        rows += features.shape[0]
+        discrete &= Storage.integral_columns(features)
+        if features.size > 0:
+            in_range = (in_range and features.min() >= int32.min and
+                        features.max() <= int32.max)
+    if rows > 0 and discrete.all() and in_range:
+        features_dtype = numpy.dtype(numpy.int32)
+    else:
+        features_dtype = numpy.dtype(numpy.float64)
+    schema = {
+        'data_name': data_name,
+        'attributes': attributes,
+        'features_dtype': features_dtype.str,
+        'labels_dtype': numpy.dtype(Storage.label_dtype(len(classes))).str,
+        'discrete': [bool(d) for d in discrete],
+        'classes': list(classes)
+    }
+    print('Saving preprocessed instances to {file}'.format(file=binary_path))
+    Storage.save_dataset_chunks(__parse_blocks(*arguments), binary_path, rows,
+                                schema, raw_path)
+
+
 if __name__ == "__main__":
-    with open("processed_data_iris.txt", "w") as outfile:
-        parsed_data = parse_data(
-            'iris/iris.data', 4,
-            ['Iris-setosa', 'Iris-versicolor', 'Iris-virginica'])
-        for line in parsed_data:
-            outfile.write(str(line) + '\n')
-
-    with open("processed_data_covtype.txt", "w") as outfile:
-        parsed_data = parse_data('covtype/covtype.data', 10, list(range(7)))
-        parsed_data = process_binary(parsed_data)
-        for line in parsed_data:
-            outfile.write(str(line) + '\n')
+    build_binary_data(
+        'iris', 'iris/iris.data', 'processed_data_iris.bin',
+        ['Iris-setosa', 'Iris-versicolor', 'Iris-virginica'])
+    build_binary_data(
+        'covtype', 'covtype/covtype.data', 'processed_data_covtype.bin',
+        list(range(7)))
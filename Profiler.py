@@ -0,0 +1,196 @@
+'''
+Profiler module
+
+This module's responsibility is to record where the training of the trees
+spends its time and memory. An instance of Profiler is passed to ID3.ID3
+(option 'profiler'), which reports to it the phases of the work of each
+node: deciding if the node is a leaf, searching the cutting points of the
+continuous attributes, computing the profit of the attributes, creating the
+nodes of the treelib tree, projecting the instances on the children and
+computing their histograms.
+The measures are saved as a summary by depth, as the list of nodes with
+their counters and as folded stacks (one line per node path and phase with
+its microseconds), the input of flame graph tools such as flamegraph.pl or
+speedscope.
+'''
+
+import json
+import time
+import tracemalloc
+
+# Phases of the work of a node, in the order they happen
+phases = ['leaf_check', 'cutting_point', 'profit', 'scoring', 'tree_nodes',
+          'projection', 'histograms', 'children']
+
+
+class Profiler:
+    '''
+    Accumulates the seconds (and, if track_memory, the bytes allocated, as
+    traced by tracemalloc) of each phase of each node of the trees trained
+    while it is active. The time between two calls to record is attributed
+    to the phase given to the second one, for the current node (see enter).
+    Tracking the memory makes the training noticeably slower.
+    '''
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        self.nodes = {}
+        self.amount_trees = 0
+        self.__current = None
+        self.__last_time = None
+        self.__last_memory = 0
+
+    '''
+    Starts measuring (and tracing the memory allocations if track_memory).
+    '''
+    def start(self):
+        if self.track_memory:
+            tracemalloc.start()
+            self.__last_memory = tracemalloc.get_traced_memory()[0]
+        self.__last_time = time.perf_counter()
+
+    def stop(self):
+        if self.track_memory:
+            tracemalloc.stop()
+
+    '''
+    Called at the start of each tree: the nodes of the following records
+    belong to a new tree.
+    '''
+    def begin_tree(self):
+        self.amount_trees += 1
+        self.__current = None
+        self.__last_time = time.perf_counter()
+
+    '''
+    Makes node (an open node of ID3.__ID3) the current node, to which the
+    following records are attributed. Returns the previous current node.
+    '''
+    def enter(self, node):
+        previous = self.__current
+        self.__current = node
+        return previous
+
+    '''
+    Attributes the time (and allocated bytes) elapsed since the previous
+    record to phase of the current node, adding attributes to the amount of
+    attributes scored in it.
+    '''
+    def record(self, phase, attributes=0):
+        now = time.perf_counter()
+        seconds = now - self.__last_time
+        self.__last_time = now
+        allocated = 0
+        if self.track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # Largest amount of memory allocated at once during the phase
+            allocated = max(peak - self.__last_memory, 0)
+            tracemalloc.reset_peak()
+            self.__last_memory = current
+        if self.__current is None:
+            return
+        key = (self.amount_trees, self.__current['identifier'])
+        statistics = self.nodes.get(key)
+        if statistics is None:
+            statistics = {
+                'tree': self.amount_trees - 1,
+                'identifier': self.__current['identifier'],
+                'depth': self.__current['depth'],
+                'rows': len(self.__current['data'].dataset),
+                'attributes_scored': 0,
+                'seconds': {}, 'allocated': {}
+            }
+            self.nodes[key] = statistics
+        statistics['attributes_scored'] += attributes
+        statistics['seconds'][phase] = (
+            statistics['seconds'].get(phase, 0) + seconds)
+        statistics['allocated'][phase] = max(
+            statistics['allocated'].get(phase, 0), allocated)
+        # The time spent recording is left out of the next phase
+        self.__last_time = time.perf_counter()
+
+    '''
+    Returns a list with the summary of each depth of the trees: the amount
+    of nodes, rows and attributes scored, the seconds of each phase and the
+    most bytes allocated at once in each phase.
+    '''
+    def depth_summary(self):
+        depths = {}
+        for statistics in self.nodes.values():
+            summary = depths.setdefault(statistics['depth'], {
+                'depth': statistics['depth'], 'nodes': 0, 'rows': 0,
+                'attributes_scored': 0,
+                'seconds': {phase: 0 for phase in phases},
+                'allocated': {phase: 0 for phase in phases}
+            })
+            summary['nodes'] += 1
+            summary['rows'] += statistics['rows']
+            summary['attributes_scored'] += statistics['attributes_scored']
+            for phase, seconds in statistics['seconds'].items():
+                summary['seconds'][phase] += seconds
+            for phase, allocated in statistics['allocated'].items():
+                summary['allocated'][phase] = max(
+                    summary['allocated'][phase], allocated)
+        return [depths[depth] for depth in sorted(depths)]
+
+    '''
+    Saves the summary by depth (see depth_summary) to file_path as a text
+    table, with the total seconds of each phase at the end.
+    '''
+    def save_summary(self, file_path):
+        summary = self.depth_summary()
+        spaces = 14
+        cell = '%{s}s'.format(s=spaces)
+        columns = ['depth', 'nodes', 'rows', 'attributes'] + phases
+        lines = ['Seconds by depth and phase\n',
+                 ''.join(cell % column for column in columns) + '\n']
+        totals = {phase: 0 for phase in phases}
+        for level in summary:
+            values = [level['depth'], level['nodes'], level['rows'],
+                      level['attributes_scored']]
+            values += ['%.4f' % level['seconds'][phase] for phase in phases]
+            lines.append(''.join(cell % value for value in values) + '\n')
+            for phase in phases:
+                totals[phase] += level['seconds'][phase]
+        values = ['total', '', '', ''] + ['%.4f' % totals[phase]
+                                          for phase in phases]
+        lines.append(''.join(cell % value for value in values) + '\n')
+        if self.track_memory:
+            lines.append('\nMost bytes allocated at once by depth and '
+                         'phase\n')
+            lines.append(''.join(cell % column for column
+                                 in ['depth'] + phases) + '\n')
+            for level in summary:
+                values = [level['depth']] + [level['allocated'][phase]
+                                             for phase in phases]
+                lines.append(''.join(cell % value for value in values) + '\n')
+        with open(file_path, 'w') as output:
+            output.write(''.join(lines))
+
+    '''
+    Saves the counters of every node to file_path as json.
+    '''
+    def save_nodes(self, file_path):
+        with open(file_path, 'w') as output:
+            json.dump(list(self.nodes.values()), output, indent=4)
+
+    '''
+    Saves the measures to file_path as folded stacks: a line per node and
+    phase with the path of the node from the root (one frame per branch)
+    followed by the phase and its microseconds.
+    '''
+    def save_folded(self, file_path):
+        lines = []
+        for statistics in self.nodes.values():
+            frames = ['ID3']
+            if self.amount_trees > 1:
+                frames.append('Tree {t}'.format(t=statistics['tree']))
+            frames += [frame.strip() for frame
+                       in statistics['identifier'].split(',') if frame]
+            for phase in phases:
+                microseconds = round(
+                    statistics['seconds'].get(phase, 0) * 1e6)
+                if microseconds > 0:
+                    lines.append('{stack} {us}\n'.format(
+                        stack=';'.join(frames + [phase]), us=microseconds))
+        with open(file_path, 'w') as output:
+            output.write(''.join(lines))
@@ -0,0 +1,176 @@
+'''
+Server module
+
+This module's responsibility is to answer classification requests with a
+classifier loaded once, through an HTTP server listening on localhost.
+The instances of concurrent requests are grouped into micro-batches, so the
+trees route many instances at once (see Classifier.predict_matrix_tree and
+Classifier.predict_matrix_forest).
+
+Requests are POST /clasificar with a json body {"instancias": [...]} where
+each instance is a list with the values of the attributes of the dataset
+(as in the preprocessed dataset files, without the class). The answer is
+{"clases": [...]} with the class predicted for each instance.
+GET /estado answers with the amount of requests, instances and batches
+served so far.
+'''
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import numpy
+import queue
+import threading
+import time
+
+
+class MicroBatcher:
+    '''
+    Groups the instances submitted by concurrent threads into batches for
+    predict, a function that receives a 2-D array of instances and returns
+    a sequence with the prediction of each row.
+    A batch is closed when it has max_batch instances or max_delay seconds
+    after its first request arrived, whichever happens first.
+    '''
+    def __init__(self, predict, max_batch, max_delay):
+        self.predict = predict
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.requests = queue.Queue()
+        self.amount_requests = 0
+        self.amount_instances = 0
+        self.amount_batches = 0
+        thread = threading.Thread(target=self.__run, daemon=True)
+        thread.start()
+
+    '''
+    Predicts the instances in rows (a 2-D array) in the next batch, blocking
+    until it is done. Returns the list of predictions of the rows, or raises
+    the exception raised by predict for them.
+    '''
+    def submit(self, rows):
+        request = {'rows': rows, 'done': threading.Event(), 'result': None,
+                   'error': None}
+        self.requests.put(request)
+        request['done'].wait()
+        if request['error'] is not None:
+            raise request['error']
+        return request['result']
+
+    def __run(self):
+        while True:
+            batch = [self.requests.get()]
+            amount = len(batch[0]['rows'])
+            deadline = time.monotonic() + self.max_delay
+            while amount < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                amount += len(request['rows'])
+            self.__answer(batch)
+
+    '''
+    Predicts the instances of the requests of batch together. If predict
+    fails, the requests are predicted one by one, so the error only reaches
+    the requests whose instances cause it.
+    '''
+    def __answer(self, batch):
+        try:
+            matrix = numpy.concatenate([request['rows'] for request in batch])
+            predictions = list(self.predict(matrix))
+        except Exception as error:
+            if len(batch) > 1:
+                for request in batch:
+                    self.__answer([request])
+                return
+            batch[0]['error'] = error
+            batch[0]['done'].set()
+            return
+        self.amount_requests += len(batch)
+        self.amount_instances += len(predictions)
+        self.amount_batches += 1
+        start = 0
+        for request in batch:
+            end = start + len(request['rows'])
+            request['result'] = predictions[start:end]
+            start = end
+            request['done'].set()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    '''
+    Handler of the requests of the server. The server has the attributes
+    batcher (a MicroBatcher) and amount_attributes (the amount of values of
+    each instance).
+    '''
+    def do_POST(self):
+        if self.path != '/clasificar':
+            self.__reply(404, {'error': 'ruta desconocida'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length).decode('utf-8'))
+            rows = numpy.array(body['instancias'], dtype=numpy.float64)
+        except (ValueError, KeyError, TypeError):
+            self.__reply(400, {'error': 'cuerpo json inválido'})
+            return
+        if rows.size == 0 and rows.ndim == 1:
+            # No instances: nothing to classify
+            self.__reply(200, {'clases': []})
+            return
+        if rows.ndim != 2 or rows.shape[1] != self.server.amount_attributes:
+            self.__reply(400, {
+                'error': 'cada instancia debe tener {n} valores'.format(
+                    n=self.server.amount_attributes)})
+            return
+        if not numpy.isfinite(rows).all():
+            self.__reply(400, {'error': 'los valores de las instancias deben '
+                                        'ser números finitos'})
+            return
+        try:
+            classes = self.server.batcher.submit(rows)
+        except Exception as error:
+            self.__reply(500, {
+                'error': 'no se pudo clasificar: {e}'.format(e=error)})
+            return
+        self.__reply(200, {'clases': classes})
+
+    def do_GET(self):
+        if self.path != '/estado':
+            self.__reply(404, {'error': 'ruta desconocida'})
+            return
+        batcher = self.server.batcher
+        self.__reply(200, {'solicitudes': batcher.amount_requests,
+                           'instancias': batcher.amount_instances,
+                           'lotes': batcher.amount_batches})
+
+    def __reply(self, status, answer):
+        encoded = json.dumps(answer).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    # Requests are not logged one by one
+    def log_message(self, format, *args):
+        pass
+
+
+'''
+Creates the server for predict (see MicroBatcher) listening on localhost at
+port (0 for any free port). Each thread of the server handles a request.
+Returns the server; server.server_address has the port it listens at.
+'''
+
+
+def create_server(predict, amount_attributes, port, max_batch, max_delay):
+    server = ThreadingHTTPServer(('127.0.0.1', port), RequestHandler)
+    server.daemon_threads = True
+    server.batcher = MicroBatcher(predict, max_batch, max_delay)
+    server.amount_attributes = amount_attributes
+    return server
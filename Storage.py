@@ -0,0 +1,618 @@
+'''
+Storage module
+
+This module's responsibility is to hold the instances of a dataset in a
+columnar layout: a contiguous 2-D array with the attribute values of every
+instance and a separate vector with the class of each instance, encoded as
+the index of the class label inside the list of classes.
+'''
+import hashlib
+import json
+import numpy
+import os
+import struct
+
+# Number of rows converted to Python lists at once while iterating
+iteration_block_rows = 4096
+
+
+'''
+Returns the smallest numpy array able to hold the given attribute values
+exactly: int32 if all of them are integers (and fit), float64 otherwise.
+'''
+
+
+def compact_features(features):
+    features = numpy.asarray(features)
+    if features.size == 0:
+        return features.astype(numpy.float64).reshape(features.shape)
+    if numpy.issubdtype(features.dtype, numpy.integer) or numpy.all(
+            features == numpy.floor(features)):
+        int32 = numpy.iinfo(numpy.int32)
+        if features.min() >= int32.min and features.max() <= int32.max:
+            return numpy.ascontiguousarray(features, dtype=numpy.int32)
+    return numpy.ascontiguousarray(features, dtype=numpy.float64)
+
+
+'''
+Returns a boolean vector telling which columns of features only hold
+integer values (those are returned as int when the rows are materialized).
+'''
+
+
+def integral_columns(features):
+    if numpy.issubdtype(features.dtype, numpy.integer):
+        return numpy.ones(features.shape[1], dtype=bool)
+    return numpy.all(features == numpy.floor(features), axis=0)
+
+
+'''
+Returns the smallest integer dtype able to encode amount_classes labels.
+'''
+
+
+def label_dtype(amount_classes):
+    return numpy.uint8 if amount_classes <= 256 else numpy.int32
+
+
+class ColumnarDataset:
+    '''
+    features is a 2-D numpy array with one row per instance and one column
+    per attribute.
+    labels is a 1-D numpy array with the index (inside classes) of the class
+    of each instance.
+    classes is the list of class labels.
+    discrete is a boolean vector telling which columns must be returned as
+    int values when the instances are materialized as lists.
+    indices (optional) is an array with the rows of features and labels that
+    belong to this dataset. Datasets built with take, copy or partition are
+    views that share features and labels with the dataset they come from;
+    only their indices are new memory.
+    thresholds (optional) is a dictionary attribute -> list of cutting
+    values that split_column applied to the attribute. They are applied when
+    the column is read, so splitting never writes to the shared arrays.
+    binning (optional) is a dictionary with the quantile buckets built by
+    build_bins, shared by all the views: 'edges' maps each binned attribute
+    to its bucket edges and 'codes' is a 2-D array with the bucket of every
+    row of features for each binned attribute.
+    Indexing or iterating a ColumnarDataset yields the instances as lists
+    (attribute values followed by the class label), just like the
+    list-of-lists storage of Data, so code written for that storage keeps
+    working on top of this one.
+    '''
+    def __init__(self, features, labels, classes, discrete=None,
+                 indices=None, thresholds=None, binning=None):
+        self.features = features
+        self.labels = labels
+        self.classes = classes
+        if discrete is None:
+            discrete = integral_columns(features)
+        self.discrete = discrete
+        self.indices = indices
+        self.thresholds = thresholds if thresholds is not None else {}
+        self.binning = binning
+
+    '''
+    Builds a ColumnarDataset from a list of instances (lists with the
+    attribute values followed by the class label).
+    '''
+    @staticmethod
+    def from_rows(rows, classes):
+        class_index = {c: i for i, c in enumerate(classes)}
+        amount_attributes = len(rows[0]) - 1 if len(rows) > 0 else 0
+        features = compact_features(
+            [row[:-1] for row in rows]).reshape(len(rows), amount_attributes)
+        labels = numpy.fromiter(
+            (class_index[row[-1]] for row in rows),
+            dtype=label_dtype(len(classes)), count=len(rows))
+        return ColumnarDataset(features, labels, list(classes))
+
+    def __len__(self):
+        if self.indices is None:
+            return self.features.shape[0]
+        return len(self.indices)
+
+    '''
+    Returns the rows of the shared arrays selected by the positions
+    (a slice, boolean mask or array of indices relative to this dataset).
+    '''
+    def __base_rows(self, positions):
+        if self.indices is None:
+            return positions
+        return self.indices[positions]
+
+    '''
+    Applies the thresholds of the attribute to its values.
+    '''
+    def __apply_thresholds(self, attribute, values):
+        for cutting_value in self.thresholds.get(attribute, []):
+            values = (values > cutting_value).astype(numpy.int8)
+        return values
+
+    '''
+    Returns the attribute values of the instances in positions (all of them
+    by default) as a 2-D array, with the thresholds applied.
+    '''
+    def feature_matrix(self, positions=slice(None)):
+        features = self.features[self.__base_rows(positions)]
+        if len(self.thresholds) > 0:
+            features = features.copy()
+            for attribute in self.thresholds:
+                features[:, attribute] = self.__apply_thresholds(
+                    attribute, features[:, attribute])
+        return features
+
+    '''
+    Returns the class indices of the instances in positions (all of them by
+    default).
+    '''
+    def label_vector(self, positions=slice(None)):
+        return self.labels[self.__base_rows(positions)]
+
+    '''
+    Converts a block of feature rows and labels into instances as lists.
+    '''
+    def __rows(self, features, labels):
+        rows = features.tolist()
+        if not numpy.issubdtype(features.dtype, numpy.integer):
+            discrete_columns = numpy.flatnonzero(self.discrete).tolist()
+            for row in rows:
+                for column in discrete_columns:
+                    row[column] = int(row[column])
+        for row, label in zip(rows, labels.tolist()):
+            row.append(self.classes[label])
+        return rows
+
+    def __getitem__(self, index):
+        positions = slice(index, index + 1 or None)
+        return self.__rows(self.feature_matrix(positions),
+                           self.label_vector(positions))[0]
+
+    def __iter__(self):
+        for start in range(0, len(self), iteration_block_rows):
+            positions = slice(start, start + iteration_block_rows)
+            for row in self.__rows(self.feature_matrix(positions),
+                                   self.label_vector(positions)):
+                yield row
+
+    '''
+    Returns the values of the attribute for every instance.
+    '''
+    def column(self, attribute):
+        if self.indices is None:
+            values = self.features[:, attribute]
+        else:
+            values = self.features[self.indices, attribute]
+        return self.__apply_thresholds(attribute, values)
+
+    '''
+    Returns the amount of instances of each class (in the order of classes).
+    '''
+    def class_counts(self):
+        return numpy.bincount(self.label_vector(),
+                              minlength=len(self.classes))
+
+    '''
+    Makes the values of the attribute 0 for the instances with value less
+    than or equal to cutting_value and 1 for the rest of them. The shared
+    arrays are not modified: the cutting value is recorded and applied when
+    the column is read.
+    '''
+    def split_column(self, attribute, cutting_value):
+        self.thresholds = dict(self.thresholds)
+        self.thresholds[attribute] = (
+            self.thresholds.get(attribute, []) + [cutting_value])
+        self.discrete = self.discrete.copy()
+        self.discrete[attribute] = True
+
+    '''
+    Returns a view with the instances selected by selection (a boolean mask
+    or an array of indices relative to this dataset).
+    '''
+    def take(self, selection):
+        selection = numpy.asarray(selection)
+        if selection.dtype == bool:
+            selection = numpy.flatnonzero(selection)
+        return ColumnarDataset(self.features, self.labels, self.classes,
+                               self.discrete, self.__base_rows(selection),
+                               self.thresholds, self.binning)
+
+    '''
+    Partitions the instances by the value of the attribute in a single
+    stable sort of the column.
+    Returns a dictionary value -> view with the instances having that value
+    (for each value in values).
+    '''
+    def partition(self, attribute, values):
+        column = self.column(attribute)
+        if (numpy.issubdtype(column.dtype, numpy.integer) and
+                len(column) > 0 and column.min() >= 0 and
+                column.max() <= numpy.iinfo(numpy.uint16).max):
+            # Small non-negative integers are radix sorted in linear time
+            column = column.astype(numpy.uint16)
+        order = numpy.argsort(column, kind='stable')
+        sorted_column = column[order]
+        partitions = {}
+        for value in values:
+            start = numpy.searchsorted(sorted_column, value, 'left')
+            stop = numpy.searchsorted(sorted_column, value, 'right')
+            partitions[value] = self.take(order[start:stop])
+        return partitions
+
+    '''
+    Returns a view of the same instances, where the class is 1 for the
+    instances labeled with label and 0 for the rest of them. Only the
+    labels vector is new memory.
+    '''
+    def one_versus_rest(self, label):
+        matches = self.labels == self.classes.index(label)
+        labels = numpy.where(matches, 0, 1).astype(label_dtype(2))
+        return ColumnarDataset(self.features, labels, [1, 0], self.discrete,
+                               self.indices, self.thresholds, self.binning)
+
+    '''
+    Returns a view of the same instances. Since views never write to the
+    shared arrays, it behaves as an independent copy.
+    '''
+    def copy(self):
+        return ColumnarDataset(self.features, self.labels, self.classes,
+                               self.discrete, self.indices, self.thresholds,
+                               self.binning)
+
+    '''
+    Returns a dataset with the instances of this one that owns its arrays:
+    the rows of the view are gathered and the thresholds applied, so the
+    positions of the instances are the indices of the new arrays.
+    '''
+    def compacted(self):
+        return ColumnarDataset(self.feature_matrix(), self.label_vector(),
+                               self.classes, self.discrete.copy())
+
+    '''
+    Computes the bucket of each instance for the attributes in edges (a
+    dictionary attribute -> sorted array of bucket edges, see
+    Utils.quantile_bin_edges): the bucket of a value is the amount of edges
+    lower than it. The buckets are shared by the views later built from this
+    dataset.
+    '''
+    def build_bins(self, edges):
+        codes = numpy.zeros((self.features.shape[0], self.features.shape[1]),
+                            dtype=numpy.uint16)
+        rows = self.__base_rows(slice(None))
+        for attribute in edges:
+            if len(edges[attribute]) >= numpy.iinfo(numpy.uint16).max:
+                raise ValueError('Storage.build_bins: too many buckets')
+            codes[rows, attribute] = numpy.searchsorted(
+                edges[attribute], self.column(attribute), 'left')
+        self.binning = {'codes': codes, 'edges': edges}
+
+    '''
+    Returns a tuple (codes, amount_buckets) with the bucket of each instance
+    for the attribute, or None if the attribute has no buckets.
+    '''
+    def binned_column(self, attribute):
+        if self.binning is None or attribute not in self.binning['edges']:
+            return None
+        codes = self.binning['codes'][self.__base_rows(slice(None)),
+                                      attribute]
+        return codes, len(self.binning['edges'][attribute]) + 1
+
+    '''
+    Returns the bucket edges of the attribute (see build_bins).
+    '''
+    def bin_edges(self, attribute):
+        return self.binning['edges'][attribute]
+
+
+'''
+Binary format of the preprocessed datasets.
+
+A file starts with the magic bytes, the format version and the length of a
+JSON header (both as little-endian uint32). The header records the schema
+(amount of rows and attributes, dtypes, discrete columns), the class
+encoding (the list of class labels; labels are stored as indices inside it),
+a fingerprint of the source file the instances were parsed from and the
+offsets of the arrays. The features matrix and the labels vector follow,
+each one aligned to alignment bytes, so they can be memory-mapped directly.
+'''
+magic = b'AA19DATA'
+format_version = 1
+alignment = 64
+
+
+def __aligned(offset):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+'''
+Returns a dictionary with the size, modification time and SHA-256 digest of
+the file in file_path, used to detect stale binary files.
+'''
+
+
+def source_fingerprint(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as source_file:
+        for block in iter(lambda: source_file.read(1 << 20), b''):
+            digest.update(block)
+    status = os.stat(file_path)
+    return {'path': file_path, 'size': status.st_size,
+            'mtime': status.st_mtime, 'sha256': digest.hexdigest()}
+
+
+'''
+Saves the ColumnarDataset to file_path in the binary format.
+data_name is the name of the dataset ('iris' or 'covtype') and source_path
+(optional) the file the instances were parsed from.
+'''
+
+
+def save_dataset(dataset, file_path, data_name, source_path=None):
+    features = numpy.ascontiguousarray(dataset.feature_matrix())
+    labels = numpy.ascontiguousarray(dataset.label_vector())
+    header = {
+        'data_name': data_name,
+        'rows': features.shape[0],
+        'attributes': features.shape[1],
+        'features_dtype': features.dtype.str,
+        'labels_dtype': labels.dtype.str,
+        'discrete': [bool(d) for d in dataset.discrete],
+        'classes': list(dataset.classes),
+        'source': (source_fingerprint(source_path)
+                   if source_path is not None else None)
+    }
+    encoded_header = __layout(header, features.nbytes)
+    # Write to a temporary file first so readers never see a partial file
+    temporary_path = file_path + '.tmp'
+    with open(temporary_path, 'wb') as binary_file:
+        __write_header(binary_file, encoded_header, header['features_offset'])
+        binary_file.write(features.tobytes())
+        binary_file.write(b'\0' * (header['labels_offset'] -
+                                    binary_file.tell()))
+        binary_file.write(labels.tobytes())
+    os.replace(temporary_path, file_path)
+
+
+'''
+Sets the offsets of the arrays in header for a features matrix of
+features_bytes bytes. Returns the encoded header.
+'''
+
+
+def __layout(header, features_bytes):
+    # The offsets depend on the header length, which depends on the offsets
+    header['features_offset'] = 0
+    header['labels_offset'] = 0
+    while True:
+        encoded_header = json.dumps(header).encode('utf-8')
+        features_offset = __aligned(
+            len(magic) + 8 + len(encoded_header))
+        labels_offset = __aligned(features_offset + features_bytes)
+        if (header['features_offset'] == features_offset and
+                header['labels_offset'] == labels_offset):
+            return encoded_header
+        header['features_offset'] = features_offset
+        header['labels_offset'] = labels_offset
+
+
+def __write_header(binary_file, encoded_header, features_offset):
+    binary_file.write(magic)
+    binary_file.write(struct.pack('<II', format_version, len(encoded_header)))
+    binary_file.write(encoded_header)
+    binary_file.write(b'\0' * (features_offset - binary_file.tell()))
+
+
+'''
+Saves the instances yielded by chunks (tuples (features, labels) as
+read_chunks) to file_path in the binary format, holding a single block in
+memory at a time. rows is the total amount of instances of the blocks and
+schema the header of a binary file with the same attributes and classes
+(see read_header), from which the schema is copied. source_path (optional)
+is the file the instances were parsed from.
+'''
+
+
+def save_dataset_chunks(chunks, file_path, rows, schema, source_path=None):
+    header = {name: schema[name] for name
+              in ['data_name', 'attributes', 'features_dtype', 'labels_dtype',
+                  'discrete', 'classes']}
+    header['rows'] = rows
+    header['source'] = (source_fingerprint(source_path)
+                        if source_path is not None else None)
+    features_dtype = numpy.dtype(header['features_dtype'])
+    labels_dtype = numpy.dtype(header['labels_dtype'])
+    encoded_header = __layout(
+        header, rows * header['attributes'] * features_dtype.itemsize)
+    temporary_path = file_path + '.tmp'
+    written = 0
+    with open(temporary_path, 'wb') as binary_file:
+        __write_header(binary_file, encoded_header, header['features_offset'])
+        # Reserve the whole file, so the blocks can be written in place
+        binary_file.truncate(header['labels_offset'] +
+                             rows * labels_dtype.itemsize)
+        for features, labels in chunks:
+            if written + len(labels) > rows:
+                raise ValueError('Storage.save_dataset_chunks: more than '
+                                 '{rows} instances'.format(rows=rows))
+            binary_file.seek(header['features_offset'] + written *
+                             header['attributes'] * features_dtype.itemsize)
+            binary_file.write(numpy.ascontiguousarray(
+                features, dtype=features_dtype).tobytes())
+            binary_file.seek(header['labels_offset'] +
+                             written * labels_dtype.itemsize)
+            binary_file.write(numpy.ascontiguousarray(
+                labels, dtype=labels_dtype).tobytes())
+            written += len(labels)
+    if written != rows:
+        os.remove(temporary_path)
+        raise ValueError('Storage.save_dataset_chunks: {written} instances '
+                         'instead of {rows}'.format(written=written, rows=rows))
+    os.replace(temporary_path, file_path)
+
+
+'''
+Reads the header of the binary file in file_path.
+Returns the header as a dictionary, or None if the file is not a binary
+file with the given magic bytes and version (by default, a dataset file of
+the current format version).
+'''
+
+
+def read_header(file_path, file_magic=magic, version=format_version):
+    with open(file_path, 'rb') as binary_file:
+        if binary_file.read(len(file_magic)) != file_magic:
+            return None
+        file_version, header_length = struct.unpack('<II',
+                                                    binary_file.read(8))
+        if file_version != version:
+            return None
+        return json.loads(binary_file.read(header_length).decode('utf-8'))
+
+
+def __map_array(file_path, dtype, offset, shape):
+    if 0 in shape:
+        return numpy.zeros(shape, dtype=dtype)
+    # Copy-on-write: pages are shared between processes until written.
+    # A plain ndarray view avoids the overhead of memmap on every slice.
+    return numpy.memmap(file_path, dtype=dtype, mode='c', offset=offset,
+                        shape=shape).view(numpy.ndarray)
+
+
+'''
+Loads the ColumnarDataset saved in file_path by memory-mapping its arrays.
+Returns a tuple (dataset, header).
+'''
+
+
+def load_dataset(file_path):
+    header = read_header(file_path)
+    if header is None:
+        raise ValueError(
+            'Storage.load_dataset: {file} is not a binary dataset file of '
+            'version {v}'.format(file=file_path, v=format_version))
+    rows, attributes = header['rows'], header['attributes']
+    features = __map_array(file_path, numpy.dtype(header['features_dtype']),
+                           header['features_offset'], (rows, attributes))
+    labels = __map_array(file_path, numpy.dtype(header['labels_dtype']),
+                         header['labels_offset'], (rows,))
+    dataset = ColumnarDataset(features, labels, header['classes'],
+                              numpy.array(header['discrete'], dtype=bool))
+    return dataset, header
+
+
+'''
+Reads the instances of the binary dataset file in file_path in blocks of
+chunk_rows instances, without memory-mapping the whole file.
+Yields tuples (features, labels) of arrays with the rows of each block.
+'''
+
+
+def read_chunks(file_path, chunk_rows):
+    header = read_header(file_path)
+    if header is None:
+        raise ValueError(
+            'Storage.read_chunks: {file} is not a binary dataset file of '
+            'version {v}'.format(file=file_path, v=format_version))
+    rows, attributes = header['rows'], header['attributes']
+    features_dtype = numpy.dtype(header['features_dtype'])
+    labels_dtype = numpy.dtype(header['labels_dtype'])
+    with open(file_path, 'rb') as binary_file:
+        for start in range(0, rows, chunk_rows):
+            amount = min(chunk_rows, rows - start)
+            binary_file.seek(header['features_offset'] +
+                             start * attributes * features_dtype.itemsize)
+            features = numpy.fromfile(binary_file, features_dtype,
+                                      amount * attributes)
+            binary_file.seek(header['labels_offset'] +
+                             start * labels_dtype.itemsize)
+            labels = numpy.fromfile(binary_file, labels_dtype, amount)
+            yield features.reshape(amount, attributes), labels
+
+
+'''
+Saves a set of arrays (a dictionary name -> numpy array) to file_path with
+the layout of the dataset files, but starting with file_magic and version:
+header (a dictionary) is extended with the dtype, shape and offset of each
+array under the key 'arrays'.
+'''
+
+
+def save_arrays(file_path, file_magic, version, header, arrays):
+    arrays = {name: numpy.ascontiguousarray(arrays[name]) for name in arrays}
+    header = dict(header)
+    header['arrays'] = {}
+    for name in arrays:
+        header['arrays'][name] = {'dtype': arrays[name].dtype.str,
+                                  'shape': list(arrays[name].shape),
+                                  'offset': 0}
+    # The offsets depend on the header length, which depends on the offsets
+    while True:
+        encoded_header = json.dumps(header).encode('utf-8')
+        offset = len(file_magic) + 8 + len(encoded_header)
+        changed = False
+        for name in arrays:
+            offset = __aligned(offset)
+            if header['arrays'][name]['offset'] != offset:
+                header['arrays'][name]['offset'] = offset
+                changed = True
+            offset += arrays[name].nbytes
+        if not changed:
+            break
+    temporary_path = file_path + '.tmp'
+    with open(temporary_path, 'wb') as binary_file:
+        binary_file.write(file_magic)
+        binary_file.write(struct.pack('<II', version, len(encoded_header)))
+        binary_file.write(encoded_header)
+        for name in arrays:
+            binary_file.write(b'\0' * (header['arrays'][name]['offset'] -
+                                       binary_file.tell()))
+            binary_file.write(arrays[name].tobytes())
+    os.replace(temporary_path, file_path)
+
+
+'''
+Loads a file written by save_arrays by memory-mapping its arrays.
+Returns a tuple (header, arrays) where arrays is a dictionary name -> array.
+Raises ValueError if file_path does not start with file_magic and version.
+'''
+
+
+def load_arrays(file_path, file_magic, version):
+    header = read_header(file_path, file_magic, version)
+    if header is None:
+        raise ValueError(
+            'Storage.load_arrays: {file} is not a binary file of version '
+            '{v}'.format(file=file_path, v=version))
+    arrays = {}
+    for name, layout in header['arrays'].items():
+        arrays[name] = __map_array(file_path, numpy.dtype(layout['dtype']),
+                                   layout['offset'], tuple(layout['shape']))
+    return header, arrays
+
+
+'''
+Returns True iff the binary file in file_path must be rebuilt from
+source_path: it does not exist, has another format version, belongs to
+another dataset or was built from a different version of the source file.
+The SHA-256 digest of the source is only computed when its size or
+modification time changed.
+'''
+
+
+def is_stale(file_path, source_path, data_name):
+    if not os.path.isfile(file_path):
+        return True
+    header = read_header(file_path)
+    if header is None or header['data_name'] != data_name:
+        return True
+    if not os.path.isfile(source_path):
+        # Nothing to rebuild it from
+        return False
+    recorded = header['source']
+    if recorded is None:
+        return True
+    status = os.stat(source_path)
+    if (status.st_size == recorded['size'] and
+            status.st_mtime == recorded['mtime']):
+        return False
+    return source_fingerprint(source_path)['sha256'] != recorded['sha256']
@@ -3,32 +3,88 @@ Module with utility functions used in more than one module.
 '''
 
 import math
+import numpy
+import os
 import random
+import resource
+import Storage
 
 
 '''
-Computes the entropy of a partition.
-Receives a dictionary with the proportions of each class.
-partitions is the proportion of elements in each class (is a list).
-Returns the entropy of such a partition.
+Computes the entropy of a partition from the amount of elements of each
+class (a list of counts) and the total amount of elements: the entropy of
+the proportions count/total.
 '''
 
 
-def __entropy(partitions):
-    __entropy = 0
-    for key in partitions:
-        if partitions[key] > 0:
-            __entropy -= partitions[key]*math.log2(partitions[key])
-        elif partitions[key] < 0:
-            return(
-                "Utils.__entropy: numbers in partitions must be non-negative")
-    return __entropy
+def __entropy_of_counts(counts, total):
+    entropy = 0
+    for count in counts:
+        if count > 0:
+            proportion = count/total
+            entropy -= proportion*math.log2(proportion)
+    return entropy
+
+
+'''
+Counts, in a single vectorized pass, the instances of each class for each
+value of an attribute.
+value_codes is an integer array with the position (between 0 and
+amount_values - 1) of the attribute value of each instance.
+labels is an integer array with the index of the class of each instance.
+Returns the contingency table as an array of shape
+(amount_values, amount_classes).
+'''
+
+
+def contingency_table(value_codes, labels, amount_values, amount_classes):
+    cells = (numpy.asarray(value_codes, dtype=numpy.intp) * amount_classes +
+             labels)
+    return numpy.bincount(
+        cells, minlength=amount_values*amount_classes).reshape(
+            amount_values, amount_classes)
+
+
+'''
+Computes the information gain of the partition described by a contingency
+table (one row per attribute value, one column per class).
+The arithmetic is the same as the one profit used to do instance by
+instance, so the results are identical.
+'''
+
+
+def information_gain(table):
+    rows = numpy.asarray(table).tolist()
+    total = sum(sum(row) for row in rows)
+    if total == 0:
+        return 0.0
+    class_totals = [sum(column) for column in zip(*rows)]
+    gain = __entropy_of_counts(class_totals, total)
+    for row in rows:
+        row_total = sum(row)
+        if row_total > 0:
+            gain -= row_total/total * __entropy_of_counts(row, row_total)
+    return gain
+
+
+'''
+Returns the position of each value of column inside values (which must hold
+every value appearing in column).
+'''
+
+
+def value_codes(column, values):
+    if list(values) == list(range(len(values))):
+        return column
+    sorted_values = numpy.sort(numpy.asarray(values))
+    return numpy.searchsorted(sorted_values, column)
 
 
 '''
 Compute the profit of splting the trainning set data across the attribute
 corresponding to the index i.
-data is a list of instances. Each instance is another list.
+data is a list of instances (each instance is another list) or a
+Storage.ColumnarDataset.
 index is a non-negative number representing the attribute (the index
 in the instance list).
 values is a list with two different meanings:
@@ -38,95 +94,142 @@ values is a list with two different meanings:
     for the attribute
 classes is a list with all the possible class values.
 Returns the information profit of such a partiton.
+The value x class contingency table is computed in one vectorized pass (see
+contingency_table) and the gain is derived from it.
 '''
 
 
 def profit(data, index, values, classes):
-    # For computing the proportions of each class inside data
-    proportions_of_data = {}
-
-    # In the if case we use this function to find the optimum splitting point
-    # for a numberical or continuous attribute (turning it into a discrete
-    # attribute).
+    if len(values) == 0:
+        return "Utils.profit: values must be non-empty"
+    if isinstance(data, Storage.ColumnarDataset):
+        column = data.column(index)
+        labels = data.label_vector()
+    else:
+        class_index = {c: i for i, c in enumerate(classes)}
+        column = numpy.array([instance[index] for instance in data])
+        labels = numpy.fromiter(
+            (class_index[instance[-1]] for instance in data),
+            dtype=numpy.intp, count=len(data))
     if len(values) == 1:
-        # count the number of instances with attribute value
-        # less or equal than values[0]
-        less = 0
-        # dictionaries with the proportions of each class inside the instances
-        # with attribute value <= than values[0] and > than values[0]
-        # (one dictionary for each group).
-        proportions_of_less = {}
-        proportions_of_greater = {}
-        for c in classes:
-            proportions_of_less[c] = 0.0
-            proportions_of_greater[c] = 0.0
-            proportions_of_data[c] = 0.0
-
-        for instance in data:
-            proportions_of_data[instance[-1]] += 1
-            if instance[index] <= values[0]:
-                less += 1
-                proportions_of_less[instance[-1]] += 1
-            else:
-                proportions_of_greater[instance[-1]] += 1
-
-        # divide the amount of instances of each class by the number of
-        # instances to get the proportions
-        if less > 0:
-            for key in proportions_of_less:
-                proportions_of_less[key] /= less
-        if less != len(data):
-            for key in proportions_of_greater:
-                proportions_of_greater[key] /= len(data) - less
-        for key in proportions_of_data:
-            proportions_of_data[key] /= len(data)
-
-        # Return information gain
-        return (__entropy(proportions_of_data) -
-                less/len(data) * __entropy(proportions_of_less) -
-                (len(data) - less)/len(data) *
-                __entropy(proportions_of_greater))
-
-    # In the elif case, we are dealing with discrete attributes.
-    elif len(values) > 1:
-        # dictionary with dictionaries of proportions of classes for instances
-        # with each possible value of the attribute
-        list_of_proportions = {}
-        # compute the number of instances with each of the possible values
-        instances_per_value = {}
-        for value in values:
-            instances_per_value[value] = 0
-            list_of_proportions[value] = {}
-            for c in classes:
-                list_of_proportions[value][c] = 0.0
-
-        # compute the proportion of each class inside data
-        proportions_of_data = {}
-        for c in classes:
-            proportions_of_data[c] = 0.0
-
-        for instance in data:
-            instances_per_value[instance[index]] += 1
-            proportions_of_data[instance[-1]] += 1
-            list_of_proportions[instance[index]][instance[-1]] += 1
-
-        # divide the amount of instances of each class by the number of
-        # instances to get proportions
-        for c in classes:
-            proportions_of_data[c] /= len(data)
-            for value in values:
-                if instances_per_value[value] > 0:
-                    list_of_proportions[value][c] /= instances_per_value[value]
-
-        # return the information gain
-        profit = __entropy(proportions_of_data)
-
-        for value in values:
-            profit -= (instances_per_value[value]/len(data) *
-                       __entropy(list_of_proportions[value]))
-        return profit
+        # Rows: instances with attribute value <= values[0] and the rest
+        codes = column > values[0]
+        table = contingency_table(codes, labels, 2, len(classes))
     else:
-        return "Utils.profit: values must be non-empty"
+        if len(column) > 0:
+            column = value_codes(column, values)
+        table = contingency_table(column, labels, len(values), len(classes))
+    return information_gain(table)
+
+
+'''
+Finds the cutting point with the highest information gain for a numerical
+attribute in one sorted pass: the column is sorted once, the class counts
+of the instances below each candidate are obtained as prefix sums and the
+gain of every distinct value as cutting point is evaluated at once.
+column is an array with the attribute value of each instance and labels an
+integer array with the index of the class of each instance.
+Returns a tuple (cutting_value, gain), where the instances with attribute
+value less than or equal to cutting_value are the ones below the cut (ties
+are resolved in favor of the smallest value). Returns (None, None) if the
+column is empty.
+'''
+
+
+def best_cutting_point(column, labels, amount_classes):
+    amount_instances = len(column)
+    if amount_instances == 0:
+        return None, None
+    order = numpy.argsort(column, kind='stable')
+    sorted_column = column[order]
+    # Class counts of the instances up to each position of the sorted column
+    below = numpy.zeros((amount_instances, amount_classes), dtype=numpy.int64)
+    below[numpy.arange(amount_instances), labels[order]] = 1
+    numpy.cumsum(below, axis=0, out=below)
+    # The candidates are the last positions of each distinct value
+    last_positions = numpy.flatnonzero(numpy.append(
+        sorted_column[1:] != sorted_column[:-1], True))
+    gains = __cut_gains(below[last_positions], below[-1])
+    best = int(numpy.argmax(gains))
+    return sorted_column[last_positions[best]].item(), float(gains[best])
+
+
+'''
+Computes, for a set of candidate cuts, the information gain of splitting
+the instances into those below and above each cut.
+below is a 2-D array with the class counts of the instances below each
+candidate (one row per candidate) and class_totals the class counts of all
+the instances.
+Returns an array with the gain of each candidate.
+'''
+
+
+def __cut_gains(below, class_totals):
+    amount_instances = int(class_totals.sum())
+    above = class_totals - below
+    amount_below = below.sum(axis=1)
+    amount_above = amount_instances - amount_below
+    return (__entropy_of_count_rows(class_totals.reshape(1, -1),
+                                    amount_instances)[0] -
+            amount_below/amount_instances *
+            __entropy_of_count_rows(below, amount_below) -
+            amount_above/amount_instances *
+            __entropy_of_count_rows(above, amount_above))
+
+
+'''
+Returns the edges of amount_bins quantile buckets of the values in column:
+a sorted array of distinct values of the column, such that the bucket of a
+value x is the amount of edges lower than x (see numpy.searchsorted).
+The edges are values of the column, so they are valid cutting points.
+'''
+
+
+def quantile_bin_edges(column, amount_bins):
+    if len(column) == 0:
+        return numpy.zeros(0, dtype=numpy.asarray(column).dtype)
+    sorted_column = numpy.sort(column)
+    positions = (numpy.arange(1, amount_bins) * len(sorted_column) //
+                 amount_bins)
+    return numpy.unique(sorted_column[positions])
+
+
+'''
+Histogram version of best_cutting_point.
+histogram is a 2-D array with the class counts of the instances in each
+bucket defined by edges (see quantile_bin_edges); only the edges are
+evaluated as cutting points, in O(buckets x classes) operations.
+Returns a tuple (cutting_value, gain) like best_cutting_point. The gain is
+computed with information_gain, so it equals profit for the cutting value.
+Returns (None, None) if there are no instances or no edges.
+'''
+
+
+def histogram_cutting_point(histogram, edges):
+    histogram = numpy.asarray(histogram)
+    class_totals = histogram.sum(axis=0)
+    if len(edges) == 0 or class_totals.sum() == 0:
+        return None, None
+    # Class counts of the instances in the buckets up to each edge
+    below = numpy.cumsum(histogram, axis=0)[:len(edges)]
+    best = int(numpy.argmax(__cut_gains(below, class_totals)))
+    table = numpy.stack([below[best], class_totals - below[best]])
+    return edges[best].item(), information_gain(table)
+
+
+'''
+Vectorized entropy of each row of a 2-D array of class counts, given the
+total of each row. Rows with total 0 have entropy 0.
+'''
+
+
+def __entropy_of_count_rows(counts, totals):
+    totals = numpy.maximum(numpy.asarray(totals, dtype=numpy.float64), 1)
+    proportions = counts / totals.reshape(-1, 1)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        terms = numpy.where(proportions > 0,
+                            proportions*numpy.log2(proportions), 0.0)
+    return -terms.sum(axis=1)
 
 
 '''
@@ -142,3 +245,21 @@ def weighted_random(values, distribution):
         cumulative_distribution += distribution[i]
         if rand_num < cumulative_distribution:
             return i
+
+
+'''
+Returns the resident memory in bytes of the process pid (the current process
+if None). Where /proc/<pid>/statm is not available, the peak resident memory
+is returned for the current process and 0 for any other one.
+'''
+
+
+def resident_memory(pid=None):
+    try:
+        with open('/proc/{pid}/statm'.format(
+                pid='self' if pid is None else pid)) as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        if pid is not None:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,42 @@
+'''
+Tests of the class distributions the folds of CrossValidation are trained
+with.
+'''
+
+import Classifier
+import CrossValidation
+import Data
+import os
+import unittest
+
+
+def setUpModule():
+    # The datasets are read from paths relative to the project directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestFoldDistributions(unittest.TestCase):
+    def assert_distribution(self, distribution):
+        self.assertAlmostEqual(sum(distribution.values()), 1)
+        for proportion in distribution.values():
+            self.assertGreaterEqual(proportion, 0)
+
+    def test_training_folds_are_normalized(self):
+        for columnar in [False, True]:
+            data = Data.Data('iris', columnar)
+            folds = CrossValidation.draw_folds(data, 3, True, 0)
+            data_training, _ = data.apply_split(
+                {'training': folds[0], 'validation': folds[1]})
+            data_training.recalculate_distributions()
+            self.assert_distribution(data_training.class_distribution)
+            self.assert_distribution(data_training.global_class_distribution)
+            for class_label in data_training.classes:
+                new_data = Classifier.one_versus_rest_data(data_training,
+                                                           class_label)
+                self.assert_distribution(new_data.class_distribution)
+                self.assert_distribution(
+                    new_data.global_class_distribution)
+
+
+if __name__ == '__main__':
+    unittest.main()
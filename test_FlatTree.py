@@ -0,0 +1,104 @@
+'''
+Tests of the trees compiled to flat arrays by FlatTree, which must classify
+as the treelib trees they come from.
+'''
+
+import Classifier
+import Data
+import FlatTree
+import ID3
+import numpy
+import os
+import random
+import re
+import tempfile
+import unittest
+
+
+def setUpModule():
+    # The datasets are read from paths relative to the project directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestFlatTreePrediction(unittest.TestCase):
+    def train(self, max_depth):
+        random.seed(0)
+        data = Data.Data('iris')
+        data_training, data_validation = data.divide_corpus(0.5, seed=0)
+        tree, breakpoints = ID3.ID3(data_training, max_depth=max_depth)
+        return tree, breakpoints, data_validation
+
+    def test_predict_matches_classify(self):
+        for max_depth in [1, 3, None]:
+            tree, breakpoints, data = self.train(max_depth)
+            raw_matrix = data.feature_matrix()
+            data.apply_breakpoints(breakpoints)
+            # The paths that leave the tree get the only class of the
+            # distribution, so classify does not draw random classes
+            fallback = data.classes[0]
+            expected = []
+            for instance in data.dataset:
+                tag = Classifier.classify(tree, instance, {fallback: 1})
+                label = re.findall(r'Class ([^,]+)', tag)[0]
+                expected.append([str(c) for c in data.classes].index(label))
+            flat_tree = FlatTree.FlatTree.compile(tree)
+            predictions = flat_tree.predict(data.feature_matrix(),
+                                            data.classes)
+            predictions[predictions < 0] = 0
+            self.assertEqual(predictions.tolist(), expected)
+            # A tree with the cutting values routes the raw instances
+            raw_tree = flat_tree.with_breakpoints(breakpoints)
+            predictions = raw_tree.predict(raw_matrix, data.classes)
+            predictions[predictions < 0] = 0
+            self.assertEqual(predictions.tolist(), expected)
+
+    def test_leaf_matches_leaves(self):
+        tree, breakpoints, data = self.train(None)
+        data.apply_breakpoints(breakpoints)
+        flat_tree = FlatTree.FlatTree.compile(tree)
+        matrix = data.feature_matrix()
+        self.assertEqual(flat_tree.leaves(matrix).tolist(),
+                         [flat_tree.leaf(row) for row in matrix.tolist()])
+        self.assertTrue(numpy.all(flat_tree.leaves(matrix) >= 0))
+
+
+class TestModelFile(unittest.TestCase):
+    def test_save_load_round_trip(self):
+        random.seed(0)
+        data = Data.Data('iris')
+        trees, breakpoints, distributions = [], [], []
+        for class_label in data.classes:
+            new_data = Classifier.one_versus_rest_data(data, class_label)
+            tree, cutting_values = ID3.ID3(new_data, max_depth=None)
+            trees.append(FlatTree.FlatTree.compile(tree, thresholds=True))
+            breakpoints.append(cutting_values)
+            distributions.append(new_data.class_distribution)
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'model.bin')
+            FlatTree.save_model(file_path, 'iris', data.classes, trees,
+                                breakpoints, distributions, data.classes)
+            self.assertTrue(FlatTree.is_model(file_path))
+            loaded = FlatTree.load_model(file_path)
+            loaded_trees, loaded_breakpoints = loaded[0], loaded[1]
+            loaded_distributions, members, header = loaded[2:]
+            self.assertEqual(header['data_name'], 'iris')
+            self.assertEqual(header['classes'], data.classes)
+            self.assertEqual(loaded_breakpoints, breakpoints)
+            self.assertEqual(loaded_distributions, distributions)
+            self.assertEqual(members, data.classes)
+            matrix = data.feature_matrix()
+            for tree, loaded_tree in zip(trees, loaded_trees):
+                for field in ['feature', 'child_offset', 'child_count',
+                              'children', 'leaf_class', 'leaf_count',
+                              'threshold']:
+                    numpy.testing.assert_array_equal(
+                        getattr(loaded_tree, field), getattr(tree, field))
+                self.assertEqual(loaded_tree.labels, tree.labels)
+                self.assertEqual(loaded_tree.leaves(matrix).tolist(),
+                                 tree.leaves(matrix).tolist())
+        # A dataset file is not a model file
+        self.assertFalse(FlatTree.is_model(Data.binary_data('iris')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+'''
+Tests of the out of core training of OutOfCore, which must grow the same
+tree as ID3.ID3 with histograms when the sample covers every instance.
+'''
+
+import Data
+import ID3
+import OutOfCore
+import os
+import random
+import tempfile
+import unittest
+
+
+def setUpModule():
+    # The datasets are read from paths relative to the project directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestOutOfCore(unittest.TestCase):
+    def assert_same_tree(self, tree, other_tree):
+        self.assertEqual(
+            sorted((n.identifier, n.tag) for n in tree.all_nodes()),
+            sorted((n.identifier, n.tag) for n in other_tree.all_nodes()))
+
+    def test_same_tree_as_histograms(self):
+        with tempfile.TemporaryDirectory() as directory:
+            training_path = os.path.join(directory, 'training.bin')
+            validation_path = os.path.join(directory, 'validation.bin')
+            Data.split_chunks(Data.binary_data('iris'), 0.8, 0, 32,
+                              training_path, validation_path)
+            data = Data.load_data('iris', training_path, columnar=True)
+            for bins in [8, 256]:
+                for max_depth in [3, None]:
+                    random.seed(0)
+                    tree, cutting_values = OutOfCore.ID3_out_of_core(
+                        'iris', training_path, 32,
+                        sample_rows=len(data.dataset), seed=0,
+                        histogram_bins=bins, max_depth=max_depth)
+                    random.seed(0)
+                    expected_tree, expected_values = ID3.ID3(
+                        data, histogram_bins=bins, expansion='breadth',
+                        max_depth=max_depth)
+                    self.assert_same_tree(tree, expected_tree)
+                    self.assertEqual(cutting_values, expected_values)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+'''
+Tests of the binary dataset files of Storage.
+'''
+
+import Data
+import numpy
+import os
+import Storage
+import tempfile
+import unittest
+
+
+def setUpModule():
+    # The datasets are read from paths relative to the project directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestDatasetFile(unittest.TestCase):
+    def assert_same_dataset(self, loaded, dataset):
+        numpy.testing.assert_array_equal(loaded.feature_matrix(),
+                                         dataset.feature_matrix())
+        numpy.testing.assert_array_equal(loaded.label_vector(),
+                                         dataset.label_vector())
+        self.assertEqual(list(loaded.classes), list(dataset.classes))
+        self.assertEqual(list(loaded.discrete), list(dataset.discrete))
+        self.assertEqual(list(loaded), list(dataset))
+
+    def test_save_load_round_trip(self):
+        dataset = Data.Data('iris', columnar=True).dataset
+        # A view of some rows, with a cut column, is saved as it reads
+        view = dataset.take(numpy.arange(0, len(dataset), 3))
+        view.split_column(2, 2.5)
+        with tempfile.TemporaryDirectory() as directory:
+            for saved in [dataset, view]:
+                file_path = os.path.join(directory, 'data.bin')
+                Storage.save_dataset(saved, file_path, 'iris',
+                                     Data.iris_raw_data)
+                loaded, header = Storage.load_dataset(file_path)
+                self.assertEqual(header['data_name'], 'iris')
+                self.assertEqual(header['rows'], len(saved))
+                self.assert_same_dataset(loaded, saved)
+                self.assertFalse(Storage.is_stale(
+                    file_path, Data.iris_raw_data, 'iris'))
+                self.assertTrue(Storage.is_stale(
+                    file_path, Data.iris_raw_data, 'covtype'))
+
+    def test_save_chunks_round_trip(self):
+        dataset = Data.Data('iris', columnar=True).dataset
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'data.bin')
+            Storage.save_dataset(dataset, file_path, 'iris')
+            chunks_path = os.path.join(directory, 'chunks.bin')
+            Storage.save_dataset_chunks(
+                Storage.read_chunks(file_path, 7), chunks_path, len(dataset),
+                Storage.read_header(file_path))
+            loaded, _ = Storage.load_dataset(chunks_path)
+            self.assert_same_dataset(loaded, dataset)
+            with self.assertRaises(ValueError):
+                Storage.save_dataset_chunks(
+                    Storage.read_chunks(file_path, 7), chunks_path,
+                    len(dataset) - 1, Storage.read_header(file_path))
+            # The file is only replaced once every block is written
+            loaded, _ = Storage.load_dataset(chunks_path)
+            self.assert_same_dataset(loaded, dataset)
+
+
+if __name__ == '__main__':
+    unittest.main()
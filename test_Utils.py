@@ -0,0 +1,89 @@
+'''
+Tests of the vectorized information gain of Utils, which must match the
+instance by instance computation it replaced.
+'''
+
+import Data
+import math
+import os
+import random
+import Storage
+import Utils
+import unittest
+
+
+def setUpModule():
+    # The datasets are read from paths relative to the project directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+
+'''
+Entropy of the classes (the last element) of instances.
+'''
+
+
+def entropy(instances):
+    proportions = {}
+    for instance in instances:
+        proportions[instance[-1]] = proportions.get(instance[-1], 0) + 1
+    result = 0
+    for count in proportions.values():
+        result -= count/len(instances) * math.log2(count/len(instances))
+    return result
+
+
+'''
+Row-wise information gain of splitting instances (a list of lists) by the
+attribute index: by the cutting point values[0] if there is a single
+value, and by each value in values otherwise.
+'''
+
+
+def row_wise_profit(instances, index, values):
+    if len(values) == 1:
+        partitions = [[i for i in instances if i[index] <= values[0]],
+                      [i for i in instances if i[index] > values[0]]]
+    else:
+        partitions = [[i for i in instances if i[index] == value]
+                      for value in values]
+    gain = entropy(instances)
+    for partition in partitions:
+        if len(partition) > 0:
+            gain -= len(partition)/len(instances) * entropy(partition)
+    return gain
+
+
+class TestProfit(unittest.TestCase):
+    def assert_profit(self, instances, index, values, classes):
+        expected = row_wise_profit(instances, index, values)
+        self.assertAlmostEqual(
+            Utils.profit(instances, index, values, classes), expected,
+            places=12)
+        columnar = Storage.ColumnarDataset.from_rows(instances, classes)
+        self.assertAlmostEqual(
+            Utils.profit(columnar, index, values, classes), expected,
+            places=12)
+
+    def test_cutting_points(self):
+        data = Data.Data('iris')
+        for attribute in data.attributes:
+            column = sorted(set(i[attribute] for i in data.dataset))
+            for cutting_value in column[::5]:
+                self.assert_profit(data.dataset, attribute, [cutting_value],
+                                   data.classes)
+
+    def test_discrete_values(self):
+        generator = random.Random(0)
+        classes = ['a', 'b', 'c']
+        for values in [[0, 1], [0, 1, 2, 3], [2, 5, 9]]:
+            instances = [[generator.choice(values), generator.choice(values),
+                          generator.choice(classes)] for _ in range(200)]
+            # The second attribute decides the class of most instances
+            for instance in instances[:150]:
+                instance[-1] = classes[values.index(instance[1]) % 3]
+            for index in [0, 1]:
+                self.assert_profit(instances, index, values, classes)
+
+
+if __name__ == '__main__':
+    unittest.main()